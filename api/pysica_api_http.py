@@ -6,106 +6,283 @@ v0.2 December 2018
 
 import requests
 import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pysica_sharding import HashRing, parse_endpoint, gather_responses
 
 
 class SimpleCache:
 
-    def __init__(self, server="localhost", port=4444, protocol="http"):
+    def __init__(self, server="localhost", port=4444, protocol="http", pool_size=10, request_timeout=10, retries=3, backoff_factor=0.1, servers=None, virtual_nodes=160):
         self.server = server
         self.port = port
         self.protocol = protocol
-
-    def add(self, element_id, data, data_type="object", timeout=None, compress=None, user_id=None):
-        return cache_add(element_id, data, data_type, timeout, compress, user_id, server=self.server, port=self.port, protocol=self.protocol)
+        self.base_url = get_base_url(server, port, protocol)
+        # Seconds to wait for the server to connect and to respond
+        self.request_timeout = request_timeout
+        # Keep-alive connections reused by all the calls
+        self.session = create_session(pool_size=pool_size, retries=retries, backoff_factor=backoff_factor)
+        # Sharding: with a list of servers, each key is sent to one of them chosen
+        # using consistent hashing (by user_id if given, by element_id otherwise)
+        self.shards = None
+        self.ring = None
+        self.executor = None
+        if servers:
+            endpoints = [parse_endpoint(endpoint, port) for endpoint in servers]
+            self.shards = [SimpleCache(endpoint.get("server"), endpoint.get("port"), protocol, pool_size, request_timeout, retries, backoff_factor) for endpoint in endpoints]
+            self.ring = HashRing([(shard, endpoint.get("name"), endpoint.get("weight")) for (shard, endpoint) in zip(self.shards, endpoints)], virtual_nodes=virtual_nodes)
+            self.executor = ThreadPoolExecutor(max_workers=len(self.shards))
+
+    def add(self, element_id, data, data_type="object", timeout=None, compress=None, user_id=None, raw=False):
+        shard = self.get_shard(element_id, user_id)
+        return cache_add(element_id, data, data_type, timeout, compress, user_id, server=shard.server, port=shard.port, protocol=self.protocol, raw=raw, session=shard.session, request_timeout=self.request_timeout, base_url=shard.base_url)
 
     def get(self, element_id=None, data_type=None, user_id=None, reset_timeout=False, timeout=None):
-        return cache_get(element_id, data_type, user_id, reset_timeout, timeout, server=self.server, port=self.port, protocol=self.protocol)
+        if self.ring is not None and element_id is None and user_id is None:
+            # Elements in the general cache can be in any shard
+            return Response(gather_responses(self.scatter(lambda shard: shard.get(element_id, data_type, user_id, reset_timeout, timeout))))
+        shard = self.get_shard(element_id, user_id)
+        return cache_get(element_id, data_type, user_id, reset_timeout, timeout, server=shard.server, port=shard.port, protocol=self.protocol, session=shard.session, request_timeout=self.request_timeout, base_url=shard.base_url)
+
+    def iter_type(self, data_type, user_id=None, reset_timeout=False, timeout=None):
+        """
+        Yields the elements ({"id": element_id, "data": value}) for the given data_type as
+        the server streams them (NDJSON), instead of receiving the whole result at once.
+        Raises an exception if the request or the query fails.
+        """
+        shards = self.shards if self.ring is not None and user_id is None else [self.get_shard(user_id=user_id)]
+        for shard in shards:
+            for item in cache_iter_type(data_type, user_id, reset_timeout, timeout, protocol=self.protocol, session=shard.session, request_timeout=self.request_timeout, base_url=shard.base_url):
+                yield item
 
     def remove(self, element_id, user_id=None, return_elem=False):
-        return cache_remove(element_id, user_id=user_id, server=self.server, port=self.port, protocol=self.protocol, return_elem=return_elem)
+        shard = self.get_shard(element_id, user_id)
+        return cache_remove(element_id, user_id=user_id, server=shard.server, port=shard.port, protocol=self.protocol, return_elem=return_elem, session=shard.session, request_timeout=self.request_timeout, base_url=shard.base_url)
 
     def reset(self, element_id=None, timeout=None, user_id=None):
-        return cache_reset(element_id, timeout=timeout, user_id=user_id, server=self.server, port=self.port, protocol=self.protocol)
-
-
-def cache_add(element_id, data, data_type, timeout=None, compress=None, user_id=None, server="localhost", port=4444, protocol="http"):
+        shard = self.get_shard(element_id, user_id)
+        return cache_reset(element_id, timeout=timeout, user_id=user_id, server=shard.server, port=shard.port, protocol=self.protocol, session=shard.session, request_timeout=self.request_timeout, base_url=shard.base_url)
+
+    def add_many(self, elements, timeout=None, compress=None, user_id=None):
+        """
+        Stores several elements in a single request (one per shard). Elements are dicts
+        with element_id, data, data_type and optionally timeout, compress, user_id and
+        raw. Returns a Response for each element.
+        """
+        return self.batch("add", elements, timeout=timeout, compress=compress, user_id=user_id)
+
+    def get_many(self, element_ids, user_id=None, reset_timeout=False, timeout=None):
+        return self.batch("get", element_ids, timeout=timeout, user_id=user_id, reset_timeout=reset_timeout)
+
+    def remove_many(self, element_ids, user_id=None, return_elem=False):
+        return self.batch("remove", element_ids, user_id=user_id, return_elem=return_elem)
+
+    def reset_many(self, element_ids, timeout=None, user_id=None):
+        return self.batch("reset", element_ids, timeout=timeout, user_id=user_id)
+
+    def batch(self, operation, items, user_id=None, **options):
+        items = list(items)
+        if self.ring is None:
+            return cache_batch(operation, items, user_id=user_id, session=self.session, request_timeout=self.request_timeout, base_url=self.base_url, **options)
+        # Group the items by shard and restore their order once all the shards respond
+        groups = OrderedDict()
+        for (index, item) in enumerate(items):
+            if operation == "add":
+                shard = self.get_shard(item.get("element_id"), item.get("user_id", user_id))
+            else:
+                shard = self.get_shard(item, user_id)
+            groups.setdefault(shard, []).append(index)
+        responses = [None] * len(items)
+        groups = list(groups.items())
+        results = self.executor.map(lambda group: group[0].batch(operation, [items[index] for index in group[1]], user_id=user_id, **options), groups)
+        for ((shard, indexes), result) in zip(groups, results):
+            for (index, response) in zip(indexes, result):
+                responses[index] = response
+        return responses
+
+    def get_shard(self, element_id=None, user_id=None):
+        """
+        Returns the SimpleCache for the server that stores the given key (self if the
+        cache is not sharded).
+        """
+        if self.ring is None:
+            return self
+        return self.ring.get_node(user_id if user_id is not None else element_id)
+
+    def scatter(self, function):
+        """
+        Calls function for each shard, at the same time, and returns their results.
+        """
+        return list(self.executor.map(function, self.shards))
+
+    def close(self):
+        self.session.close()
+        if self.shards is not None:
+            for shard in self.shards:
+                shard.close()
+            self.executor.shutdown(wait=False)
+
+
+def create_session(pool_size=10, retries=3, backoff_factor=0.1):
+    """
+    Creates a requests session with up to pool_size keep-alive connections. Failed
+    connections are retried up to retries times, waiting backoff_factor * 2^(n-1)
+    seconds between attempts. Read errors and 502/503/504 responds are only retried for
+    idempotent methods (the default ones of urllib3), never for POST (e.g. adds).
+    """
+    retry = Retry(total=retries, connect=retries, read=retries, backoff_factor=backoff_factor, status_forcelist=(502, 503, 504), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_base_url(server="localhost", port=4444, protocol="http"):
+    return protocol + "://" + server.replace(protocol + "://", "").rstrip("/") + ":" + str(port)
+
+
+def cache_add(element_id, data, data_type, timeout=None, compress=None, user_id=None, server="localhost", port=4444, protocol="http", raw=False, session=None, request_timeout=None, base_url=None):
+    """
+    Stores a new element in the cache. With raw=True, data must be the value already
+    encoded as JSON (str or bytes), it is sent as the body of the request and the
+    server stores it and returns it as it is.
+    """
     try:
-        server = protocol + "://" + server.replace(protocol + "://", "").rstrip("/") + ":" + str(port)
-        response = requests.post(server + "/api/add", json={
+        url = (base_url or get_base_url(server, port, protocol)) + "/api/add"
+        if raw:
+            params = {'raw': 1, 'element_id': element_id, 'data_type': data_type}
+            if timeout is not None:
+                params['timeout'] = timeout
+            if user_id is not None:
+                params['user_id'] = user_id
+            response = (session or requests).post(url, params=params, data=data.encode("utf-8") if not isinstance(data, bytes) else data, headers={'Content-Type': 'application/octet-stream'}, timeout=request_timeout)
+            return Response(json.loads(response.text))
+        response = (session or requests).post(url, json={
             'element_id': element_id,
             'data': data,
             'data_type': data_type,
             'timeout': timeout,
             'compress': compress,
             'user_id': user_id
-        })
+        }, timeout=request_timeout)
         return Response(json.loads(response.text))
-    except:
-        return Response({"success": False, "message": "Unable to connect to cache server."})
+    except Exception as ex:
+        return Response({"success": False, "message": "Unable to add element to cache. Error message: " + str(ex)})
 
 
-def cache_get(element_id=None, data_type=None, user_id=None, reset_timeout=False, timeout=None, server="localhost", port=4444, protocol="http"):
+def cache_get(element_id=None, data_type=None, user_id=None, reset_timeout=False, timeout=None, server="localhost", port=4444, protocol="http", session=None, request_timeout=None, base_url=None):
     try:
-        server = protocol + "://" + server.replace(protocol + "://", "").rstrip("/") + ":" + str(port)
-
-        url = server + "/api/get"
+        url = (base_url or get_base_url(server, port, protocol)) + "/api/get"
         if element_id is not None:
-            url+= "/" + element_id
-
-        extra = ""
-        extra += ("&data_type=" + data_type if data_type else "")
-        extra += ("&user_id=" + user_id if user_id else "")
-        extra += ("&reset_timeout=1" if reset_timeout else "")
-        extra += ("&timeout=" + str(timeout) if timeout else "")
-
-        if extra != "":
-            extra = "?" + extra[1:]
-            url += extra
-
-        response = requests.get(url)
+            url += "/" + element_id
+
+        params = {}
+        if data_type:
+            params['data_type'] = data_type
+        if user_id:
+            params['user_id'] = user_id
+        if reset_timeout:
+            params['reset_timeout'] = 1
+        if timeout:
+            params['timeout'] = timeout
+
+        response = (session or requests).get(url, params=params, timeout=request_timeout)
         return Response(json.loads(response.text))
-    except:
-        return Response({"success": False, "message": "Unable to connect to cache server."})
-
-
-def cache_remove(element_id, user_id=None, server="localhost", port=4444, protocol="http", return_elem=False):
+    except Exception as ex:
+        return Response({"success": False, "message": "Unable to get element from cache. Error message: " + str(ex)})
+
+
+def cache_iter_type(data_type, user_id=None, reset_timeout=False, timeout=None, server="localhost", port=4444, protocol="http", session=None, request_timeout=None, base_url=None):
+    """
+    Yields the elements for the given data_type from a streamed (NDJSON) respond.
+    """
+    url = (base_url or get_base_url(server, port, protocol)) + "/api/get"
+    params = {'data_type': data_type, 'stream': 1}
+    if user_id:
+        params['user_id'] = user_id
+    if reset_timeout:
+        params['reset_timeout'] = 1
+    if timeout:
+        params['timeout'] = timeout
+    response = (session or requests).get(url, params=params, stream=True, timeout=request_timeout)
     try:
-        server = protocol + "://" + server.replace(protocol + "://", "").rstrip("/") + ":" + str(port)
-
-        url = server + "/api/remove/" + element_id
-
-        extra = ""
-        extra += ("&user_id=" + user_id if user_id else "")
-        extra += ("&return=1" if return_elem else "")
+        for line in response.iter_lines(chunk_size=65536):
+            if not line:
+                continue
+            respond = json.loads(line.decode("utf-8"))
+            if "id" in respond:
+                yield respond
+            elif "result" in respond:
+                # Not streamed by the server, a single respond with all the elements
+                for item in respond.get("result"):
+                    yield item
+            elif "message" in respond:
+                raise Exception(respond.get("message"))
+    finally:
+        response.close()
+
+
+def cache_remove(element_id, user_id=None, server="localhost", port=4444, protocol="http", return_elem=False, session=None, request_timeout=None, base_url=None):
+    try:
+        url = (base_url or get_base_url(server, port, protocol)) + "/api/remove/" + element_id
 
-        if extra != "":
-            extra = "?" + extra[1:]
-            url += extra
+        params = {}
+        if user_id:
+            params['user_id'] = user_id
+        if return_elem:
+            params['return'] = 1
 
-        response = requests.delete(url)
+        response = (session or requests).delete(url, params=params, timeout=request_timeout)
         return Response(json.loads(response.text))
-    except:
-        return Response({"success": False, "message": "Unable to connect to cache server."})
+    except Exception as ex:
+        return Response({"success": False, "message": "Unable to remove element from cache. Error message: " + str(ex)})
 
 
-def cache_reset(element_id, timeout=None, user_id=None, server="localhost", port=4444, protocol="http"):
+def cache_reset(element_id, timeout=None, user_id=None, server="localhost", port=4444, protocol="http", session=None, request_timeout=None, base_url=None):
     try:
-        server = protocol + "://" + server.replace(protocol + "://", "").rstrip("/") + ":" + str(port)
+        url = (base_url or get_base_url(server, port, protocol)) + "/api/reset/" + element_id
 
-        url = server + "/api/reset/" + element_id
+        params = {}
+        if user_id:
+            params['user_id'] = user_id
+        if timeout:
+            params['timeout'] = timeout
 
-        extra = ""
-        extra += ("&user_id=" + user_id if user_id else "")
-        extra += ("&timeout=" + str(timeout) if timeout else "")
+        response = (session or requests).put(url, params=params, timeout=request_timeout)
+        return Response(json.loads(response.text))
+    except Exception as ex:
+        return Response({"success": False, "message": "Unable to reset element at cache. Error message: " + str(ex)})
 
-        if extra != "":
-            extra = "?" + extra[1:]
-            url += extra
 
-        response = requests.put(url)
-        return Response(json.loads(response.text))
-    except:
-        return Response({"success": False, "message": "Unable to connect to cache server."})
+def cache_batch(operation, items, timeout=None, compress=None, user_id=None, reset_timeout=False, return_elem=False, server="localhost", port=4444, protocol="http", session=None, request_timeout=None, base_url=None):
+    """
+    Runs the same operation (add, get, remove or reset) for several items in a single
+    request and returns a Response for each item. Items are element ids, or dicts as
+    the ones for SimpleCache.add_many when adding.
+    """
+    items = list(items)
+    try:
+        if operation == "add":
+            items = [dict(item, data=item.get("data").decode("utf-8")) if item.get("raw") and isinstance(item.get("data"), bytes) else item for item in items]
+        url = (base_url or get_base_url(server, port, protocol)) + "/api/batch"
+        response = (session or requests).post(url, json={
+            'operation': operation,
+            'items': items,
+            'timeout': timeout,
+            'compress': compress,
+            'user_id': user_id,
+            'reset_timeout': reset_timeout,
+            'return': return_elem
+        }, timeout=request_timeout)
+        response = json.loads(response.text)
+    except Exception as ex:
+        response = {"success": False, "message": "Unable to run batch at cache. Error message: " + str(ex)}
+    if not response.get("success"):
+        return [Response(response) for item in items]
+    return [Response(result) for result in response.get("result")]
 
 
 class Response(object):
@@ -1,186 +1,670 @@
 import socket
 import json
 import zlib
-from struct import unpack, pack
+import time
+import itertools
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pysica_framing import pack_header, recv_header, recv_exactly, recv_decompress, recv_payload, send_buffers, dumps_payload, compress_payload, loads_payload, ConnectionClosedError, PROTOCOL_VERSION, FLAG_CLOSE, FLAG_MORE, FLAG_ADAPTIVE, MAX_FRAME_SIZE
+from pysica_sharding import HashRing, parse_endpoint, gather_responses
+
+# Targets of the requests that have the same effect if they are applied twice, they are
+# retried when a pooled connection fails before their respond arrives
+IDEMPOTENT_TARGETS = ("get", "reset", "stats")
+
+
+class RequestNotSentError(ConnectionError):
+    """
+    The request could not be written to the connection, so the server did not apply it.
+    """
+    pass
 
 
 class SimpleCache:
 
-    def __init__(self, socket_file=None, server="localhost", port=4444, buffer_size=4096):
+    def __init__(self, socket_file=None, server="localhost", port=4444, buffer_size=4096, persistent=False, pool_size=8, pool_idle_timeout=20, pool_wait_timeout=10, servers=None, virtual_nodes=160, wire_serializer="json", wire_compress_level=1, wire_compress_min_size=1024, connect_timeout=5, read_timeout=30):
         self.socket_file = socket_file
         self.server = server
         self.port = port
         self.buffer_size = buffer_size
-
-    def add(self, element_id, data, data_type="object", timeout=None, compress=None, user_id=None):
-        return cache_add(element_id, data, data_type, timeout, compress, user_id, socket_file=self.socket_file, server=self.server, port=self.port, buffer_size=self.buffer_size)
+        # Seconds to wait for a connection to the server and for each read of a respond
+        # (None to wait forever). Timed out requests are not retried, the server may have
+        # applied them
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # Encoding of the requests sent through protocol version 2 connections (pools and
+        # pipelines): json or marshal, compressed with zlib at wire_compress_level (0 to
+        # disable it) if larger than wire_compress_min_size bytes
+        self.wire_options = dict(serializer=wire_serializer, compress_level=wire_compress_level, compress_min_size=wire_compress_min_size)
+        # Reuse connections (protocol version 2) instead of opening one per call
+        self.persistent = persistent
+        self.pool = ConnectionPool(socket_file, server, port, max_size=pool_size, idle_timeout=pool_idle_timeout, wait_timeout=pool_wait_timeout, wire_options=self.wire_options, connect_timeout=connect_timeout, read_timeout=read_timeout) if persistent else None
+        # Sharding: with a list of servers, each key is sent to one of them chosen
+        # using consistent hashing (by user_id if given, by element_id otherwise)
+        self.shards = None
+        self.ring = None
+        self.executor = None
+        if servers:
+            endpoints = [parse_endpoint(endpoint, port) for endpoint in servers]
+            self.shards = [SimpleCache(endpoint.get("socket_file"), endpoint.get("server"), endpoint.get("port"), buffer_size, persistent, pool_size, pool_idle_timeout, pool_wait_timeout, wire_serializer=wire_serializer, wire_compress_level=wire_compress_level, wire_compress_min_size=wire_compress_min_size, connect_timeout=connect_timeout, read_timeout=read_timeout) for endpoint in endpoints]
+            self.ring = HashRing([(shard, endpoint.get("name"), endpoint.get("weight")) for (shard, endpoint) in zip(self.shards, endpoints)], virtual_nodes=virtual_nodes)
+            self.executor = ThreadPoolExecutor(max_workers=len(self.shards))
+
+    def add(self, element_id, data, data_type="object", timeout=None, compress=None, user_id=None, raw=False):
+        shard = self.get_shard(element_id, user_id)
+        return cache_add(element_id, data, data_type, timeout, compress, user_id, socket_file=shard.socket_file, server=shard.server, port=shard.port, buffer_size=self.buffer_size, raw=raw, pool=shard.pool, connect_timeout=self.connect_timeout, read_timeout=self.read_timeout)
 
     def get(self, element_id=None, data_type=None, user_id=None, reset_timeout=False, timeout=None):
-        return cache_get(element_id, data_type, user_id, reset_timeout, timeout, socket_file=self.socket_file, server=self.server, port=self.port, buffer_size=self.buffer_size)
+        if self.ring is not None and element_id is None and user_id is None:
+            # Elements in the general cache can be in any shard
+            return Response(gather_responses(self.scatter(lambda shard: shard.get(element_id, data_type, user_id, reset_timeout, timeout))))
+        shard = self.get_shard(element_id, user_id)
+        return cache_get(element_id, data_type, user_id, reset_timeout, timeout, socket_file=shard.socket_file, server=shard.server, port=shard.port, buffer_size=self.buffer_size, pool=shard.pool, connect_timeout=self.connect_timeout, read_timeout=self.read_timeout)
+
+    def iter_type(self, data_type, user_id=None, reset_timeout=False, timeout=None):
+        """
+        Yields the elements ({"id": element_id, "data": value}) for the given data_type as
+        the server streams them, instead of receiving the whole result at once. Raises an
+        exception if the connection or the query fails.
+        """
+        shards = self.shards if self.ring is not None and user_id is None else [self.get_shard(user_id=user_id)]
+        for shard in shards:
+            for item in cache_iter_type(data_type, user_id, reset_timeout, timeout, socket_file=shard.socket_file, server=shard.server, port=shard.port, buffer_size=self.buffer_size, pool=shard.pool, connect_timeout=self.connect_timeout, read_timeout=self.read_timeout):
+                yield item
 
     def remove(self, element_id, user_id=None, return_elem=False):
-        return cache_remove(element_id, user_id=user_id, return_elem=return_elem, socket_file=self.socket_file, server=self.server, port=self.port, buffer_size=self.buffer_size)
+        shard = self.get_shard(element_id, user_id)
+        return cache_remove(element_id, user_id=user_id, return_elem=return_elem, socket_file=shard.socket_file, server=shard.server, port=shard.port, buffer_size=self.buffer_size, pool=shard.pool, connect_timeout=self.connect_timeout, read_timeout=self.read_timeout)
 
     def reset(self, element_id=None, timeout=None, user_id=None):
-        return cache_reset(element_id, timeout=timeout, user_id=user_id, socket_file=self.socket_file, server=self.server, port=self.port, buffer_size=self.buffer_size)
+        shard = self.get_shard(element_id, user_id)
+        return cache_reset(element_id, timeout=timeout, user_id=user_id, socket_file=shard.socket_file, server=shard.server, port=shard.port, buffer_size=self.buffer_size, pool=shard.pool, connect_timeout=self.connect_timeout, read_timeout=self.read_timeout)
+
+    def add_many(self, elements, timeout=None, compress=None, user_id=None):
+        """
+        Stores several elements in a single request (one per shard). Elements are dicts
+        with element_id, data, data_type and optionally timeout, compress, user_id and
+        raw. Returns a Response for each element.
+        """
+        return self.batch("add", elements, timeout=timeout, compress=compress, user_id=user_id)
+
+    def get_many(self, element_ids, user_id=None, reset_timeout=False, timeout=None):
+        return self.batch("get", element_ids, timeout=timeout, user_id=user_id, reset_timeout=reset_timeout)
+
+    def remove_many(self, element_ids, user_id=None, return_elem=False):
+        return self.batch("remove", element_ids, user_id=user_id, return_elem=return_elem)
+
+    def reset_many(self, element_ids, timeout=None, user_id=None):
+        return self.batch("reset", element_ids, timeout=timeout, user_id=user_id)
+
+    def stats(self):
+        """
+        Returns the metrics of the server (see PySiCa.get_metrics), or a list with
+        the metrics of each server if the cache is sharded.
+        """
+        if self.ring is None:
+            return cache_stats(socket_file=self.socket_file, server=self.server, port=self.port, buffer_size=self.buffer_size, pool=self.pool, connect_timeout=self.connect_timeout, read_timeout=self.read_timeout)
+        return self.scatter(lambda shard: shard.stats())
+
+    def trace(self, enabled=None, slow_threshold=None):
+        """
+        Enables or disables the tracing of the requests in the server, and sets the
+        threshold (seconds) over which requests are logged with their phases. The server
+        must have ADMIN_ENDPOINTS enabled.
+        """
+        if self.ring is None:
+            return send_request({'target': "trace", 'enabled': enabled, 'slow_threshold': slow_threshold}, "Unable to configure tracing at cache.", socket_file=self.socket_file, server=self.server, port=self.port, buffer_size=self.buffer_size, pool=self.pool, connect_timeout=self.connect_timeout, read_timeout=self.read_timeout)
+        return self.scatter(lambda shard: shard.trace(enabled, slow_threshold))
+
+    def profile(self, seconds=None):
+        """
+        Starts the sampling profiler of the server for the given seconds, the result has
+        the file where the collapsed stacks are written. Without seconds, returns the status.
+        The server must have ADMIN_ENDPOINTS enabled.
+        """
+        if self.ring is None:
+            return send_request({'target': "profile", 'seconds': seconds}, "Unable to start the profiler at cache.", socket_file=self.socket_file, server=self.server, port=self.port, buffer_size=self.buffer_size, pool=self.pool, connect_timeout=self.connect_timeout, read_timeout=self.read_timeout)
+        return self.scatter(lambda shard: shard.profile(seconds))
+
+    def batch(self, operation, items, user_id=None, **options):
+        items = list(items)
+        if self.ring is None:
+            return cache_batch(operation, items, user_id=user_id, socket_file=self.socket_file, server=self.server, port=self.port, buffer_size=self.buffer_size, pool=self.pool, connect_timeout=self.connect_timeout, read_timeout=self.read_timeout, **options)
+        # Group the items by shard and restore their order once all the shards respond
+        groups = OrderedDict()
+        for (index, item) in enumerate(items):
+            if operation == "add":
+                shard = self.get_shard(item.get("element_id"), item.get("user_id", user_id))
+            else:
+                shard = self.get_shard(item, user_id)
+            groups.setdefault(shard, []).append(index)
+        responses = [None] * len(items)
+        groups = list(groups.items())
+        results = self.executor.map(lambda group: group[0].batch(operation, [items[index] for index in group[1]], user_id=user_id, **options), groups)
+        for ((shard, indexes), result) in zip(groups, results):
+            for (index, response) in zip(indexes, result):
+                responses[index] = response
+        return responses
+
+    def get_shard(self, element_id=None, user_id=None):
+        """
+        Returns the SimpleCache for the server that stores the given key (self if the
+        cache is not sharded).
+        """
+        if self.ring is None:
+            return self
+        return self.ring.get_node(user_id if user_id is not None else element_id)
+
+    def scatter(self, function):
+        """
+        Calls function for each shard, at the same time, and returns their results.
+        """
+        return list(self.executor.map(function, self.shards))
+
+    def pipeline(self):
+        """
+        Returns a Pipeline to send several requests at once, e.g.
+        cache.pipeline().add("1", data).get("2").execute()
+        """
+        return Pipeline(self)
 
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+        if self.shards is not None:
+            for shard in self.shards:
+                shard.close()
+            self.executor.shutdown(wait=False)
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of open connections (protocol version 2) to a cache server.
+    Connections are checked before being reused, and those idle for more than
+    idle_timeout seconds are closed. No more than max_size connections are open at the
+    same time, callers wait up to wait_timeout seconds for a free one.
+    """
+
+    def __init__(self, socket_file=None, server="localhost", port=4444, max_size=8, idle_timeout=20, wait_timeout=10, wire_options=None, connect_timeout=None, read_timeout=None):
+        self.socket_file = socket_file
+        self.server = server
+        self.port = port
+        self.wire_options = wire_options or {}
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.condition = threading.Condition()
+        # Idle connections as tuples (handler, last use), the most recently used at the end
+        self.idle = deque()
+        self.size = 0
+
+    def acquire(self):
+        with self.condition:
+            deadline = time.time() + self.wait_timeout if self.wait_timeout is not None else None
+            while True:
+                self.evict_idle()
+                while len(self.idle) > 0:
+                    (handler, last_use) = self.idle.pop()
+                    if handler.is_alive():
+                        return handler
+                    handler.close()
+                    self.size -= 1
+                if self.size < self.max_size:
+                    self.size += 1
+                    break
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise Exception("No connection available in the pool after " + str(self.wait_timeout) + " seconds")
+                self.condition.wait(remaining)
+        # Open the new connection out of the lock
+        try:
+            handler = SocketHandler(protocol_version=PROTOCOL_VERSION, connect_timeout=self.connect_timeout, read_timeout=self.read_timeout, **self.wire_options)
+            handler.connect(self.socket_file, self.server, self.port)
+            return handler
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, handler, discard=False):
+        with self.condition:
+            if discard or handler.socket is None:
+                handler.close()
+                self.size -= 1
+            else:
+                self.idle.append((handler, time.time()))
+            self.condition.notify()
+
+    def evict_idle(self):
+        # The oldest connections are at the beginning
+        now = time.time()
+        while len(self.idle) > 0 and now - self.idle[0][1] > self.idle_timeout:
+            (handler, last_use) = self.idle.popleft()
+            handler.close()
+            self.size -= 1
 
-def cache_add(element_id, data, data_type, timeout=None, compress=None, user_id=None, socket_file=None, server="localhost", port=4444, buffer_size=4096):
-    try:
-        cp = SocketHandler()
-        cp.connect(socket_file, server, port)
-    except Exception as ex:
-        return Response({"success": False, "message": "Unable to connect to cache server. Error message: " + str(ex)})
+    def close(self):
+        with self.condition:
+            while len(self.idle) > 0:
+                (handler, last_use) = self.idle.popleft()
+                handler.close()
+                self.size -= 1
 
-    try:
-        # Prepare package
-        data = {
-            'target': "add",
-            'element_id': element_id,
-            'data': data,
-            'data_type': data_type,
-            'timeout': timeout,
-            'compress': compress,
-            'user_id': user_id
-        }
-        # Send data
-        response = cp.send_data(data, buffer_size=buffer_size)
-        cp.close()
-        return Response(json.loads(response))
-    except Exception as ex:
-        return Response({"success": False, "message": "Unable to add element to cache. Error message: " + str(ex)})
 
+class Pipeline:
+    """
+    Requests queued to be sent together through a single connection (one per shard).
+    The server may process them concurrently, responds are matched to the requests by
+    their id.
+    """
 
-def cache_get(element_id=None, data_type=None, user_id=None, reset_timeout=False, timeout=None, socket_file=None, server="localhost", port=4444, buffer_size=4096):
-    try:
-        cp = SocketHandler()
-        cp.connect(socket_file, server, port)
-    except Exception as ex:
-        return Response({"success": False, "message": "Unable to connect to cache server. Error message: " + str(ex)})
+    def __init__(self, cache):
+        self.cache = cache
+        # Tuples (shards, request), queries by data_type in the general cache are sent to all the shards
+        self.requests = []
 
-    try:
-        # Prepare package
-        data = {
-            'target': "get",
-            'element_id': element_id,
-            'data_type': data_type,
-            'user_id': user_id,
-            'reset_timeout': reset_timeout,
-            'timeout': timeout
-        }
-        # Get data
-        response = cp.get_data(data, buffer_size=buffer_size)
-        cp.close()
-        return Response(json.loads(response))
-    except Exception as ex:
-        return Response({"success": False, "message": "Unable to get element from cache. Error message: " + str(ex)})
+    def add(self, element_id, data, data_type="object", timeout=None, compress=None, user_id=None, raw=False):
+        self.requests.append(([self.cache.get_shard(element_id, user_id)], add_request(element_id, data, data_type, timeout, compress, user_id, raw)))
+        return self
 
+    def get(self, element_id=None, data_type=None, user_id=None, reset_timeout=False, timeout=None):
+        if self.cache.ring is not None and element_id is None and user_id is None:
+            shards = self.cache.shards
+        else:
+            shards = [self.cache.get_shard(element_id, user_id)]
+        self.requests.append((shards, get_request(element_id, data_type, user_id, reset_timeout, timeout)))
+        return self
 
-def cache_remove(element_id, user_id=None, return_elem=False, socket_file=None, server="localhost", port=4444, buffer_size=4096):
-    # Get data
-    if return_elem:
-        element = cache_get(element_id=element_id, user_id=user_id, socket_file=socket_file, server=server, port=port, buffer_size=buffer_size)
+    def remove(self, element_id, user_id=None, return_elem=False):
+        self.requests.append(([self.cache.get_shard(element_id, user_id)], remove_request(element_id, user_id, return_elem)))
+        return self
 
-    try:
-        cp = SocketHandler()
+    def reset(self, element_id=None, timeout=None, user_id=None):
+        self.requests.append(([self.cache.get_shard(element_id, user_id)], reset_request(element_id, timeout, user_id)))
+        return self
+
+    def execute(self):
+        """
+        Sends the queued requests and returns the list of Response objects, in the same order.
+        """
+        requests = self.requests
+        self.requests = []
+        groups = OrderedDict()
+        for (index, (shards, request)) in enumerate(requests):
+            for shard in shards:
+                groups.setdefault(shard, []).append(index)
+        responses = [[] for request in requests]
+        for (shard, indexes) in groups.items():
+            for (index, response) in zip(indexes, self.send(shard, [requests[index][1] for index in indexes])):
+                responses[index].append(response)
+        return [response[0] if len(response) == 1 else Response(gather_responses(response)) for response in responses]
+
+    def send(self, shard, requests):
+        pool = shard.pool
+        try:
+            if pool is not None:
+                cp = pool.acquire()
+            else:
+                cp = SocketHandler(protocol_version=PROTOCOL_VERSION, connect_timeout=shard.connect_timeout, read_timeout=shard.read_timeout, **shard.wire_options)
+                cp.connect(shard.socket_file, shard.server, shard.port)
+        except Exception as ex:
+            return [Response({"success": False, "message": "Unable to connect to cache server. Error message: " + str(ex)}) for request in requests]
+        failed = False
+        try:
+            responses = cp.send_requests(requests, buffer_size=shard.buffer_size)
+            return [Response(response if response is not None else {"success": False, "message": "No respond from cache server."}) for response in responses]
+        except Exception as ex:
+            failed = True
+            return [Response({"success": False, "message": "Unable to send requests to cache server. Error message: " + str(ex)}) for request in requests]
+        finally:
+            if pool is not None:
+                pool.release(cp, discard=failed)
+            else:
+                cp.close()
+
+
+def cache_add(element_id, data, data_type, timeout=None, compress=None, user_id=None, socket_file=None, server="localhost", port=4444, buffer_size=4096, raw=False, pool=None, connect_timeout=None, read_timeout=None):
+    """
+    Stores a new element in the cache. With raw=True, data must be the value already
+    encoded as JSON (str or bytes), the server stores it and returns it as it is.
+    """
+    return send_request(add_request(element_id, data, data_type, timeout, compress, user_id, raw), "Unable to add element to cache.", socket_file=socket_file, server=server, port=port, buffer_size=buffer_size, pool=pool, connect_timeout=connect_timeout, read_timeout=read_timeout)
+
+
+def cache_get(element_id=None, data_type=None, user_id=None, reset_timeout=False, timeout=None, socket_file=None, server="localhost", port=4444, buffer_size=4096, pool=None, connect_timeout=None, read_timeout=None):
+    return send_request(get_request(element_id, data_type, user_id, reset_timeout, timeout), "Unable to get element from cache.", socket_file=socket_file, server=server, port=port, buffer_size=buffer_size, pool=pool, connect_timeout=connect_timeout, read_timeout=read_timeout)
+
+
+def cache_iter_type(data_type, user_id=None, reset_timeout=False, timeout=None, socket_file=None, server="localhost", port=4444, buffer_size=4096, pool=None, connect_timeout=None, read_timeout=None):
+    """
+    Yields the elements for the given data_type from a streamed respond (protocol
+    version 2). The connection goes back to the pool once the whole respond is read.
+    """
+    request = get_request(None, data_type, user_id, reset_timeout, timeout)
+    request['stream'] = True
+    if pool is not None:
+        cp = pool.acquire()
+    else:
+        cp = SocketHandler(protocol_version=PROTOCOL_VERSION, connect_timeout=connect_timeout, read_timeout=read_timeout)
         cp.connect(socket_file, server, port)
-    except Exception as ex:
-        return Response({"success": False, "message": "Unable to connect to cache server. Error message: " + str(ex)})
-
+    done = False
     try:
-        # Prepare package
-        data={
-            'target': "remove",
-            'element_id': element_id,
-            'user_id': user_id
-        }
-        response = cp.send_data(data, buffer_size=buffer_size)
-        response = json.loads(response)
-
-        if return_elem:
-            response["result"] = element.result
-
-        cp.close()
-        return Response(response)
-    except Exception as ex:
-        return Response({"success": False, "message": "Unable to remove element from cache. Error message: " + str(ex)})
-
-
-def cache_reset(element_id, timeout=None, user_id=None, socket_file=None, server="localhost", port=4444, buffer_size=4096):
+        for item in cp.send_stream(request, buffer_size=buffer_size):
+            yield item
+        done = True
+    finally:
+        if pool is None:
+            cp.close()
+        else:
+            # Discard the connection if the respond was not completely read
+            pool.release(cp, discard=not done)
+
+
+def cache_remove(element_id, user_id=None, return_elem=False, socket_file=None, server="localhost", port=4444, buffer_size=4096, pool=None, connect_timeout=None, read_timeout=None):
+    return send_request(remove_request(element_id, user_id, return_elem), "Unable to remove element from cache.", socket_file=socket_file, server=server, port=port, buffer_size=buffer_size, pool=pool, connect_timeout=connect_timeout, read_timeout=read_timeout)
+
+
+def cache_reset(element_id, timeout=None, user_id=None, socket_file=None, server="localhost", port=4444, buffer_size=4096, pool=None, connect_timeout=None, read_timeout=None):
+    return send_request(reset_request(element_id, timeout, user_id), "Unable to reset element at cache.", socket_file=socket_file, server=server, port=port, buffer_size=buffer_size, pool=pool, connect_timeout=connect_timeout, read_timeout=read_timeout)
+
+
+def cache_stats(socket_file=None, server="localhost", port=4444, buffer_size=4096, pool=None, connect_timeout=None, read_timeout=None):
+    return send_request({'target': "stats"}, "Unable to get metrics from cache.", socket_file=socket_file, server=server, port=port, buffer_size=buffer_size, pool=pool, connect_timeout=connect_timeout, read_timeout=read_timeout)
+
+
+def cache_batch(operation, items, timeout=None, compress=None, user_id=None, reset_timeout=False, return_elem=False, socket_file=None, server="localhost", port=4444, buffer_size=4096, pool=None, connect_timeout=None, read_timeout=None):
+    """
+    Runs the same operation (add, get, remove or reset) for several items in a single
+    request and returns a Response for each item. Items are element ids, or dicts as
+    the ones for SimpleCache.add_many when adding.
+    """
+    items = list(items)
+    response = send_request(batch_request(operation, items, timeout, compress, user_id, reset_timeout, return_elem), "Unable to run batch at cache.", socket_file=socket_file, server=server, port=port, buffer_size=buffer_size, pool=pool, connect_timeout=connect_timeout, read_timeout=read_timeout)
+    return batch_responses(response, len(items))
+
+
+def batch_responses(response, n_items):
+    if not response.success:
+        return [response for i in range(n_items)]
+    return [Response(result) for result in response.result]
+
+
+def batch_request(operation, items, timeout=None, compress=None, user_id=None, reset_timeout=False, return_elem=False):
+    if operation == "add":
+        items = [dict(item, data=item.get("data").decode("utf-8")) if item.get("raw") and isinstance(item.get("data"), bytes) else item for item in items]
+    return {
+        'target': "batch",
+        'operation': operation,
+        'items': items,
+        'timeout': timeout,
+        'compress': compress,
+        'user_id': user_id,
+        'reset_timeout': reset_timeout,
+        'return': return_elem
+    }
+
+
+def add_request(element_id, data, data_type, timeout=None, compress=None, user_id=None, raw=False):
+    request = {
+        'target': "add",
+        'element_id': element_id,
+        'data': data,
+        'data_type': data_type,
+        'timeout': timeout,
+        'compress': compress,
+        'user_id': user_id
+    }
+    if raw:
+        request['data'] = data.decode("utf-8") if isinstance(data, bytes) else data
+        request['raw'] = True
+    return request
+
+
+def get_request(element_id=None, data_type=None, user_id=None, reset_timeout=False, timeout=None):
+    return {
+        'target': "get",
+        'element_id': element_id,
+        'data_type': data_type,
+        'user_id': user_id,
+        'reset_timeout': reset_timeout,
+        'timeout': timeout
+    }
+
+
+def remove_request(element_id, user_id=None, return_elem=False):
+    return {
+        'target': "remove",
+        'element_id': element_id,
+        'user_id': user_id,
+        'return': return_elem
+    }
+
+
+def reset_request(element_id, timeout=None, user_id=None):
+    return {
+        'target': "reset",
+        'element_id': element_id,
+        'timeout': timeout,
+        'user_id': user_id
+    }
+
+
+def is_idempotent(request):
+    if request.get("target") == "batch":
+        return request.get("operation") in IDEMPOTENT_TARGETS
+    return request.get("target") in IDEMPOTENT_TARGETS
+
+
+def send_request(request, error_message, socket_file=None, server="localhost", port=4444, buffer_size=4096, pool=None, connect_timeout=None, read_timeout=None):
+    """
+    Sends a request using a connection from the pool or a new connection that is
+    closed after the respond.
+    """
     try:
-        cp = SocketHandler()
-        cp.connect(socket_file, server, port)
+        if pool is not None:
+            cp = pool.acquire()
+        else:
+            cp = SocketHandler(connect_timeout=connect_timeout, read_timeout=read_timeout)
+            cp.connect(socket_file, server, port)
     except Exception as ex:
         return Response({"success": False, "message": "Unable to connect to cache server. Error message: " + str(ex)})
 
+    failed = False
     try:
-        # Prepare package
-        data={
-            'target': "reset",
-            'element_id': element_id,
-            'timeout': timeout,
-            'user_id': user_id
-        }
-        # Get data
-        response = cp.send_data(data, buffer_size=buffer_size)
-        cp.close()
-        return Response(json.loads(response))
+        try:
+            response = cp.send_data(request, buffer_size=buffer_size)
+        except (OSError, ConnectionClosedError) as ex:
+            # The pooled connection may have been closed (e.g. by the server after some
+            # time without requests), retry once using a new connection if the request
+            # was not sent or it can be applied twice. Never after a timeout, the server
+            # may still apply the request
+            if pool is None or isinstance(ex, socket.timeout) or not (isinstance(ex, RequestNotSentError) or is_idempotent(request)):
+                raise
+            pool.release(cp, discard=True)
+            cp = None
+            cp = pool.acquire()
+            response = cp.send_data(request, buffer_size=buffer_size)
+        return Response(response)
     except Exception as ex:
-        return Response({"success": False, "message": "Unable to reset element at cache. Error message: " + str(ex)})
+        failed = True
+        return Response({"success": False, "message": error_message + " Error message: " + str(ex)})
+    finally:
+        if pool is None:
+            cp.close()
+        elif cp is not None:
+            pool.release(cp, discard=failed)
 
 
 class SocketHandler:
-    def __init__(self):
+    def __init__(self, protocol_version=1, max_frame_size=MAX_FRAME_SIZE, serializer="json", compress_level=1, compress_min_size=1024, connect_timeout=None, read_timeout=None):
         self.socket = None
+        # Seconds (None to block), reads raise socket.timeout if the server does not answer
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.protocol_version = protocol_version
+        self.max_frame_size = max_frame_size
+        # Encoding of the requests (protocol version 2)
+        self.serializer = serializer
+        self.compress_level = compress_level
+        self.compress_min_size = compress_min_size
+        self.request_ids = itertools.count(1)
 
     def connect(self, socket_file=None, server_ip=None, server_port=None):
+        if self.socket is not None:
+            # Already connected (persistent connection)
+            return
         if socket_file is not None and socket_file != "":
             self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            self.socket.connect(socket_file)
+            address = socket_file
         else:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((server_ip, server_port))
+            address = (server_ip, server_port)
+        try:
+            self.socket.settimeout(self.connect_timeout)
+            self.socket.connect(address)
+            self.socket.settimeout(self.read_timeout)
+        except Exception:
+            self.socket.close()
+            self.socket = None
+            raise
+
+    def is_alive(self):
+        """
+        Checks that the connection was not closed by the server.
+        """
+        if self.socket is None:
+            return False
+        try:
+            # Sockets with a timeout wait for data before reading, even with MSG_DONTWAIT
+            self.socket.setblocking(False)
+            self.socket.recv(1, socket.MSG_PEEK)
+            # Closed by the server (b'') or unexpected data waiting in an idle connection
+            return False
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+        finally:
+            self.socket.settimeout(self.read_timeout)
 
     def close(self):
-        self.socket.shutdown(socket.SHUT_WR)
+        if self.socket is None:
+            return
+        try:
+            self.socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
         self.socket.close()
         self.socket = None
 
+    def send_frames(self, frames):
+        try:
+            send_buffers(self.socket, frames)
+        except socket.timeout:
+            raise
+        except OSError as ex:
+            # The last frame was not fully written, the server did not read it
+            raise RequestNotSentError(str(ex))
+
     def send_data(self, data, buffer_size=4096):
-        data = zlib.compress(json.dumps(data))
-        # use struct to make sure we have a consistent endianness on the length
-        length = pack('>Q', len(data))
-        # sendall to make sure it blocks if there's back-pressure on the socket
-        self.socket.sendall(length)
-        self.socket.sendall(data)
+        if self.protocol_version > 1:
+            return self.send_requests([data], buffer_size=buffer_size)[0]
+        (data, flags) = self.encode_request(data)
+        # blocks if there's back-pressure on the socket
+        self.send_frames([pack_header(len(data)), data])
         # Receive respond
-        bs = self.socket.recv(8)
-        (data_length,) = unpack('>Q', bs)
-        data = b''
-        while len(data) < data_length:
-            # doing it in batches is generally better than trying
-            # to do it all in one go, so I believe.
-            to_read = data_length - len(data)
-            data += self.socket.recv(buffer_size if to_read > buffer_size else to_read)
-        return zlib.decompress(data)
+        (version, request_id, flags, data_length, header_size) = recv_header(self.socket, self.max_frame_size)
+        return json.loads(recv_decompress(self.socket, data_length))
 
     def get_data(self, data, buffer_size=4096):
-        data = zlib.compress(json.dumps(data))
-        # use struct to make sure we have a consistent endianness on the length
-        length = pack('>Q', len(data))
-        # sendall to make sure it blocks if there's back-pressure on the socket
-        self.socket.sendall(length)
-        self.socket.sendall(data)
-        # Receive respond
-        bs = self.socket.recv(8)
-        (data_length,) = unpack('>Q', bs)
-        data = b''
-        while len(data) < data_length:
-            # doing it in batches is generally better than trying
-            # to do it all in one go, so I believe.
-            to_read = data_length - len(data)
-            data += self.socket.recv(buffer_size if to_read > buffer_size else to_read)
-        return zlib.decompress(data)
+        return self.send_data(data, buffer_size=buffer_size)
+
+    def send_requests(self, requests, buffer_size=4096):
+        """
+        Sends several requests (protocol version 2) without waiting for the responds and
+        returns the (decoded) responds in the same order as the requests.
+        """
+        request_ids = []
+        frames = []
+        for request in requests:
+            request_id = next(self.request_ids) & 0xFFFFFFFF
+            (data, flags) = self.encode_request(request)
+            frames.append(pack_header(len(data), request_id, flags))
+            frames.append(data)
+            request_ids.append(request_id)
+        self.send_frames(frames)
+        # Receive the responds, maybe in a different order
+        responds = {}
+        while len(responds) < len(request_ids):
+            (version, request_id, flags, data_length, header_size) = recv_header(self.socket, self.max_frame_size)
+            if version == 1:
+                raise Exception("Invalid respond from cache server")
+            responds[request_id] = loads_payload(recv_payload(self.socket, data_length, flags), flags, json.loads)
+            if flags & FLAG_CLOSE:
+                # The server will not accept more requests through this connection
+                self.close()
+                break
+        return [responds.get(request_id) for request_id in request_ids]
+
+    def send_stream(self, request, buffer_size=4096):
+        """
+        Sends a request for a streamed respond (protocol version 2) and yields the
+        elements as their frames arrive.
+        """
+        request_id = next(self.request_ids) & 0xFFFFFFFF
+        # Without FLAG_ADAPTIVE, the frames of the respond are always JSON compressed with zlib
+        (data, flags) = self.encode_request(request, adaptive=False)
+        send_buffers(self.socket, [pack_header(len(data), request_id, flags), data])
+        # All the frames are parts of a single zlib stream
+        decompressor = zlib.decompressobj()
+        pending = b''
+        more = True
+        while more:
+            (version, respond_id, flags, data_length, header_size) = recv_header(self.socket, self.max_frame_size)
+            if version == 1 or respond_id != request_id:
+                raise Exception("Invalid respond from cache server")
+            lines = (pending + recv_decompress(self.socket, data_length, decompressor=decompressor)).split(b"\n")
+            pending = lines.pop()
+            more = flags & FLAG_MORE
+            if flags & FLAG_CLOSE:
+                self.close()
+            if not more and pending:
+                lines.append(pending)
+            for line in lines:
+                respond = json.loads(line.decode("utf-8"))
+                if "id" in respond:
+                    yield respond
+                elif "result" in respond:
+                    # Not streamed by the server, a single respond with all the elements
+                    for item in respond.get("result"):
+                        yield item
+                elif "message" in respond:
+                    raise Exception(respond.get("message"))
+
+    def encode_request(self, request, adaptive=True):
+        """
+        Serializes and compresses a request, returns a tuple (payload, flags).
+        """
+        if self.protocol_version == 1:
+            data = zlib.compress(json.dumps(request).encode("utf-8"))
+            flags = 0
+        elif adaptive:
+            (data, flags) = dumps_payload(request, self.serializer, json.dumps)
+            (data, flags) = compress_payload(data, flags | FLAG_ADAPTIVE, self.compress_level, self.compress_min_size)
+        else:
+            (data, flags) = compress_payload(json.dumps(request).encode("utf-8"), 0, self.compress_level, self.compress_min_size)
+        if self.max_frame_size and len(data) > self.max_frame_size:
+            raise Exception("Request of " + str(len(data)) + " bytes exceeds the limit (" + str(self.max_frame_size) + " bytes)")
+        return data, flags
+
+    def recv(self, data_length, buffer_size=4096):
+        # The data is received into a buffer of data_length bytes, buffer_size is
+        # no longer used
+        return recv_exactly(self.socket, data_length)
 
 
 class Response(object):
@@ -0,0 +1,359 @@
+"""
+PySiCa, a simple Python Cache system
+
+Framing of the socket protocol, shared by the server (server_sockets.py) and the client
+(pysica_api_sockets.py).
+
+Version 2 frames: magic, version, flags, request id and payload length. Connections
+using version 2 are kept open and can send several requests without waiting for the
+responds, which carry the same request id. Version 1 frames only have the length and
+the server closes the connection after the respond.
+
+Payloads are received into a preallocated buffer (recv_into) instead of joining the
+chunks, and headers and payloads are sent together (sendmsg) without joining them.
+
+The encoding of each version 2 payload is described by the flags of its frame: JSON or
+marshal (FLAG_MARSHAL), compressed with zlib or not (FLAG_PLAIN). Frames without these
+flags (and version 1 frames) are JSON compressed with zlib. Requests with FLAG_ADAPTIVE
+tell the server the client reads these flags, so small responds are not compressed, and
+responds use the same serializer as their request.
+"""
+
+import marshal
+import socket
+import zlib
+from struct import unpack_from, pack, calcsize
+
+PROTOCOL_MAGIC = b'PS'
+PROTOCOL_VERSION = 2
+HEADER_FORMAT = '>2sBBIQ'
+HEADER_SIZE = calcsize(HEADER_FORMAT)
+LENGTH_FORMAT = '>Q'
+LENGTH_SIZE = calcsize(LENGTH_FORMAT)
+FLAG_CLOSE = 0x01
+# Streamed responds are sent in several frames with the same request id, all of them
+# but the last one with FLAG_MORE
+FLAG_MORE = 0x02
+# Encoding of the payload
+FLAG_MARSHAL = 0x04
+FLAG_PLAIN = 0x08
+# Requests from clients that accept responds in any encoding
+FLAG_ADAPTIVE = 0x10
+SERIALIZERS = ("json", "marshal")
+# Frames over this size are rejected (0 for no limit)
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+# Buffers per sendmsg call (IOV_MAX is 1024 on Linux)
+MAX_BUFFERS = 512
+# Smaller frames are joined or received in one piece, cheaper than the buffers
+SMALL_FRAME_SIZE = 65536
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+
+class ConnectionClosedError(Exception):
+    pass
+
+
+class FrameTooLargeError(Exception):
+    def __init__(self, version, request_id, data_length, max_size):
+        super(FrameTooLargeError, self).__init__("Frame of " + str(data_length) + " bytes exceeds the limit (" + str(max_size) + " bytes)")
+        self.version = version
+        self.request_id = request_id
+
+
+def pack_header(data_length, request_id=None, flags=0):
+    """
+    Returns the header of a version 2 frame, or a version 1 one if request_id is None.
+    """
+    if request_id is None:
+        # use struct to make sure we have a consistent endianness on the length
+        return pack(LENGTH_FORMAT, data_length)
+    return pack(HEADER_FORMAT, PROTOCOL_MAGIC, PROTOCOL_VERSION, flags, request_id, data_length)
+
+
+def parse_header(data, max_size=0):
+    """
+    Parses the header of a frame. Version 1 frames start with the length of the payload
+    (8 bytes), version 2 frames start with PROTOCOL_MAGIC followed by the version, flags,
+    request id and length. Returns a tuple (version, request_id, flags, length, header size)
+    or None if there are not enough bytes.
+    """
+    if len(data) < LENGTH_SIZE:
+        return None
+    if bytes(data[:2]) != PROTOCOL_MAGIC:
+        (data_length,) = unpack_from(LENGTH_FORMAT, data)
+        header = (1, None, 0, data_length, LENGTH_SIZE)
+    elif len(data) < HEADER_SIZE:
+        return None
+    else:
+        (magic, version, flags, request_id, data_length) = unpack_from(HEADER_FORMAT, data)
+        if version != PROTOCOL_VERSION:
+            raise Exception("Unsupported protocol version " + str(version))
+        header = (version, request_id, flags, data_length, HEADER_SIZE)
+    if max_size and header[3] > max_size:
+        raise FrameTooLargeError(header[0], header[1], header[3], max_size)
+    return header
+
+
+def dumps_payload(data, serializer="json", dumps=None):
+    """
+    Serializes a request or respond, returns a tuple (bytes, flags).
+    """
+    if serializer == "marshal":
+        return marshal.dumps(data), FLAG_MARSHAL
+    if serializer != "json":
+        raise Exception("Unknown serializer " + str(serializer) + ". Valid options are " + ", ".join(SERIALIZERS))
+    return dumps(data).encode("utf-8"), 0
+
+
+def compress_payload(data, flags=0, compress_level=6, compress_min_size=0):
+    """
+    Compresses a serialized payload with zlib, unless compress_level is 0 or the payload
+    is shorter than compress_min_size. Returns a tuple (payload, flags).
+    """
+    if compress_level == 0 or len(data) < compress_min_size:
+        return data, flags | FLAG_PLAIN
+    return zlib.compress(data, compress_level), flags
+
+
+def loads_payload(data, flags, loads):
+    """
+    Deserializes a payload (already decompressed) using the serializer in its flags.
+    """
+    if flags & FLAG_MARSHAL:
+        return marshal.loads(data)
+    return loads(data)
+
+
+def decode_payload(payload, flags, loads):
+    if not flags & FLAG_PLAIN:
+        payload = zlib.decompress(payload)
+    return loads_payload(payload, flags, loads)
+
+
+def recv_exactly(connection, data_length):
+    """
+    Receives data_length bytes from a blocking socket into a preallocated buffer.
+    """
+    if data_length <= SMALL_FRAME_SIZE:
+        data = connection.recv(data_length)
+        if len(data) == data_length:
+            return data
+        if len(data) == 0:
+            raise ConnectionClosedError("Connection closed by cache server")
+        received = len(data)
+        data = bytearray(data) + bytearray(data_length - received)
+    else:
+        data = bytearray(data_length)
+        received = 0
+    view = memoryview(data)
+    while received < data_length:
+        n = connection.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionClosedError("Connection closed by cache server")
+        received += n
+    return data
+
+
+def recv_header(connection, max_size=0):
+    """
+    Receives the header of the next frame from a blocking socket, returns a tuple
+    (version, request_id, flags, length, header size).
+    """
+    data = recv_exactly(connection, LENGTH_SIZE)
+    if data[:2] == PROTOCOL_MAGIC:
+        data = data + recv_exactly(connection, HEADER_SIZE - LENGTH_SIZE)
+    return parse_header(data, max_size)
+
+
+def recv_decompress(connection, data_length, chunk_size=262144, decompressor=None):
+    """
+    Receives a zlib compressed payload from a blocking socket, decompressing each chunk
+    as it arrives so the compressed payload is never kept in memory. Streamed responds
+    pass their decompressor, shared by all their frames.
+    """
+    if decompressor is None:
+        if data_length <= SMALL_FRAME_SIZE:
+            return zlib.decompress(recv_exactly(connection, data_length))
+        decompressor = zlib.decompressobj()
+        last = True
+    else:
+        last = False
+    buffer = bytearray(min(data_length, chunk_size))
+    view = memoryview(buffer)
+    parts = []
+    received = 0
+    while received < data_length:
+        n = connection.recv_into(view, min(data_length - received, len(buffer)))
+        if n == 0:
+            raise ConnectionClosedError("Connection closed by cache server")
+        received += n
+        parts.append(decompressor.decompress(view[:n]))
+    if last:
+        parts.append(decompressor.flush())
+    return b''.join(parts)
+
+
+def recv_payload(connection, data_length, flags=0):
+    """
+    Receives a payload from a blocking socket, decompressed unless its frame has FLAG_PLAIN.
+    """
+    if flags & FLAG_PLAIN:
+        return recv_exactly(connection, data_length)
+    return recv_decompress(connection, data_length)
+
+
+def send_buffers(connection, buffers):
+    """
+    Sends a list of buffers (e.g. headers and payloads) through a blocking socket using
+    scatter-gather I/O, so they are not joined before sending.
+    """
+    if not HAS_SENDMSG or sum(len(data) for data in buffers) <= SMALL_FRAME_SIZE:
+        connection.sendall(b''.join(buffers))
+        return
+    buffers = [memoryview(data) for data in buffers if len(data) > 0]
+    while len(buffers) > 0:
+        sent = connection.sendmsg(buffers[:MAX_BUFFERS])
+        # Drop what was sent, the first buffer may have been sent partially
+        while sent > 0:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
+
+def stream_frames(chunks, request_id, flags=0):
+    """
+    Yields the frames (lists of buffers) of a streamed respond: the chunks compressed by
+    a single zlib stream that is flushed at the end of each frame, so the client can
+    decompress them as they arrive. The last frame (with the given flags) is the only
+    one without FLAG_MORE.
+    """
+    compressor = zlib.compressobj()
+    chunks = iter(chunks)
+    chunk = next(chunks)
+    for next_chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield [pack_header(len(data), request_id, FLAG_MORE), data]
+        chunk = next_chunk
+    data = compressor.compress(chunk) + compressor.flush()
+    yield [pack_header(len(data), request_id, flags), data]
+
+
+class SendBuffer(object):
+    """
+    Queue of buffers waiting to be sent through a non-blocking socket. Sent bytes are
+    skipped using an offset instead of moving the rest of the data.
+    """
+
+    def __init__(self):
+        self.buffers = []
+        self.offset = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        if len(data) > 0:
+            self.buffers.append(data)
+            self.size += len(data)
+
+    def extend(self, buffers):
+        for data in buffers:
+            self.append(data)
+
+    def send(self, connection):
+        """
+        Sends as much as the socket accepts, returns the number of bytes sent.
+        """
+        if self.size == 0:
+            return 0
+        buffers = self.buffers[:MAX_BUFFERS]
+        if self.offset > 0:
+            buffers[0] = memoryview(buffers[0])[self.offset:]
+        if HAS_SENDMSG:
+            sent = connection.sendmsg(buffers)
+        else:
+            sent = connection.send(buffers[0])
+        self.size -= sent
+        offset = self.offset + sent
+        n_sent = 0
+        while n_sent < len(self.buffers) and offset >= len(self.buffers[n_sent]):
+            offset -= len(self.buffers[n_sent])
+            n_sent += 1
+        del self.buffers[:n_sent]
+        self.offset = offset
+        return sent
+
+
+class FrameReader(object):
+    """
+    Reads frames from a non-blocking socket. Small frames are received (several at
+    once) into a preallocated buffer, larger ones directly into a buffer of the size
+    of their payload.
+    """
+
+    def __init__(self, buffer_size=65536, max_size=0):
+        self.buffer = bytearray(max(buffer_size, HEADER_SIZE))
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.max_size = max_size
+        # Header and buffer of the frame being received directly
+        self.header = None
+        self.payload = None
+        self.received = 0
+
+    def read(self, connection):
+        """
+        Receives the available data, returns the number of bytes read (0 if the client
+        closed its side).
+        """
+        if self.payload is not None:
+            n = connection.recv_into(memoryview(self.payload)[self.received:])
+            self.received += n
+            return n
+        if self.end == len(self.buffer):
+            # Move the beginning of the next frame to the start of the buffer
+            remaining = self.end - self.start
+            self.buffer[:remaining] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = remaining
+        n = connection.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def next_frame(self):
+        """
+        Extracts the next complete frame, returns a tuple (version, request_id, flags,
+        payload) or None if there is no complete frame yet.
+        """
+        if self.payload is not None:
+            if self.received < len(self.payload):
+                return None
+            (version, request_id, flags) = self.header
+            payload = self.payload
+            self.header = None
+            self.payload = None
+            return version, request_id, flags, payload
+        header = parse_header(self.view[self.start:self.end], self.max_size)
+        if header is None:
+            return None
+        (version, request_id, flags, data_length, header_size) = header
+        start = self.start + header_size
+        available = self.end - start
+        if available >= data_length:
+            payload = bytes(self.view[start:start + data_length])
+            self.start = start + data_length
+            if self.start == self.end:
+                self.start = self.end = 0
+            return version, request_id, flags, payload
+        # Not received yet, the rest of the payload goes straight to its own buffer
+        self.header = (version, request_id, flags)
+        self.payload = bytearray(data_length)
+        self.payload[:available] = self.view[start:self.end]
+        self.received = available
+        self.start = self.end = 0
+        return None
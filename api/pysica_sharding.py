@@ -0,0 +1,78 @@
+"""
+PySiCa, a simple Python Cache system
+
+Client-side sharding, shared by the sockets (pysica_api_sockets.py) and HTTP
+(pysica_api_http.py) clients: each key is sent to one of the servers chosen with
+consistent hashing, so all the clients agree on the server of a key and adding or
+removing a server only moves the keys of that server.
+"""
+
+import bisect
+import hashlib
+
+
+class HashRing:
+    """
+    Consistent hashing ring. Each node is placed at virtual_nodes * weight points of
+    the ring and a key belongs to the first node found from its hash, so adding or
+    removing a server only moves the keys of that server.
+    """
+
+    def __init__(self, nodes, virtual_nodes=160):
+        points = []
+        for (node, name, weight) in nodes:
+            for i in range(max(1, int(virtual_nodes * weight))):
+                points.append((hash_key(name + "#" + str(i)), node))
+        points.sort(key=lambda point: point[0])
+        self.hashes = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+
+    def get_node(self, key):
+        index = bisect.bisect(self.hashes, hash_key(str(key)))
+        return self.nodes[index % len(self.nodes)]
+
+
+def hash_key(key):
+    # Python's hash() changes between processes, all the clients must agree
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+def parse_endpoint(endpoint, port=4444):
+    """
+    Reads a server given as a dict (server, port, socket_file and weight), a tuple
+    (server, port[, weight]) or a str "server:port" (or the path to a socket file,
+    only for the sockets client).
+    """
+    if isinstance(endpoint, dict):
+        result = {"server": endpoint.get("server", "localhost"), "port": endpoint.get("port", port), "socket_file": endpoint.get("socket_file"), "weight": endpoint.get("weight", 1)}
+    elif isinstance(endpoint, (tuple, list)):
+        result = {"server": endpoint[0], "port": endpoint[1], "socket_file": None, "weight": endpoint[2] if len(endpoint) > 2 else 1}
+    elif endpoint.startswith("/"):
+        result = {"server": None, "port": None, "socket_file": endpoint, "weight": 1}
+    else:
+        (server, _, server_port) = endpoint.rpartition(":")
+        if server and server_port.isdigit():
+            result = {"server": server, "port": int(server_port), "socket_file": None, "weight": 1}
+        else:
+            result = {"server": endpoint, "port": port, "socket_file": None, "weight": 1}
+    result["name"] = result.get("socket_file") or (str(result.get("server")) + ":" + str(result.get("port")))
+    return result
+
+
+def gather_responses(responses):
+    """
+    Joins the responds of all the shards for a query by data_type, returns the respond
+    as a dict (the clients wrap it in their Response).
+    """
+    result = []
+    messages = []
+    for response in responses:
+        result.extend(getattr(response, "result", None) or [])
+        if hasattr(response, "message"):
+            messages.append(response.message)
+    respond = {"success": len(result) > 0}
+    if len(result) > 0:
+        respond["result"] = result
+    if len(messages) > 0:
+        respond["message"] = " ".join(messages)
+    return respond
@@ -0,0 +1,77 @@
+"""
+PySiCa, a simple Python Cache system
+
+Latency of the API clients reusing connections (keep-alive session for HTTP, connection
+pool for sockets) compared with opening a new connection per call. Needs a running server.
+
+Usage:
+    python benchmark/bench_clients.py http --server localhost --port 4444
+    python benchmark/bench_clients.py sockets --server localhost --port 4444 [--socket-file /tmp/pysica.sock]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "api"))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def measure(function, n):
+    latencies = []
+    for i in range(n):
+        start = time.perf_counter()
+        function(i)
+        latencies.append(time.perf_counter() - start)
+    return {
+        "calls": n,
+        "mean_us": 1e6 * sum(latencies) / n,
+        "p50_us": 1e6 * percentile(latencies, 0.50),
+        "p99_us": 1e6 * percentile(latencies, 0.99)
+    }
+
+
+def run_http(server, port, n):
+    import pysica_api_http as api
+    cache = api.SimpleCache(server=server, port=port)
+    cache.add("bench", {"value": 1})
+    return {
+        "per_call": measure(lambda i: api.cache_get("bench", server=server, port=port), n),
+        "session": measure(lambda i: cache.get("bench"), n)
+    }
+
+
+def run_sockets(server, port, socket_file, n):
+    import pysica_api_sockets as api
+    cache = api.SimpleCache(socket_file=socket_file, server=server, port=port)
+    pooled = api.SimpleCache(socket_file=socket_file, server=server, port=port, persistent=True)
+    cache.add("bench", {"value": 1})
+    results = {
+        "per_call": measure(lambda i: cache.get("bench"), n),
+        "pool": measure(lambda i: pooled.get("bench"), n)
+    }
+    pooled.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Latency of the PySiCa clients with and without connection reuse")
+    parser.add_argument("client", choices=["http", "sockets"])
+    parser.add_argument("--server", default="localhost")
+    parser.add_argument("--port", type=int, default=4444)
+    parser.add_argument("--socket-file", default=None)
+    parser.add_argument("-n", type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.client == "http":
+        results = run_http(args.server, args.port, args.n)
+    else:
+        results = run_sockets(args.server, args.port, args.socket_file, args.n)
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,68 @@
+"""
+PySiCa, a simple Python Cache system
+
+Benchmark for the codecs used to store the values: bytes saved and CPU cost per
+operation for each codec, using the test payloads (test1.json and test2.json).
+
+Usage: python benchmark/bench_codecs.py [--repeat 200] [--level 1] [--min-size 1024]
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from pysica import PySiCa
+from pysica_codecs import CODECS
+
+
+def load_payloads():
+    payloads = {}
+    for name in ["test1.json", "test2.json"]:
+        payloads[name] = json.load(open(os.path.join(ROOT, "test", "sockets", name)))
+    return payloads
+
+
+def run(repeat=200, level=1, min_size=1024):
+    logger = logging.getLogger("bench_codecs")
+    logger.setLevel(logging.WARNING)
+    results = []
+    for payload_name, payload in load_payloads().items():
+        for codec in sorted(CODECS):
+            cache = PySiCa(logger=logger, max_elems=0, clean_interval=3600, codec=codec, compress_level=level, compress_min_size=min_size)
+            for i in range(repeat):
+                cache.add(str(i), payload, "bench")
+                cache.get_elem(str(i))
+            stats = cache.get_codec_stats()
+            used = [name for name in stats if stats.get(name).get("count") > 0]
+            for name in used:
+                result = stats.get(name)
+                result.update({"payload": payload_name, "codec": codec, "used_codec": name, "level": level})
+                results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bytes saved and CPU cost for the PySiCa codecs")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--level", type=int, default=1)
+    parser.add_argument("--min-size", type=int, default=1024)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    results = run(repeat=args.repeat, level=args.level, min_size=args.min_size)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("%-12s %-8s %14s %14s %8s %12s %12s" % ("payload", "codec", "bytes/op", "saved/op", "ratio", "encode us", "decode us"))
+        for result in results:
+            count = result.get("count")
+            print("%-12s %-8s %14d %14d %8.2f %12.1f %12.1f" % (
+                result.get("payload"), result.get("used_codec"),
+                result.get("bytes_out") // count, result.get("bytes_saved") // count,
+                float(result.get("bytes_in")) / max(result.get("bytes_out"), 1),
+                result.get("encode_us"), result.get("decode_us")))
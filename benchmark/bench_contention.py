@@ -0,0 +1,102 @@
+"""
+PySiCa, a simple Python Cache system
+
+Throughput of the PySiCa core when several threads use it at the same time, for a
+single lock (--stripes 1) compared with lock striping. Each thread runs a mix of
+gets and adds (plus the periodic cleaning) for its own user or the general cache.
+
+Usage: python benchmark/bench_contention.py [--threads 1,2,4,8] [--stripes 1,16] [--ops 2000] [--payload test1.json]
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from pysica import PySiCa
+
+
+def load_payload(name):
+    if name == "small":
+        return {"value": 1}
+    return json.load(open(os.path.join(ROOT, "test", "sockets", name)))
+
+
+def worker(cache, n_thread, ops, keys, write_ratio, payload, general, barrier):
+    user_id = None if general else "user" + str(n_thread)
+    rand = random.Random(n_thread)
+    barrier.wait()
+    for i in range(ops):
+        key = str(rand.randrange(keys))
+        if rand.random() < write_ratio:
+            cache.add(key, payload, "bench", user_id=user_id)
+        else:
+            cache.get_elem(key, user_id=user_id)
+
+
+def cleaner(cache, stop):
+    while not stop.is_set():
+        cache.clean_cache()
+        time.sleep(0.01)
+
+
+def run(n_threads, stripes, ops=2000, keys=100, write_ratio=0.2, payload=None, general=False):
+    logger = logging.getLogger("bench_contention")
+    logger.setLevel(logging.WARNING)
+    cache = PySiCa(logger=logger, max_elems=keys * n_threads, clean_interval=3600, stripes=stripes)
+    for n_thread in range(n_threads):
+        for key in range(keys):
+            cache.add(str(key), payload, "bench", user_id=None if general else "user" + str(n_thread))
+    barrier = threading.Barrier(n_threads + 1)
+    threads = [threading.Thread(target=worker, args=(cache, n_thread, ops, keys, write_ratio, payload, general, barrier)) for n_thread in range(n_threads)]
+    stop = threading.Event()
+    clean_thread = threading.Thread(target=cleaner, args=(cache, stop))
+    for thread in threads:
+        thread.start()
+    clean_thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    clean_thread.join()
+    return {
+        "threads": n_threads,
+        "stripes": stripes,
+        "ops": ops * n_threads,
+        "seconds": elapsed,
+        "ops_per_second": ops * n_threads / elapsed
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Throughput of the PySiCa core with several threads")
+    parser.add_argument("--threads", default="1,2,4,8", help="Comma separated numbers of threads")
+    parser.add_argument("--stripes", default="1,16", help="Comma separated numbers of stripes")
+    parser.add_argument("--ops", type=int, default=2000, help="Operations per thread")
+    parser.add_argument("--keys", type=int, default=100, help="Keys per thread")
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument("--payload", default="test1.json", help="small, test1.json or test2.json")
+    parser.add_argument("--general", action="store_true", help="Use the general cache instead of a cache per thread")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    payload = load_payload(args.payload)
+    results = []
+    for stripes in [int(value) for value in args.stripes.split(",")]:
+        for n_threads in [int(value) for value in args.threads.split(",")]:
+            results.append(run(n_threads, stripes, ops=args.ops, keys=args.keys, write_ratio=args.write_ratio, payload=payload, general=args.general))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("%8s %8s %12s %10s %14s" % ("stripes", "threads", "ops", "seconds", "ops/s"))
+        for result in results:
+            print("%8d %8d %12d %10.2f %14.0f" % (result.get("stripes"), result.get("threads"), result.get("ops"), result.get("seconds"), result.get("ops_per_second")))
@@ -0,0 +1,197 @@
+"""
+PySiCa, a simple Python Cache system
+
+Micro-benchmarks of the PySiCa class for caches with 10k, 100k and 1M elements: add
+(with and without compression), get_elem by id and by type, remove, reset_timeout,
+clean_cache (idle and removing expired elements) and get_cache_size. Each benchmark
+runs --repeat operations per round and the best round is kept (as timeit does).
+
+Results can be saved as a baseline and later runs compared with it: benchmarks slower
+than the baseline by more than --threshold are flagged and the exit status is 1, so
+changes to expiry, eviction or the storage layout can be measured before a release.
+
+Usage:
+    python benchmark/bench_core.py [--sizes 10000,100000,1000000] [--repeat 1000] [--rounds 5] --save baseline.json
+    python benchmark/bench_core.py --compare baseline.json [--threshold 0.1]
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from pysica import PySiCa
+
+BENCHMARKS = ["add", "add_compress", "get_elem_id", "get_elem_type", "remove", "reset_timeout", "clean_cache_idle", "clean_cache", "get_cache_size"]
+# Elements of each data_type, the result of a get by type
+TYPE_SIZE = 10
+# Value added by the add benchmarks (about 1KB as JSON)
+PAYLOAD = {"name": "element", "values": list(range(100)), "text": "PySiCa, a simple Python Cache system. " * 10}
+
+
+def fill_cache(size):
+    logger = logging.getLogger("bench_core")
+    logger.setLevel(logging.WARNING)
+    cache = PySiCa(logger=logger, max_elems=0, clean_interval=3600)
+    for i in range(size):
+        cache.add(str(i), {"id": i}, "type-" + str(i // TYPE_SIZE), compress=False)
+    return cache
+
+
+def run_benchmark(cache, benchmark, size, repeat, rand):
+    """
+    Returns the seconds per operation of a round (per cleaning for clean_cache, which
+    removes repeat expired elements). The state of the cache (number of elements) is
+    restored after each round, outside the measured time.
+    """
+    keys = [str(rand.randrange(size)) for i in range(repeat)]
+    if benchmark in ["add", "add_compress"]:
+        new_keys = ["new-" + str(i) for i in range(repeat)]
+        compress = benchmark == "add_compress"
+        start = time.perf_counter()
+        for key in new_keys:
+            cache.add(key, PAYLOAD, "bench", compress=compress)
+        elapsed = time.perf_counter() - start
+        for key in new_keys:
+            cache.remove(key)
+        return elapsed / repeat
+    if benchmark == "get_elem_id":
+        start = time.perf_counter()
+        for key in keys:
+            cache.get_elem(key)
+        return (time.perf_counter() - start) / repeat
+    if benchmark == "get_elem_type":
+        data_types = ["type-" + str(int(key) // TYPE_SIZE) for key in keys]
+        start = time.perf_counter()
+        for data_type in data_types:
+            cache.get_elem(data_type=data_type)
+        return (time.perf_counter() - start) / repeat
+    if benchmark == "remove":
+        keys = list(set(keys))
+        start = time.perf_counter()
+        for key in keys:
+            cache.remove(key)
+        elapsed = time.perf_counter() - start
+        for key in keys:
+            cache.add(key, {"id": int(key)}, "type-" + str(int(key) // TYPE_SIZE), compress=False)
+        return elapsed / len(keys)
+    if benchmark == "reset_timeout":
+        start = time.perf_counter()
+        for key in keys:
+            cache.reset_timeout(key)
+        return (time.perf_counter() - start) / repeat
+    if benchmark == "clean_cache_idle":
+        # Nothing to remove, the common case
+        start = time.perf_counter()
+        for i in range(repeat):
+            cache.clean_cache()
+        return (time.perf_counter() - start) / repeat
+    if benchmark == "clean_cache":
+        # A cleaning removing repeat expired elements
+        for i in range(repeat):
+            cache.add("expired-" + str(i), {"id": i}, "expired", timeout=-1, compress=False)
+        start = time.perf_counter()
+        cache.clean_cache()
+        return time.perf_counter() - start
+    if benchmark == "get_cache_size":
+        start = time.perf_counter()
+        for i in range(repeat):
+            cache.get_cache_size()
+        return (time.perf_counter() - start) / repeat
+    raise Exception("Unknown benchmark " + benchmark)
+
+
+def run(sizes, benchmarks=BENCHMARKS, repeat=1000, rounds=5, seed=0):
+    results = []
+    for size in sizes:
+        cache = fill_cache(size)
+        rand = random.Random(seed)
+        for benchmark in benchmarks:
+            elapsed = min(run_benchmark(cache, benchmark, size, repeat, rand) for i in range(rounds))
+            results.append({"benchmark": benchmark, "size": size, "us": elapsed * 1e6})
+    return results
+
+
+def compare(results, baseline, threshold=0.1):
+    """
+    Adds to each result the time of the baseline and the change, returns the results
+    slower than the baseline by more than threshold (0.1 for 10%).
+    """
+    previous = {(result.get("benchmark"), result.get("size")): result.get("us") for result in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        baseline_us = previous.get((result.get("benchmark"), result.get("size")))
+        result["baseline_us"] = baseline_us
+        result["change"] = result.get("us") / baseline_us - 1 if baseline_us else None
+        result["regression"] = result.get("change") is not None and result.get("change") > threshold
+        if result.get("regression"):
+            regressions.append(result)
+    return regressions
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except Exception:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the PySiCa core operations")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="Comma separated list of numbers of elements in the cache")
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS), help="Comma separated list of " + ", ".join(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=1000, help="Operations per round")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", default=None, help="Write the results to a baseline file")
+    parser.add_argument("--compare", default=None, help="Compare the results with a baseline file")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Slowdown flagged as a regression (0.1 for 10%%)")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    for benchmark in args.benchmarks.split(","):
+        if benchmark not in BENCHMARKS:
+            parser.error("Unknown benchmark " + benchmark)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = run([int(size) for size in args.sizes.split(",")], args.benchmarks.split(","), args.repeat, args.rounds, args.seed)
+    regressions = compare(results, baseline, args.threshold) if baseline is not None else []
+    report = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "options": {"repeat": args.repeat, "rounds": args.rounds, "seed": args.seed},
+        "results": results
+    }
+    if args.save is not None:
+        with open(args.save, "w") as output:
+            json.dump(report, output, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    elif baseline is not None:
+        print("%18s %10s %14s %14s %10s" % ("benchmark", "size", "baseline us", "us", "change"))
+        for result in results:
+            print("%18s %10d %14s %14.2f %10s%s" % (
+                result.get("benchmark"), result.get("size"),
+                "%.2f" % result.get("baseline_us") if result.get("baseline_us") else "-", result.get("us"),
+                "%+.1f%%" % (result.get("change") * 100) if result.get("change") is not None else "-",
+                "  SLOWER" if result.get("regression") else ""))
+        if baseline.get("options") != report.get("options"):
+            print("Warning: options differ from the baseline " + json.dumps(baseline.get("options")) + ", results may not be comparable")
+        print(str(len(regressions)) + " benchmarks slower than the baseline (commit " + str(baseline.get("commit")) + ") by more than " + str(args.threshold * 100) + "%")
+    else:
+        print("%18s %10s %14s" % ("benchmark", "size", "us"))
+        for result in results:
+            print("%18s %10d %14.2f" % (result.get("benchmark"), result.get("size"), result.get("us")))
+    if regressions:
+        sys.exit(1)
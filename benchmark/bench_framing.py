@@ -0,0 +1,154 @@
+"""
+PySiCa, a simple Python Cache system
+
+Throughput of the socket framing for frames from 1 KB to 100 MB: the old receive loop
+(joining recv chunks of buffer_size) compared with recv_into a preallocated buffer,
+incremental decompression and the non-blocking FrameReader used by the server.
+
+Usage: python benchmark/bench_framing.py [--sizes 1K,64K,1M,16M,100M] [--methods legacy,recv_into,incremental,reader] [--tcp]
+"""
+
+import argparse
+import json
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+import zlib
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "api"))
+
+from pysica_framing import pack_header, parse_header, recv_header, recv_exactly, recv_decompress, send_buffers, FrameReader, LENGTH_SIZE, HEADER_SIZE, PROTOCOL_MAGIC
+
+UNITS = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+
+
+def parse_size(value):
+    if value[-1].upper() in UNITS:
+        return int(value[:-1]) * UNITS.get(value[-1].upper())
+    return int(value)
+
+
+def make_payload(size, kind):
+    if kind == "json":
+        data = json.dumps(json.load(open(os.path.join(ROOT, "test", "sockets", "test2.json")))).encode("utf-8")
+        data = (data * (size // len(data) + 1))[:size]
+    else:
+        data = os.urandom(size)
+    return zlib.compress(data, 1)
+
+
+def socket_pair(tcp):
+    if not tcp:
+        return socket.socketpair()
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    client = socket.create_connection(server.getsockname())
+    (connection, addr) = server.accept()
+    server.close()
+    return connection, client
+
+
+def sender(connection, method, payload, frames):
+    header = pack_header(len(payload), request_id=1)
+    for i in range(frames):
+        if method == "legacy":
+            connection.sendall(header + payload)
+        else:
+            send_buffers(connection, [header, payload])
+
+
+def recv_legacy(connection, buffer_size):
+    def recv(data_length):
+        data = b''
+        while len(data) < data_length:
+            to_read = data_length - len(data)
+            data += connection.recv(buffer_size if to_read > buffer_size else to_read)
+        return data
+    bs = recv(LENGTH_SIZE)
+    if bs[:2] == PROTOCOL_MAGIC:
+        bs += recv(HEADER_SIZE - LENGTH_SIZE)
+    (version, request_id, flags, data_length, header_size) = parse_header(bs)
+    return zlib.decompress(recv(data_length))
+
+
+def receive(connection, method, frames, buffer_size):
+    if method == "reader":
+        connection.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(connection, selectors.EVENT_READ)
+        reader = FrameReader(buffer_size)
+        received = 0
+        while received < frames:
+            selector.select()
+            reader.read(connection)
+            frame = reader.next_frame()
+            while frame is not None:
+                zlib.decompress(frame[3])
+                received += 1
+                frame = reader.next_frame()
+        selector.close()
+        return
+    for i in range(frames):
+        if method == "legacy":
+            recv_legacy(connection, buffer_size)
+        elif method == "incremental":
+            (version, request_id, flags, data_length, header_size) = recv_header(connection)
+            recv_decompress(connection, data_length)
+        else:
+            (version, request_id, flags, data_length, header_size) = recv_header(connection)
+            zlib.decompress(recv_exactly(connection, data_length))
+
+
+def run(size, method, kind="random", tcp=False, buffer_size=4096, total=256 * 1024 * 1024):
+    payload = make_payload(size, kind)
+    frames = max(3, min(2000, total // size))
+    (receiver, client) = socket_pair(tcp)
+    thread = threading.Thread(target=sender, args=(client, method, payload, frames))
+    start = time.perf_counter()
+    thread.start()
+    receive(receiver, method, frames, buffer_size)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    receiver.close()
+    client.close()
+    return {
+        "size": size,
+        "method": method,
+        "payload": kind,
+        "transport": "tcp" if tcp else "unix",
+        "frames": frames,
+        "wire_bytes": len(payload),
+        "seconds": elapsed,
+        "frames_per_second": frames / elapsed,
+        "mb_per_second": frames * size / elapsed / (1024 * 1024)
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Throughput of the PySiCa socket framing")
+    parser.add_argument("--sizes", default="1K,64K,1M,16M,100M", help="Comma separated payload sizes (K, M and G suffixes)")
+    parser.add_argument("--methods", default="legacy,recv_into,incremental,reader", help="Comma separated receive methods")
+    parser.add_argument("--payload", default="random", help="random (not compressible) or json (test2.json repeated)")
+    parser.add_argument("--buffer-size", type=int, default=4096, help="recv size of the legacy loop, buffer of the reader")
+    parser.add_argument("--legacy-max-size", default="16M", help="Larger frames are skipped for the legacy method (quadratic)")
+    parser.add_argument("--tcp", action="store_true", help="Use a TCP connection on localhost instead of a Unix socket pair")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    for size in [parse_size(value) for value in args.sizes.split(",")]:
+        for method in args.methods.split(","):
+            if method == "legacy" and size > parse_size(args.legacy_max_size):
+                continue
+            results.append(run(size, method, args.payload, args.tcp, args.buffer_size))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("%12s %12s %8s %10s %12s %12s" % ("size", "method", "frames", "seconds", "frames/s", "MB/s"))
+        for result in results:
+            print("%12d %12s %8d %10.2f %12.0f %12.1f" % (result.get("size"), result.get("method"), result.get("frames"), result.get("seconds"), result.get("frames_per_second"), result.get("mb_per_second")))
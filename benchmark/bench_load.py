@@ -0,0 +1,370 @@
+"""
+PySiCa, a simple Python Cache system
+
+End-to-end load test: starts the servers (server_http.py under uwsgi, or a wsgiref
+stand-in if uwsgi is not installed, and server_sockets.py over TCP and a Unix socket)
+and drives them from several client processes with a mix of gets and adds. Keys are
+chosen with a uniform or a Zipf distribution, values are our payloads (test1.json,
+test2.json) or synthetic ones of a given size in bytes.
+
+For each target, payload and concurrency it reports the throughput, the p50, p99 and
+p999 latencies of the calls and the RSS of the server (including its child processes).
+With --json or --output, results are written as JSON together with the commit and the
+Python version, so runs of different releases can be compared.
+
+Servers read their settings from conf/server.cfg (e.g. MAX_ELEMS below --keys evicts
+elements and gets miss, misses are reported).
+
+Usage:
+    python benchmark/bench_load.py [--targets http,sockets-tcp,sockets-unix] [--concurrency 1,4]
+        [--payloads test1.json,1024] [--ops 2000] [--keys 1000] [--read-ratio 0.9]
+        [--distribution zipf] [--zipf-s 1.1] [--http-server uwsgi] [--output results.json]
+"""
+
+import argparse
+import bisect
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import time
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "api"))
+
+TARGETS = ["http", "sockets-tcp", "sockets-unix"]
+# Max bytes sent in each request while preloading the keys
+PRELOAD_BATCH_BYTES = 4 * 1024 * 1024
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    # Keep the connections of the clients open between requests, as uwsgi does
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_wsgi(port):
+    """
+    Stand-in for uwsgi: serves server_http.py with the wsgiref server (a thread per connection).
+    """
+    sys.path.insert(0, ROOT)
+    import server_http
+    make_server("127.0.0.1", port, server_http.application, server_class=ThreadingWSGIServer, handler_class=KeepAliveRequestHandler).serve_forever()
+
+
+def start_server(target, port, socket_file, http_server="uwsgi", http_processes=1):
+    if target != "sockets-unix" and is_listening(port):
+        raise Exception("Port " + str(port) + " is already in use, choose another one with --port")
+    if target == "http" and http_server == "uwsgi":
+        command = ["uwsgi", "--http-socket", "127.0.0.1:" + str(port), "--wsgi-file", os.path.join(ROOT, "server_http.py"), "--callable", "application",
+                   "--processes", str(http_processes), "--enable-threads", "--master", "--die-on-term", "--disable-logging"]
+    elif target == "http":
+        command = [sys.executable, os.path.realpath(__file__), "--serve-wsgi", str(port)]
+    elif target == "sockets-tcp":
+        command = [sys.executable, os.path.join(ROOT, "server_sockets.py"), "--host", "127.0.0.1", "--port", str(port)]
+    else:
+        command = [sys.executable, os.path.join(ROOT, "server_sockets.py"), "--socket-file", socket_file]
+    process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_server(process, port if target != "sockets-unix" else None, socket_file)
+    except Exception:
+        stop_server(process)
+        raise
+    return process
+
+
+def is_listening(port=None, socket_file=None):
+    try:
+        if port is not None:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+        else:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.connect(socket_file)
+            connection.close()
+        return True
+    except OSError:
+        return False
+
+
+def wait_for_server(process, port=None, socket_file=None, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise Exception("Server exited with status " + str(process.returncode))
+        if is_listening(port, socket_file):
+            return
+        time.sleep(0.1)
+    raise Exception("Server " + (str(port) if port is not None else str(socket_file)) + " did not start")
+
+
+def stop_server(process):
+    children = get_children(process.pid) if os.path.isdir("/proc") else []
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    # Workers (e.g. of uwsgi) may outlive their master, they are killed after a while
+    deadline = time.time() + 10
+    while children and time.time() < deadline:
+        children = [pid for pid in children if os.path.exists("/proc/" + str(pid))]
+        time.sleep(0.1)
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def get_children(pid):
+    children = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/" + name + "/stat") as stat:
+                # The name of the command (in parentheses) may contain spaces
+                ppid = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            children.append(int(name))
+            children.extend(get_children(int(name)))
+    return children
+
+
+def get_rss(pid):
+    """
+    Returns the RSS and the peak RSS in bytes of a process and its children (e.g. uwsgi
+    workers), (None, None) if /proc is not available.
+    """
+    if not os.path.isdir("/proc"):
+        return (None, None)
+    (rss, peak) = (0, 0)
+    for process_id in [pid] + get_children(pid):
+        try:
+            with open("/proc/" + str(process_id) + "/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1]) * 1024
+                    elif line.startswith("VmHWM:"):
+                        peak += int(line.split()[1]) * 1024
+        except (IOError, OSError):
+            pass
+    return (rss, peak)
+
+
+def load_payload(name):
+    """
+    Returns one of our payloads (test1.json, test2.json) or a synthetic one of the given
+    size in bytes (random letters, so compression does not shrink it to nothing).
+    """
+    if name.isdigit():
+        rand = random.Random(int(name))
+        return {"value": "".join(rand.choice(string.ascii_letters) for i in range(int(name)))}
+    return json.load(open(os.path.join(ROOT, "test", "sockets", name)))
+
+
+def create_client(target, port, socket_file):
+    if target == "http":
+        import pysica_api_http as api
+        return api.SimpleCache(server="127.0.0.1", port=port)
+    import pysica_api_sockets as api
+    if target == "sockets-unix":
+        return api.SimpleCache(socket_file=socket_file, persistent=True)
+    return api.SimpleCache(server="127.0.0.1", port=port, persistent=True)
+
+
+def get_key_sampler(rand, keys, distribution="uniform", zipf_s=1.1):
+    if distribution == "uniform":
+        return lambda: str(rand.randrange(keys))
+    # Zipf: the key of rank k is chosen with probability proportional to 1 / k^s
+    cumulative = []
+    total = 0.0
+    for rank in range(1, keys + 1):
+        total += 1.0 / rank ** zipf_s
+        cumulative.append(total)
+    return lambda: str(min(keys - 1, bisect.bisect_left(cumulative, rand.random() * total)))
+
+
+def preload(target, port, socket_file, payload, keys):
+    cache = create_client(target, port, socket_file)
+    batch_size = max(1, min(500, PRELOAD_BATCH_BYTES // max(1, len(json.dumps(payload)))))
+    for first in range(0, keys, batch_size):
+        responses = cache.add_many([{"element_id": str(key), "data": payload, "data_type": "bench"} for key in range(first, min(keys, first + batch_size))])
+        for response in responses:
+            if not getattr(response, "success", False):
+                raise Exception("Unable to preload the keys: " + str(response))
+    cache.close()
+
+
+def client(args):
+    (target, port, socket_file, n_client, options) = args
+    cache = create_client(target, port, socket_file)
+    payload = load_payload(options.get("payload"))
+    rand = random.Random(options.get("seed") + n_client)
+    next_key = get_key_sampler(rand, options.get("keys"), options.get("distribution"), options.get("zipf_s"))
+    read_ratio = options.get("read_ratio")
+    latencies = []
+    (errors, misses) = (0, 0)
+    for i in range(options.get("warmup")):
+        cache.get(next_key())
+    start = time.perf_counter()
+    for i in range(options.get("ops")):
+        key = next_key()
+        call_start = time.perf_counter()
+        if rand.random() < read_ratio:
+            response = cache.get(key)
+            # Misses have no message, errors do
+            if not getattr(response, "success", False) and not hasattr(response, "message"):
+                misses += 1
+        else:
+            response = cache.add(key, payload, "bench")
+        latencies.append(time.perf_counter() - call_start)
+        if hasattr(response, "message"):
+            errors += 1
+    elapsed = time.perf_counter() - start
+    cache.close()
+    return (elapsed, latencies, errors, misses)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run_load(target, port, socket_file, concurrency, options):
+    pool = multiprocessing.Pool(concurrency)
+    try:
+        results = pool.map(client, [(target, port, socket_file, n_client, options) for n_client in range(concurrency)])
+    finally:
+        pool.close()
+        pool.join()
+    latencies = sorted(latency for result in results for latency in result[1])
+    # The clients start together, the slowest one gives the duration of the run
+    elapsed = max(result[0] for result in results)
+    return {
+        "ops": len(latencies),
+        "seconds": elapsed,
+        "ops_per_second": len(latencies) / elapsed,
+        "errors": sum(result[2] for result in results),
+        "misses": sum(result[3] for result in results),
+        "mean_us": 1e6 * sum(latencies) / len(latencies),
+        "p50_us": 1e6 * percentile(latencies, 0.50),
+        "p99_us": 1e6 * percentile(latencies, 0.99),
+        "p999_us": 1e6 * percentile(latencies, 0.999),
+        "max_us": 1e6 * latencies[-1]
+    }
+
+
+def run(targets, concurrency_levels, payloads, ops=2000, keys=1000, read_ratio=0.9, distribution="uniform", zipf_s=1.1, warmup=100, http_server=None, http_processes=1, port=4800, seed=0):
+    if http_server is None:
+        http_server = "uwsgi" if shutil.which("uwsgi") else "wsgiref"
+    directory = tempfile.mkdtemp(prefix="pysica-bench-load-")
+    socket_file = os.path.join(directory, "pysica.sock")
+    results = []
+    try:
+        for target in targets:
+            for payload in payloads:
+                # A new server for each payload (and a new port, the previous one may still
+                # be held by its workers), so the RSS is not affected by the previous ones
+                process = start_server(target, port, socket_file, http_server, http_processes)
+                try:
+                    preload(target, port, socket_file, load_payload(payload), keys)
+                    for concurrency in concurrency_levels:
+                        options = dict(payload=payload, ops=ops, keys=keys, read_ratio=read_ratio, distribution=distribution, zipf_s=zipf_s, warmup=warmup, seed=seed)
+                        result = {
+                            "target": target if target != "http" else "http (" + http_server + ")",
+                            "payload": payload,
+                            "payload_bytes": len(json.dumps(load_payload(payload))),
+                            "concurrency": concurrency,
+                            "read_ratio": read_ratio,
+                            "distribution": distribution if distribution == "uniform" else "zipf " + str(zipf_s),
+                            "keys": keys
+                        }
+                        result.update(run_load(target, port, socket_file, concurrency, options))
+                        (rss, peak_rss) = get_rss(process.pid)
+                        result["rss_mb"] = rss / 1048576.0 if rss is not None else None
+                        result["peak_rss_mb"] = peak_rss / 1048576.0 if peak_rss is not None else None
+                        results.append(result)
+                finally:
+                    stop_server(process)
+                    if os.path.exists(socket_file):
+                        os.remove(socket_file)
+                port += 1
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except Exception:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="End-to-end load test of the PySiCa servers")
+    parser.add_argument("--targets", default=",".join(TARGETS), help="Comma separated list of " + ", ".join(TARGETS))
+    parser.add_argument("--concurrency", default="1,4", help="Comma separated list of numbers of client processes")
+    parser.add_argument("--payloads", default="test1.json,1024", help="Comma separated list of test1.json, test2.json or sizes in bytes")
+    parser.add_argument("--ops", type=int, default=2000, help="Operations per client")
+    parser.add_argument("--warmup", type=int, default=100, help="Gets per client before measuring")
+    parser.add_argument("--keys", type=int, default=1000)
+    parser.add_argument("--read-ratio", type=float, default=0.9)
+    parser.add_argument("--distribution", default="uniform", choices=["uniform", "zipf"])
+    parser.add_argument("--zipf-s", type=float, default=1.1)
+    parser.add_argument("--http-server", default=None, choices=["uwsgi", "wsgiref"], help="uwsgi if installed by default")
+    parser.add_argument("--http-processes", type=int, default=1, help="uwsgi processes (STORAGE shared for more than 1)")
+    parser.add_argument("--port", type=int, default=4800)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to a file")
+    parser.add_argument("--serve-wsgi", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_wsgi is not None:
+        serve_wsgi(args.serve_wsgi)
+        sys.exit(0)
+    for target in args.targets.split(","):
+        if target not in TARGETS:
+            parser.error("Unknown target " + target)
+
+    results = run(args.targets.split(","), [int(value) for value in args.concurrency.split(",")], args.payloads.split(","), args.ops, args.keys, args.read_ratio,
+                  args.distribution, args.zipf_s, args.warmup, args.http_server, args.http_processes, args.port, args.seed)
+    report = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "options": {key: value for (key, value) in vars(args).items() if key not in ["json", "output", "serve_wsgi"]},
+        "results": results
+    }
+    if args.output is not None:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print("%18s %12s %6s %10s %8s %8s %10s %10s %10s %10s %10s" % ("target", "payload", "conc", "ops/s", "errors", "misses", "p50 us", "p99 us", "p999 us", "rss MB", "peak MB"))
+        for result in results:
+            print("%18s %12s %6d %10.0f %8d %8d %10.0f %10.0f %10.0f %10s %10s" % (
+                result.get("target"), result.get("payload"), result.get("concurrency"), result.get("ops_per_second"), result.get("errors"), result.get("misses"),
+                result.get("p50_us"), result.get("p99_us"), result.get("p999_us"),
+                "%.1f" % result.get("rss_mb") if result.get("rss_mb") is not None else "-",
+                "%.1f" % result.get("peak_rss_mb") if result.get("peak_rss_mb") is not None else "-"))
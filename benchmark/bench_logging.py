@@ -0,0 +1,121 @@
+"""
+PySiCa, a simple Python Cache system
+
+Throughput of the cache operations (an add and a get per operation) with the INFO
+messages written to a log file: synchronously from the request thread, through the
+queue (pysica_logging.QueueLogHandler) and through the queue with sampled operations.
+With --stall-ms, the file handler sleeps every 100 records to simulate a slow disk.
+
+The time of each run only includes the cache operations, the time needed by the
+listener thread to write the pending records afterwards is reported as drain.
+
+Usage: python benchmark/bench_logging.py [--repeat 20000] [--rounds 3] [--stall-ms 0]
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from pysica import PySiCa
+from pysica_logging import start_queue_logging
+
+# (name, level, queue, sample_rate, max_per_second)
+MODES = [
+    ("disabled", logging.WARNING, False, 1.0, 0),
+    ("sync", logging.INFO, False, 1.0, 0),
+    ("queue", logging.INFO, True, 1.0, 0),
+    ("queue+sample", logging.INFO, True, 0.01, 0),
+    ("queue+rate", logging.INFO, True, 1.0, 1000)
+]
+
+
+class StallingFileHandler(logging.FileHandler):
+    """
+    File handler that sleeps every 100 records.
+    """
+
+    def __init__(self, path, stall):
+        super(StallingFileHandler, self).__init__(path)
+        self.stall = stall
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+        if self.stall and self.count % 100 == 0:
+            time.sleep(self.stall)
+        super(StallingFileHandler, self).emit(record)
+
+
+def run_mode(directory, mode, repeat, stall):
+    (name, level, use_queue, sample_rate, max_per_second) = mode
+    logger = logging.getLogger("bench_logging." + name)
+    logger.propagate = False
+    logger.setLevel(level)
+    handler = StallingFileHandler(os.path.join(directory, name + ".log"), stall)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(filename)s : %(funcName)s - %(message)s'))
+    logger.handlers = [handler]
+    if use_queue:
+        handler = start_queue_logging(logger)
+    cache = PySiCa(logger=logger, max_elems=0, clean_interval=3600, metrics=False, log_sample_rate=sample_rate, log_max_per_second=max_per_second)
+    keys = [str(i) for i in range(repeat)]
+    start = time.perf_counter()
+    for key in keys:
+        cache.add(key, key, "bench", compress=False)
+        cache.get_elem(key)
+    elapsed = time.perf_counter() - start
+    # Wait for the listener to write the pending records
+    start = time.perf_counter()
+    handler.close()
+    drain = time.perf_counter() - start
+    logger.handlers = []
+    return (elapsed, drain)
+
+
+def run(repeat=20000, rounds=3, stall_ms=0.0):
+    directory = tempfile.mkdtemp(prefix="pysica-bench-logging-")
+    try:
+        # Best of the rounds, the modes are interleaved
+        times = {}
+        for i in range(rounds):
+            for mode in MODES:
+                (elapsed, drain) = run_mode(directory, mode, repeat, stall_ms / 1000.0)
+                if mode[0] not in times or elapsed < times[mode[0]][0]:
+                    times[mode[0]] = (elapsed, drain)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    results = []
+    for mode in MODES:
+        (elapsed, drain) = times.get(mode[0])
+        results.append({
+            "mode": mode[0],
+            "ops_per_second": repeat / elapsed,
+            "us_per_op": elapsed / repeat * 1e6,
+            "drain_ms": drain * 1000,
+            "speedup_vs_sync": times.get("sync")[0] / elapsed
+        })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Throughput of PySiCa with INFO logging enabled")
+    parser.add_argument("--repeat", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--stall-ms", type=float, default=0.0, help="Sleep of the file handler every 100 records")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    results = run(args.repeat, args.rounds, args.stall_ms)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("%14s %14s %12s %12s %16s" % ("mode", "ops/s", "us/op", "drain ms", "speedup vs sync"))
+        for result in results:
+            print("%14s %14.0f %12.1f %12.1f %16.2f" % (result.get("mode"), result.get("ops_per_second"), result.get("us_per_op"), result.get("drain_ms"), result.get("speedup_vs_sync")))
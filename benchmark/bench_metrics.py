@@ -0,0 +1,91 @@
+"""
+PySiCa, a simple Python Cache system
+
+Cost of the metrics: time to record an operation (Metrics.record) and time per cache
+operation (add, get, get miss, reset and remove) with the metrics enabled and disabled.
+
+Usage: python benchmark/bench_metrics.py [--repeat 100000] [--rounds 5]
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from pysica import PySiCa
+from pysica_metrics import Metrics
+
+OPERATIONS = ["add", "get", "get_miss", "reset", "remove"]
+
+
+def run_operation(cache, operation, repeat):
+    keys = [str(i) for i in range(repeat)]
+    start = time.perf_counter()
+    if operation == "add":
+        for key in keys:
+            cache.add(key, key, "bench", compress=False)
+    elif operation == "get":
+        for key in keys:
+            cache.get_elem(key)
+    elif operation == "get_miss":
+        for key in keys:
+            cache.get_elem("missing")
+    elif operation == "reset":
+        for key in keys:
+            cache.reset_timeout(key)
+    else:
+        for key in keys:
+            cache.remove(key)
+    return (time.perf_counter() - start) / repeat
+
+
+def run_record(repeat):
+    metrics = Metrics()
+    start = time.perf_counter()
+    for i in range(repeat):
+        metrics.record("get_elem", "general", "bench", 1, 0, 100, 0.00001)
+    elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(repeat):
+        pass
+    return (elapsed - (time.perf_counter() - start)) / repeat
+
+
+def run(repeat=100000, rounds=5):
+    logger = logging.getLogger("bench_metrics")
+    logger.setLevel(logging.WARNING)
+    # Best of the rounds, the runs with and without metrics are interleaved
+    times = {}
+    for i in range(rounds):
+        for metrics in [False, True]:
+            cache = PySiCa(logger=logger, max_elems=0, clean_interval=3600, metrics=metrics)
+            for operation in OPERATIONS:
+                elapsed = run_operation(cache, operation, repeat)
+                times[(operation, metrics)] = min(elapsed, times.get((operation, metrics), elapsed))
+    results = [{"operation": "record", "disabled_ns": 0.0, "enabled_ns": min(run_record(repeat) for i in range(rounds)) * 1e9}]
+    for operation in OPERATIONS:
+        results.append({"operation": operation, "disabled_ns": times.get((operation, False)) * 1e9, "enabled_ns": times.get((operation, True)) * 1e9})
+    for result in results:
+        result["overhead_ns"] = result.get("enabled_ns") - result.get("disabled_ns")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cost of the PySiCa metrics")
+    parser.add_argument("--repeat", type=int, default=100000)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    results = run(args.repeat, args.rounds)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("%12s %14s %14s %14s" % ("operation", "disabled ns", "enabled ns", "overhead ns"))
+        for result in results:
+            print("%12s %14.0f %14.0f %14.0f" % (result.get("operation"), result.get("disabled_ns"), result.get("enabled_ns"), result.get("overhead_ns")))
@@ -0,0 +1,97 @@
+"""
+PySiCa, a simple Python Cache system
+
+Throughput cost of the operation log: adds (and some removes) per second with the
+log disabled and for each fsync mode (none, everysec and always), using several
+threads so the group commit can share the fsyncs.
+
+Usage: python benchmark/bench_oplog.py [--threads 1,4] [--ops 5000] [--payload small] [--directory /tmp]
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from pysica import PySiCa
+
+
+def load_payload(name):
+    if name == "small":
+        return {"value": 1}
+    return json.load(open(os.path.join(ROOT, "test", "sockets", name)))
+
+
+def worker(cache, n_thread, ops, keys, payload, barrier):
+    rand = random.Random(n_thread)
+    barrier.wait()
+    for i in range(ops):
+        key = str(rand.randrange(keys))
+        if rand.random() < 0.1:
+            cache.remove(key)
+        else:
+            cache.add(key, payload, "bench", compress=False)
+
+
+def run(mode, n_threads, ops=5000, keys=1000, payload=None, directory=None):
+    path = os.path.join(directory or tempfile.gettempdir(), "bench_oplog." + str(os.getpid()))
+    if os.path.exists(path):
+        os.remove(path)
+    logger = logging.getLogger("bench_oplog")
+    logger.setLevel(logging.WARNING)
+    cache = PySiCa(logger=logger, max_elems=0, clean_interval=3600, oplog_file=path if mode != "disabled" else None,
+                   oplog_fsync=mode if mode != "disabled" else None)
+    barrier = threading.Barrier(n_threads + 1)
+    threads = [threading.Thread(target=worker, args=(cache, n_thread, ops, keys, payload, barrier)) for n_thread in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    size = 0
+    if cache.oplog is not None:
+        cache.oplog.close()
+        size = os.path.getsize(path)
+        os.remove(path)
+    return {
+        "mode": mode,
+        "threads": n_threads,
+        "ops": ops * n_threads,
+        "seconds": elapsed,
+        "ops_per_second": ops * n_threads / elapsed,
+        "log_bytes": size
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Throughput of PySiCa with the operation log")
+    parser.add_argument("--modes", default="disabled,none,everysec,always", help="Comma separated fsync modes")
+    parser.add_argument("--threads", default="1,4", help="Comma separated numbers of threads")
+    parser.add_argument("--ops", type=int, default=5000, help="Operations per thread")
+    parser.add_argument("--keys", type=int, default=1000)
+    parser.add_argument("--payload", default="small", help="small, test1.json or test2.json")
+    parser.add_argument("--directory", default=None, help="Where the log is written (use the disk to test)")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    payload = load_payload(args.payload)
+    results = []
+    for mode in args.modes.split(","):
+        for n_threads in [int(value) for value in args.threads.split(",")]:
+            results.append(run(mode, n_threads, args.ops, args.keys, payload, args.directory))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("%10s %8s %10s %10s %12s %12s" % ("mode", "threads", "ops", "seconds", "ops/s", "log bytes"))
+        for result in results:
+            print("%10s %8d %10d %10.2f %12.0f %12d" % (result.get("mode"), result.get("threads"), result.get("ops"), result.get("seconds"), result.get("ops_per_second"), result.get("log_bytes")))
@@ -0,0 +1,113 @@
+"""
+PySiCa, a simple Python Cache system
+
+Throughput of a sharded cache: starts from 1 to N socket servers (server_sockets.py,
+one process each) and several client processes sending requests through a sharded
+SimpleCache (consistent hashing by element id).
+
+Usage: python benchmark/bench_sharding.py [--shards 4] [--clients 4] [--ops 5000] [--base-port 4700]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "api"))
+
+
+def start_servers(ports):
+    processes = []
+    for port in ports:
+        processes.append(subprocess.Popen([sys.executable, os.path.join(ROOT, "server_sockets.py"), "--port", str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    for port in ports:
+        wait_for_port(port)
+    return processes
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise Exception("Server on port " + str(port) + " did not start")
+
+
+def stop_servers(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+
+def client(args):
+    (ports, n_client, ops, keys, write_ratio) = args
+    import pysica_api_sockets as api
+    cache = api.SimpleCache(servers=[("localhost", port) for port in ports], persistent=True)
+    rand = random.Random(n_client)
+    payload = {"value": "x" * 100}
+    errors = 0
+    start = time.perf_counter()
+    for i in range(ops):
+        key = str(rand.randrange(keys))
+        if rand.random() < write_ratio:
+            response = cache.add(key, payload, "bench")
+        else:
+            response = cache.get(key)
+        if hasattr(response, "message"):
+            errors += 1
+    elapsed = time.perf_counter() - start
+    cache.close()
+    return elapsed, errors
+
+
+def run(n_shards, n_clients=4, ops=5000, keys=10000, write_ratio=0.2, base_port=4700):
+    ports = [base_port + i for i in range(n_shards)]
+    processes = start_servers(ports)
+    try:
+        pool = multiprocessing.Pool(n_clients)
+        results = pool.map(client, [(ports, n_client, ops, keys, write_ratio) for n_client in range(n_clients)])
+        pool.close()
+        pool.join()
+    finally:
+        stop_servers(processes)
+    elapsed = max(result[0] for result in results)
+    return {
+        "shards": n_shards,
+        "clients": n_clients,
+        "ops": ops * n_clients,
+        "errors": sum(result[1] for result in results),
+        "seconds": elapsed,
+        "ops_per_second": ops * n_clients / elapsed
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Throughput of PySiCa with 1 to N shards")
+    parser.add_argument("--shards", type=int, default=4, help="Max number of shards")
+    parser.add_argument("--clients", type=int, default=4, help="Number of client processes")
+    parser.add_argument("--ops", type=int, default=5000, help="Operations per client")
+    parser.add_argument("--keys", type=int, default=10000)
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument("--base-port", type=int, default=4700)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    for n_shards in range(1, args.shards + 1):
+        results.append(run(n_shards, args.clients, args.ops, args.keys, args.write_ratio, args.base_port))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("%8s %8s %10s %8s %10s %12s" % ("shards", "clients", "ops", "errors", "seconds", "ops/s"))
+        for result in results:
+            print("%8d %8d %10d %8d %10.2f %12.0f" % (result.get("shards"), result.get("clients"), result.get("ops"), result.get("errors"), result.get("seconds"), result.get("ops_per_second")))
@@ -0,0 +1,93 @@
+"""
+PySiCa, a simple Python Cache system
+
+Snapshots of the PySiCa core: time to write a snapshot (and how long requests are
+blocked when it is written by a forked child) and load rate (entries per second)
+for a warm restart.
+
+Usage: python benchmark/bench_snapshot.py [--entries 10000,100000] [--payload small] [--users 10]
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from pysica import PySiCa
+
+
+def load_payload(name):
+    if name == "small":
+        return {"value": 1}
+    return json.load(open(os.path.join(ROOT, "test", "sockets", name)))
+
+
+def create_cache(entries=0):
+    logger = logging.getLogger("bench_snapshot")
+    logger.setLevel(logging.WARNING)
+    return PySiCa(logger=logger, max_elems=entries, timeout=60, clean_interval=3600)
+
+
+def run(entries, payload, users=10, compress=False, directory=None):
+    path = os.path.join(directory or tempfile.gettempdir(), "bench_snapshot." + str(os.getpid()))
+    cache = create_cache(entries)
+    for i in range(entries):
+        cache.add(str(i), payload, "type" + str(i % 10), compress=compress, user_id=("user" + str(i % users)) if users and i % 2 else None)
+    try:
+        start = time.perf_counter()
+        cache.save_snapshot(path, fork=False)
+        write_time = time.perf_counter() - start
+        fork_time = None
+        if hasattr(os, "fork"):
+            # Time while the locks are held (the child writes the file)
+            start = time.perf_counter()
+            pid = cache.save_snapshot(path + ".fork", fork=True)
+            fork_time = time.perf_counter() - start
+            while cache.snapshot_pid == pid:
+                time.sleep(0.01)
+        size = os.path.getsize(path)
+        restored = create_cache(entries)
+        start = time.perf_counter()
+        loaded = restored.load_snapshot(path)
+        load_time = time.perf_counter() - start
+    finally:
+        for name in (path, path + ".fork"):
+            if os.path.exists(name):
+                os.remove(name)
+    return {
+        "entries": entries,
+        "loaded": loaded,
+        "bytes": size,
+        "write_seconds": write_time,
+        "fork_pause_ms": 1e3 * fork_time if fork_time is not None else None,
+        "load_seconds": load_time,
+        "load_entries_per_second": loaded / load_time if load_time else 0.0
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write and load times of the PySiCa snapshots")
+    parser.add_argument("--entries", default="10000,100000", help="Comma separated numbers of entries")
+    parser.add_argument("--payload", default="small", help="small, test1.json or test2.json")
+    parser.add_argument("--users", type=int, default=10, help="Half of the entries are spread over these users")
+    parser.add_argument("--compress", action="store_true", help="Store the values compressed")
+    parser.add_argument("--directory", default=None, help="Where the snapshots are written")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    payload = load_payload(args.payload)
+    results = [run(int(entries), payload, args.users, args.compress, args.directory) for entries in args.entries.split(",")]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("%10s %12s %10s %12s %10s %14s" % ("entries", "bytes", "write s", "fork ms", "load s", "entries/s"))
+        for result in results:
+            print("%10d %12d %10.2f %12s %10.2f %14.0f" % (result.get("entries"), result.get("bytes"), result.get("write_seconds"),
+                                                          "%.1f" % result.get("fork_pause_ms") if result.get("fork_pause_ms") is not None else "-",
+                                                          result.get("load_seconds"), result.get("load_entries_per_second")))
@@ -0,0 +1,140 @@
+"""
+PySiCa, a simple Python Cache system
+
+Cost of the wire encodings of the socket protocol (serializer json or marshal, no
+compression, zlib at some levels, zlib only above a size threshold) for a small get
+request and for add requests and get responds with our payloads (test1.json and
+test2.json): bytes sent, CPU time to encode and decode, and the total time per frame
+including the transfer at a given bandwidth.
+
+With --port, the round trip of each get is measured against a running server instead
+(python server_sockets.py) using persistent connections. The marshal encodings need
+"SERVER_WIRE_MARSHAL": true in the settings of the server (rejected by default).
+
+Usage:
+    python benchmark/bench_wire.py [--repeat 200] [--bandwidth 100]
+    python benchmark/bench_wire.py --server localhost --port 4444 [--socket-file /tmp/pysica.sock]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "api"))
+
+from pysica_framing import dumps_payload, compress_payload, decode_payload
+
+# (name, serializer, compress_level, compress_min_size)
+ENCODINGS = [
+    ("json", "json", 0, 0),
+    ("json+zlib1", "json", 1, 0),
+    ("json+zlib6", "json", 6, 0),
+    ("json+zlib1>1K", "json", 1, 1024),
+    ("marshal", "marshal", 0, 0),
+    ("marshal+zlib1", "marshal", 1, 0),
+    ("marshal+zlib6", "marshal", 6, 0),
+    ("marshal+zlib1>1K", "marshal", 1, 1024)
+]
+
+
+def load_payloads():
+    payloads = {}
+    for name in ["test1.json", "test2.json"]:
+        payloads[name] = json.load(open(os.path.join(ROOT, "test", "sockets", name)))
+    return payloads
+
+
+def get_frames():
+    """
+    Returns the messages as tuples (frame, payload name, message).
+    """
+    frames = [("get request", "-", {"target": "get", "element_id": "1", "data_type": None, "user_id": None, "reset_timeout": False, "timeout": None})]
+    for (name, payload) in sorted(load_payloads().items()):
+        frames.append(("add request", name, {"target": "add", "element_id": "1", "data": payload, "data_type": "object", "timeout": None, "compress": None, "user_id": None, "raw": False}))
+        frames.append(("get respond", name, {"success": True, "result": [payload]}))
+    return frames
+
+
+def run(repeat=200, bandwidth=100.0):
+    results = []
+    for (frame, payload_name, message) in get_frames():
+        for (name, serializer, compress_level, compress_min_size) in ENCODINGS:
+            start = time.perf_counter()
+            for i in range(repeat):
+                (data, flags) = dumps_payload(message, serializer, json.dumps)
+                (data, flags) = compress_payload(data, flags, compress_level, compress_min_size)
+            encode = (time.perf_counter() - start) / repeat
+            start = time.perf_counter()
+            for i in range(repeat):
+                decode_payload(data, flags, json.loads)
+            decode = (time.perf_counter() - start) / repeat
+            transfer = len(data) / (bandwidth * 1024 * 1024)
+            results.append({
+                "frame": frame,
+                "payload": payload_name,
+                "encoding": name,
+                "bytes": len(data),
+                "encode_us": encode * 1e6,
+                "decode_us": decode * 1e6,
+                "transfer_us": transfer * 1e6,
+                "total_us": (encode + decode + transfer) * 1e6
+            })
+    return results
+
+
+def run_server(socket_file=None, server="localhost", port=4444, repeat=200):
+    from pysica_api_sockets import SimpleCache
+    results = []
+    for (name, payload) in sorted(load_payloads().items()):
+        for (encoding, serializer, compress_level, compress_min_size) in ENCODINGS:
+            cache = SimpleCache(socket_file=socket_file, server=server, port=port, persistent=True, wire_serializer=serializer, wire_compress_level=compress_level, wire_compress_min_size=compress_min_size)
+            response = cache.add("bench_wire", payload, compress=False)
+            if not response.success:
+                raise Exception("Unable to add the payload: " + str(response))
+            start = time.perf_counter()
+            for i in range(repeat):
+                cache.add("bench_wire", payload, compress=False)
+            add = (time.perf_counter() - start) / repeat
+            start = time.perf_counter()
+            for i in range(repeat):
+                cache.get("bench_wire")
+            get = (time.perf_counter() - start) / repeat
+            start = time.perf_counter()
+            for i in range(repeat):
+                cache.get("bench_wire_missing")
+            miss = (time.perf_counter() - start) / repeat
+            cache.remove("bench_wire")
+            cache.close()
+            results.append({"payload": name, "encoding": encoding, "add_us": add * 1e6, "get_us": get * 1e6, "get_miss_us": miss * 1e6})
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cost of the wire encodings of the PySiCa socket protocol")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--bandwidth", type=float, default=100.0, help="MB/s used to estimate the transfer time (100 for 1 Gbit/s)")
+    parser.add_argument("--server", default="localhost")
+    parser.add_argument("--port", type=int, default=None, help="Measure round trips against a running server")
+    parser.add_argument("--socket-file", default=None)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    if args.port is not None or args.socket_file is not None:
+        results = run_server(args.socket_file, args.server, args.port, args.repeat)
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            print("%12s %18s %12s %12s %12s" % ("payload", "encoding", "add us", "get us", "miss us"))
+            for result in results:
+                print("%12s %18s %12.0f %12.0f %12.0f" % (result.get("payload"), result.get("encoding"), result.get("add_us"), result.get("get_us"), result.get("get_miss_us")))
+    else:
+        results = run(args.repeat, args.bandwidth)
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            print("%12s %12s %18s %10s %10s %10s %12s %10s" % ("frame", "payload", "encoding", "bytes", "encode us", "decode us", "transfer us", "total us"))
+            for result in results:
+                print("%12s %12s %18s %10d %10.1f %10.1f %12.1f %10.1f" % (result.get("frame"), result.get("payload"), result.get("encoding"), result.get("bytes"), result.get("encode_us"), result.get("decode_us"), result.get("transfer_us"), result.get("total_us")))
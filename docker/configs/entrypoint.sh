@@ -15,12 +15,23 @@ SERVER_MODE="${SERVER_MODE:-web_server}"
 SERVER_SOCKET_FILE="${SERVER_SOCKET_FILE:-}"
 SERVER_BUFFER_SIZE=${SERVER_BUFFER_SIZE:-4096}
 SERVER_HOST_NAME="${SERVER_HOST_NAME:-0.0.0.0}"
+STORAGE="${STORAGE:-memory}"
+UWSGI_PROCESSES=${UWSGI_PROCESSES:-1}
+SNAPSHOT_FILE="${SNAPSHOT_FILE:-}"
 
 # Change the default configuration based on environment
 sed -i 's/"SERVER_MODE".*/"SERVER_MODE" : "'${SERVER_MODE}'",/' /var/www/pysica/conf/server.cfg
 sed -i 's#"SERVER_SOCKET_FILE".*#"SERVER_SOCKET_FILE" : "'${SERVER_SOCKET_FILE}'",#' /var/www/pysica/conf/server.cfg
 sed -i 's/"SERVER_BUFFER_SIZE".*/"SERVER_BUFFER_SIZE" : '${SERVER_BUFFER_SIZE}',/' /var/www/pysica/conf/server.cfg
 sed -i 's/"SERVER_HOST_NAME".*/"SERVER_HOST_NAME" : "'${SERVER_HOST_NAME}'",/' /var/www/pysica/conf/server.cfg
+sed -i 's/"STORAGE".*/"STORAGE": "'${STORAGE}'",/' /var/www/pysica/conf/server.cfg
+sed -i 's#"SNAPSHOT_FILE".*#"SNAPSHOT_FILE": "'${SNAPSHOT_FILE}'",#' /var/www/pysica/conf/server.cfg
+
+# Several uwsgi workers only share the cache when using the shared storage
+if [[ "$STORAGE" != "shared" ]]; then
+    UWSGI_PROCESSES=1
+fi
+sed -i 's/^processes .*/processes       = '${UWSGI_PROCESSES}'/' /var/pysica_uwsgi.ini
 
 echo "#---------------------------------------------------------------------------------------------------"
 echo "# Welcome to PySiCa (Python Simple Cache)"
@@ -33,6 +44,7 @@ if [[ "$SERVER_MODE" == "socket_based" ]]; then
     echo "# and 'socket_based' to use pure socket communication."
     echo "#---------------------------------------------------------------------------------------------------"
     python /var/www/pysica/server_sockets.py &
+    SERVER_PID=$!
 else
     echo "# Cache server is running as web server"
     echo "# To change the running mode, please set the value for the variable SERVER_MODE in the"
@@ -47,5 +59,9 @@ else
     uwsgi --ini /var/pysica_uwsgi.ini
 fi
 
+# Stop the server gracefully on docker stop, so the snapshot (if enabled) is written
+trap 'if [[ -n "$SERVER_PID" ]]; then kill -TERM $SERVER_PID; wait $SERVER_PID; else uwsgi --stop /tmp/pysica.pid; sleep 2; fi; exit 0' TERM INT
+
 echo "Listening to /var/log/pysica/cache.log"
-tail -f /var/log/pysica/cache.log
+tail -f /var/log/pysica/cache.log &
+wait $!
@@ -4,14 +4,24 @@ PySiCa, a simple Python Cache system
 v0.2 December 2018
 """
 
-import datetime
-import marshal
+import os
+import time
+import heapq
+import itertools
 # import psutil
 import uuid
 import logging
 import atexit
+import threading
+import ujson
 from sys import getsizeof
 from apscheduler.schedulers.background import BackgroundScheduler
+from pysica_eviction import get_eviction_policy
+from pysica_codecs import CODECS, get_codec
+from pysica_snapshot import read_snapshot, write_snapshot
+from pysica_oplog import OperationLog, pack_record, OP_ADD, OP_REMOVE, OP_RESET
+from pysica_metrics import Metrics
+from pysica_logging import OperationSampler
 
 
 class Singleton(type):
@@ -26,126 +36,659 @@ class Singleton(type):
         return cls._instances[cls]
 
 
+class RawValue(str):
+    """
+    A value stored in raw mode: the already encoded (JSON) payload sent by the client.
+    Servers write it into their responses as it is, without decoding or encoding it.
+    """
+    pass
+
+
+def check_raw_value(data):
+    """
+    Returns the encoded (JSON) payload of a raw element as a RawValue. It is only checked
+    here, when it is stored, as it is spliced unchanged in every respond that returns it.
+    """
+    if isinstance(data, RawValue):
+        return data
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    elif not isinstance(data, str):
+        raise Exception("raw data must be an encoded (JSON) str or bytes, not " + type(data).__name__)
+    try:
+        ujson.loads(data)
+    except ValueError as e:
+        raise Exception("raw data is not valid JSON (" + str(e) + ")")
+    return RawValue(data)
+
+
+def dumps_respond(respond, dumps):
+    """
+    Serializes a respond using the dumps function, RawValue items in respond["result"]
+    (or in their "data" field for results of queries by type) are spliced as they are.
+    Results of batch operations (responds with their own "result") are handled too.
+    """
+    result = respond.get("result")
+    if not isinstance(result, list) or not has_raw_values(result):
+        return dumps(respond)
+    parts = []
+    for item in result:
+        if isinstance(item, RawValue):
+            parts.append(item)
+        elif isinstance(item, dict) and isinstance(item.get("data"), RawValue):
+            parts.append(dumps_item(item, dumps))
+        elif isinstance(item, dict) and isinstance(item.get("result"), list):
+            parts.append(dumps_respond(item, dumps))
+        else:
+            parts.append(dumps(item))
+    head = dumps({key: value for key, value in respond.items() if key != "result"})
+    return head[:-1] + ("," if len(head) > 2 else "") + '"result":[' + ",".join(parts) + ']}'
+
+
+def loads_raw_values(respond, loads):
+    """
+    Returns the respond with its RawValue items (as in dumps_respond) decoded using the
+    loads function, for serializers that can not splice them (e.g. marshal).
+    """
+    result = respond.get("result")
+    if not isinstance(result, list) or not has_raw_values(result):
+        return respond
+    items = []
+    for item in result:
+        if isinstance(item, RawValue):
+            items.append(loads(item))
+        elif isinstance(item, dict) and isinstance(item.get("data"), RawValue):
+            items.append({"id": item.get("id"), "data": loads(item.get("data"))})
+        elif isinstance(item, dict) and isinstance(item.get("result"), list):
+            items.append(loads_raw_values(item, loads))
+        else:
+            items.append(item)
+    respond = dict(respond)
+    respond["result"] = items
+    return respond
+
+
+def dumps_item(item, dumps):
+    """
+    Serializes an element of a query by type ({"id": element_id, "data": value}).
+    """
+    if isinstance(item.get("data"), RawValue):
+        return '{"id":' + dumps(item.get("id")) + ',"data":' + item.get("data") + '}'
+    return dumps(item)
+
+
+def iter_ndjson(items, dumps, chunk_size=65536):
+    """
+    Yields the elements of a query by type (e.g. from PySiCa.iter_type) as NDJSON, one
+    line per element, in chunks of about chunk_size bytes. The last line is a summary,
+    {"success": ..., "count": ...} with a message if the query failed.
+    """
+    lines = []
+    size = 0
+    count = 0
+    try:
+        for item in items:
+            line = dumps_item(item, dumps)
+            lines.append(line)
+            size += len(line) + 1
+            count += 1
+            if size >= chunk_size:
+                yield ("\n".join(lines) + "\n").encode("utf-8")
+                lines = []
+                size = 0
+        summary = {'success': count > 0, 'count': count}
+    except Exception as e:
+        summary = {'success': False, 'count': count, 'message': "Failed while getting elements. Error message: " + str(e)}
+    lines.append(dumps(summary))
+    yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def has_raw_values(result):
+    for item in result:
+        if isinstance(item, RawValue):
+            return True
+        if isinstance(item, dict):
+            if isinstance(item.get("data"), RawValue):
+                return True
+            if isinstance(item.get("result"), list) and has_raw_values(item.get("result")):
+                return True
+    return False
+
+
+def run_batch(cache, request, max_size=0):
+    """
+    Runs a batch operation (the request used by the servers: operation, items and the
+    options user_id, timeout, compress, reset_timeout and return) and returns a respond
+    for each item. Items are dicts as in PySiCa.add_many for "add" and element ids for
+    "get", "remove" and "reset". Batches with more than max_size items (0 for no limit)
+    are rejected.
+    """
+    operation = request.get("operation")
+    items = request.get("items") or []
+    if max_size and len(items) > max_size:
+        raise Exception("Batch size " + str(len(items)) + " exceeds the limit (" + str(max_size) + ").")
+    user_id = request.get("user_id")
+    timeout = request.get("timeout")
+    if operation == "add":
+        results = cache.add_many(items, timeout=timeout, compress=request.get("compress"), user_id=user_id)
+        return [{'success': success, 'element_id': item.get("element_id")} for (item, success) in zip(items, results)]
+    elif operation == "get":
+        results = cache.get_many(items, user_id=user_id, reset_timeout=request.get("reset_timeout", False), timeout=timeout)
+        return [{'success': True, 'result': result} if len(result) > 0 else {'success': False} for result in results]
+    elif operation == "remove":
+        results = cache.remove_many(items, user_id=user_id)
+        if request.get("return"):
+            return [{'success': len(result) > 0, 'result': result} for result in results]
+        return [{'success': len(result) > 0} for result in results]
+    elif operation == "reset":
+        return [{'success': success} for success in cache.reset_many(items, timeout=timeout, user_id=user_id)]
+    raise Exception(str(operation) + " is not a valid batch operation.")
+
+
+def get_data_size(data, compressed=False):
+    """
+    Estimates the memory used by a stored value. Compressed values are bytes so their
+    length is used, for other values the size of the contained objects is added too.
+    """
+    if compressed:
+        return len(data)
+    size = getsizeof(data)
+    if isinstance(data, dict):
+        for key, value in data.items():
+            size += get_data_size(key) + get_data_size(value)
+    elif isinstance(data, (list, tuple, set, frozenset)):
+        for value in data:
+            size += get_data_size(value)
+    return size
+
+
+class CacheStripe(object):
+    """
+    A partition of the cache guarded by its own lock. All the elements of a user are in
+    the same stripe (chosen by the user id), those in the general cache are spread over
+    the stripes by their element id. Callers must hold the lock while using a stripe.
+    """
+
+    def __init__(self, eviction_policy="lru"):
+        self.lock = threading.Lock()
+        self.general_cache = dict()
+        self.user_cache = dict()
+        # Expiry index: min-heap of (deadline, seq, user_id, element_id). Entries are
+        # not removed from the heap when an element is deleted or its timeout is reset,
+        # they are just ignored when popped (the deadline no longer matches).
+        self.expiry_heap = []
+        self.expiry_seq = itertools.count()
+        self.expiry_stale = 0
+        # Index of element ids by data_type for each cache: {user_id: {data_type: set(element_id)}}
+        # (user_id is None for the general cache)
+        self.type_index = dict()
+        # Bookkeeping for the cache limits
+        self.eviction_policy = get_eviction_policy(eviction_policy)
+        self.n_elems = 0
+        self.n_bytes = 0
+        # Size in bytes for each cache: {user_id: bytes} (user_id is None for the general cache)
+        self.cache_bytes = {None: 0}
+        self.evictions = {"general": 0, "user": 0}
+        # Expired elements removed from the stripe
+        self.expirations = 0
+
+    def get_cache(self, user_id, create=False):
+        if user_id is not None:
+            if create and user_id not in self.user_cache:
+                self.user_cache[user_id] = {}  # Initialize if not present
+            return self.user_cache.get(user_id, {})
+        else:
+            return self.general_cache
+
+    def insert(self, element_id, elem, user_id=None):
+        cache = self.get_cache(user_id, create=True)
+        if element_id in cache:
+            self.delete_elem(cache, element_id, user_id)
+            cache = self.get_cache(user_id, create=True)
+        cache[element_id] = elem
+        self.n_elems += 1
+        self.n_bytes += elem.get("size")
+        self.cache_bytes[user_id] = self.cache_bytes.get(user_id, 0) + elem.get("size")
+        self.eviction_policy.on_insert((user_id, element_id), elem)
+        self.type_index.setdefault(user_id, {}).setdefault(elem.get("data_type"), set()).add(element_id)
+        self.schedule_expiry(elem.get("timeout"), element_id, user_id)
+
+    def lookup(self, element_id, user_id=None, now=None, deadline=None):
+        """
+        Returns the element (None if not found or expired) and resets its timeout to
+        deadline if given.
+        """
+        cache = self.get_cache(user_id)
+        elem = cache.get(element_id)
+        if elem is None:
+            return None
+        if elem.get("timeout") < (now or time.time()):
+            # Expired but not cleaned yet, evict it now
+            self.delete_elem(cache, element_id, user_id)
+            self.expirations += 1
+            return None
+        self.eviction_policy.on_access((user_id, element_id), elem)
+        if deadline is not None:
+            self.reset(element_id, deadline, user_id)
+        return elem
+
+    def lookup_type(self, data_type, user_id=None, now=None, deadline=None):
+        """
+        Returns the list of (element_id, element) for the given data_type.
+        """
+        cache = self.get_cache(user_id)
+        now = now or time.time()
+        result = []
+        expired = []
+        for element_id in self.type_index.get(user_id, {}).get(data_type, ()):
+            elem = cache.get(element_id)
+            if elem.get("timeout") < now:
+                expired.append(element_id)
+                continue
+            self.eviction_policy.on_access((user_id, element_id), elem)
+            if deadline is not None:
+                self.reset(element_id, deadline, user_id)
+            result.append((element_id, elem))
+        for element_id in expired:
+            self.delete_elem(cache, element_id, user_id)
+        self.expirations += len(expired)
+        return result
+
+    def pop(self, element_id, user_id=None, now=None):
+        """
+        Removes the element and returns it (None if not found or expired).
+        """
+        elem = self.lookup(element_id, user_id, now)
+        if elem is not None:
+            self.delete_elem(self.get_cache(user_id), element_id, user_id)
+        return elem
+
+    def reset(self, element_id, deadline, user_id=None):
+        """
+        Sets the timeout of the element, returns the element (None if not found).
+        """
+        elem = self.get_cache(user_id).get(element_id)
+        if elem is None:
+            return None
+        elem["timeout"] = deadline
+        self.eviction_policy.on_update((user_id, element_id), elem)
+        self.expiry_stale += 1
+        self.schedule_expiry(deadline, element_id, user_id)
+        return elem
+
+    def clean(self, now, max_work=None):
+        """
+        Removes up to max_work expired elements. Returns the list of removed elements
+        (user_id, element_id, element) and whether there are expired entries left.
+        """
+        removed = []
+        work = 0
+        heap = self.expiry_heap
+        while heap and heap[0][0] < now:
+            if max_work and work >= max_work:
+                return removed, True
+            work += 1
+            (deadline, seq, user_id, key) = heapq.heappop(heap)
+            cache = self.general_cache if user_id is None else self.user_cache.get(user_id)
+            if cache is None or key not in cache or cache.get(key).get("timeout") != deadline:
+                # Element removed or timeout reset after this entry was scheduled
+                self.expiry_stale = max(0, self.expiry_stale - 1)
+                continue
+            removed.append((user_id, key, cache.get(key)))
+            self.delete_elem(cache, key, user_id, stale=False)
+            self.expirations += 1
+        return removed, False
+
+    def delete_elem(self, cache, element_id, user_id=None, stale=True):
+        elem = cache.pop(element_id)
+        self.n_elems -= 1
+        self.n_bytes -= elem.get("size", 0)
+        self.cache_bytes[user_id] -= elem.get("size", 0)
+        self.eviction_policy.on_remove((user_id, element_id))
+        index = self.type_index.get(user_id)
+        element_ids = index.get(elem.get("data_type"))
+        element_ids.discard(element_id)
+        if len(element_ids) == 0:
+            del index[elem.get("data_type")]
+            if len(index) == 0:
+                del self.type_index[user_id]
+        if stale:
+            # Its entry in the expiry index is still in the heap
+            self.expiry_stale += 1
+        if user_id is not None and len(cache) == 0:
+            self.user_cache.pop(user_id, None)
+            self.cache_bytes.pop(user_id, None)
+
+    def schedule_expiry(self, deadline, element_id, user_id=None):
+        heapq.heappush(self.expiry_heap, (deadline, next(self.expiry_seq), user_id, element_id))
+        # Rebuild the index when most of its entries are stale (e.g. after many resets)
+        if self.expiry_stale > 1024 and self.expiry_stale > len(self.expiry_heap) // 2:
+            self.rebuild_expiry_index()
+
+    def rebuild_expiry_index(self):
+        heap = [(elem.get("timeout"), next(self.expiry_seq), None, key) for key, elem in self.general_cache.items()]
+        for user_id, cache in self.user_cache.items():
+            heap.extend((elem.get("timeout"), next(self.expiry_seq), user_id, key) for key, elem in cache.items())
+        heapq.heapify(heap)
+        self.expiry_heap = heap
+        self.expiry_stale = 0
+
+
 class PySiCa:
 
     __metaclass__ = Singleton
 
     # Implementation of the singleton interface
-    def __init__(self, timeout=10, compress=True, max_elems=50, clean_interval=30, logger=None):
+    def __init__(self, timeout=10, compress=True, max_elems=0, clean_interval=30, logger=None, max_bytes=0, eviction_policy="lru", codec="zlib", compress_level=1, compress_min_size=1024, stripes=16, clean_batch_size=1000, snapshot_file=None, snapshot_interval=0,
+                 oplog_file=None, oplog_fsync="everysec", oplog_interval=1.0, oplog_compact_size=64 * 1024 * 1024, metrics=True,
+                 log_sample_rate=1.0, log_max_per_second=0, metrics_max_data_types=100):
         self.id = uuid.uuid4()
-        self.general_cache = dict()
-        self.user_cache = dict()
+        # The elements are partitioned in stripes, each one with its own lock, so
+        # requests for different users (or general elements) rarely wait for each other
+        self.stripes = [CacheStripe(eviction_policy) for i in range(max(1, int(stripes or 1)))]
+        # Codecs for the stored values and their stats
+        self.codecs = {name: get_codec(name, level=compress_level) for name in CODECS}
+        self.codec_stats = {name: {"count": 0, "bytes_in": 0, "bytes_out": 0, "encode_time": 0.0, "decode_count": 0, "decode_time": 0.0} for name in CODECS}
+        self.stats_lock = threading.Lock()
+        # Counters and latencies of the operations (None if disabled)
+        self.metrics = Metrics(max_data_types=metrics_max_data_types) if metrics else None
         if logger is None:
             self.logger = logging.getLogger('queue_application')
         else:
             self.logger = logger
+        # Operations logged at INFO level (all by default)
+        self.log_sampler = OperationSampler(log_sample_rate, log_max_per_second)
         # Set default options
         self.options = {
             "timeout": timeout, # TODO USE -1 TO DISABLE
-            "compress": compress,
-            "max_elems": max_elems, # TODO NOT USED
-            "clean_interval": clean_interval
+            "compress": compress, # True (uses codec), False or the name of a codec
+            "codec": get_codec(codec).name if codec is not None else "zlib",
+            "compress_min_size": compress_min_size, # Smaller values are only marshalled
+            "max_elems": max_elems, # USE 0 OR None TO DISABLE
+            "max_bytes": max_bytes, # USE 0 OR None TO DISABLE
+            "clean_interval": clean_interval,
+            "clean_batch_size": clean_batch_size, # Max expired elements removed per stripe lock
+            "snapshot_file": snapshot_file, # USE None TO DISABLE
+            "snapshot_interval": snapshot_interval # Seconds between snapshots, USE 0 TO DISABLE
         }
+        # Changes since the last snapshot and the pid of the child writing a snapshot
+        self.changes = 0
+        self.snapshot_pid = None
+        self.logger.debug("A new instance for MemCacheManager was created (id: %s)...", self.id)
+        # Operation log (None if disabled), it is newer than the snapshot when both exist
+        self.oplog = OperationLog(oplog_file, fsync=oplog_fsync, interval=oplog_interval, compact_size=oplog_compact_size, logger=self.logger) if oplog_file else None
+        if self.oplog is not None and os.path.exists(oplog_file):
+            self.replay_log()
+        # Warm restart from the last snapshot, a snapshot is written again on exit
+        elif snapshot_file and os.path.exists(snapshot_file):
+            try:
+                self.load_snapshot(snapshot_file)
+            except Exception as e:
+                self.logger.error("Unable to load snapshot %s: %s", snapshot_file, e)
+        if snapshot_file:
+            atexit.register(self.save_snapshot, fork=False, force=False)
+        if self.oplog is not None:
+            self.oplog.open(elements=self.iter_elements)
+            if self.oplog.created and self.count_elems() > 0:
+                # New log for a cache loaded from a snapshot, start it with the elements
+                self.oplog.compact()
+            atexit.register(self.oplog.close)
         # SCHELUDE THE CLEANING TASK
-        self.logger.debug("A new instance for MemCacheManager was created (id: " + str(self.id) + ")...")
         self.start_schelude_tasks()
 
-    def add(self, element_id, data, data_type, timeout=None, compress=None, user_id=None):
+    def get_stripe(self, element_id=None, user_id=None):
+        if user_id is not None:
+            return self.stripes[hash(user_id) % len(self.stripes)]
+        return self.stripes[hash(element_id) % len(self.stripes)]
+
+    def get_deadline(self, timeout=None):
+        if timeout is None:
+            timeout = self.options.get("timeout", 10)
+        return time.time() + float(timeout) * 60
+
+    def add(self, element_id, data, data_type, timeout=None, compress=None, user_id=None, raw=False):
+        """
+        Stores a new element in the cache. With raw=True, data is an already encoded (JSON)
+        payload (str or bytes) that is stored as it is and returned as a RawValue. Payloads
+        that are not valid JSON are rejected.
+        """
+        start = time.perf_counter()
         try:
-            if timeout is None:
-                timeout = self.options.get("timeout", 10)
-            if compress is None:
+            if raw:
+                compress = False
+                data = str(check_raw_value(data))
+            elif compress is None:
                 compress = self.options.get("compress", True)
 
-            self.logger.info("Storing new element in cache " + str(self.id) + (" (compressed)" if compress else "") + (" for user " + user_id if user_id is not None else ""))
-            # Choose which cache should be used
-            cache = self.get_cache(user_id)
-            # Store the object in the corresponding cache
-            cache[str(element_id)] = {
-                "timeout": datetime.datetime.now() + datetime.timedelta(minutes=timeout),
-                "compressed": compress,
-                "data_type" : data_type,
-                "data": marshal.dumps(data) if compress else data
+            # Sampled once, the evictions of this operation are logged with it
+            log = self.log_operation()
+            if log:
+                self.logger.info("Storing new element in cache %s%s%s", self.id, " (compressed)" if compress else "", " for user " + user_id if user_id is not None else "")
+            element_id = str(element_id)
+            elem = {
+                "timeout": self.get_deadline(timeout),
+                "compressed": bool(compress),
+                "data_type" : data_type
             }
+            # Encode the value before taking the lock
+            if compress:
+                (elem["codec"], elem["data"]) = self.encode_data(data, compress)
+            else:
+                elem["data"] = data
+            if raw:
+                elem["raw"] = True
+            elem["size"] = get_data_size(elem.get("data"), compressed=elem.get("compressed"))
+            max_bytes = self.options.get("max_bytes")
+            if max_bytes and elem.get("size") > max_bytes:
+                raise Exception("element size (" + str(elem.get("size")) + " bytes) exceeds the max size for the cache")
+            # Store the object in the corresponding stripe and make room for it if needed
+            # The record for the operation log is also prepared before taking the lock
+            record = pack_record(OP_ADD, element_id, user_id, elem) if self.oplog is not None else None
+            seq = None
+            stripe = self.get_stripe(element_id, user_id)
+            with stripe.lock:
+                stripe.insert(element_id, elem, user_id)
+                evicted = self.evict(stripe, exclude=(user_id, element_id))
+                if record is not None:
+                    seq = self.oplog.append(record)
+                    for (evicted_user_id, evicted_id) in evicted:
+                        seq = self.oplog.append(pack_record(OP_REMOVE, evicted_id, evicted_user_id))
+            self.changes += 1
+            self.oplog_sync(seq)
+            for (evicted_user_id, evicted_id) in evicted:
+                if log:
+                    self.logger.info("Evicting item %s from cache %s%s", evicted_id, self.id, " for user " + evicted_user_id if evicted_user_id is not None else "")
             # Print the memory usage
             self.print_memory_usage()
+            if self.metrics is not None:
+                self.metrics.record("add", "general" if user_id is None else "user", data_type, 1, 0, elem.get("size"), time.perf_counter() - start)
             return True
         except Exception as e:
-            self.logger.error("Unable to add new element to cache " + str(self.id) + ": " + str(e))
+            self.logger.error("Unable to add new element to cache %s: %s", self.id, e)
+            if self.metrics is not None:
+                self.metrics.record("add", "general" if user_id is None else "user", data_type, 0, 1, 0, time.perf_counter() - start)
             return False
 
     def get_elem(self, element_id=None, data_type=None, user_id=None, reset_timeout=False, timeout=None):
-        # Choose which cache should be used
-        cache = self.get_cache(user_id)
+        start = time.perf_counter()
         result = []
-        if element_id is not None and element_id in cache:
-            self.logger.info("Getting element from cache with ID " + str(self.id))
-            elem = cache.get(element_id)
-            if reset_timeout:
-                self.reset_timeout(element_id, timeout=timeout, user_id=user_id)
-            result.append(marshal.loads(elem.get("data")) if elem.get("compressed") else elem.get("data"))
-        elif data_type is not None:
-            self.logger.info("Getting all elements from cache for type " + data_type)
-            for element_id in cache:
-                elem = cache.get(element_id)
-                if elem.get("data_type") == data_type:
-                    if reset_timeout:
-                        self.reset_timeout(element_id, timeout=timeout, user_id=user_id)
-                    result.append({"id": element_id, "data": marshal.loads(elem.get("data")) if elem.get("compressed") else elem.get("data")})
+        now = time.time()
+        deadline = self.get_deadline(timeout) if reset_timeout else None
+        if element_id is not None:
+            stripe = self.get_stripe(element_id, user_id)
+            with stripe.lock:
+                expirations = stripe.expirations
+                elem = stripe.lookup(element_id, user_id, now, deadline)
+                expirations = stripe.expirations - expirations
+                seq = self.log_resets(stripe, [element_id] if elem is not None else [], deadline, user_id)
+            self.oplog_sync(seq)
+            if elem is not None:
+                if self.log_operation():
+                    self.logger.info("Getting element from cache with ID %s", self.id)
+                result.append(self.decode_data(elem))
+                if self.metrics is not None:
+                    self.metrics.record("get_elem", "general" if user_id is None else "user", elem.get("data_type"), 1, 0, elem.get("size"), time.perf_counter() - start)
+                return result
+            if self.metrics is not None:
+                # The type of a missing element is unknown, the one in the request is used
+                self.metrics.record("get_elem", "general" if user_id is None else "user", data_type, 0, 1, 0, time.perf_counter() - start, expirations)
+        if data_type is not None:
+            result.extend(self.iter_type(data_type, user_id=user_id, reset_timeout=reset_timeout, timeout=timeout))
+        return result
+
+    def iter_type(self, data_type, user_id=None, reset_timeout=False, timeout=None):
+        """
+        Yields the elements ({"id": element_id, "data": value}) for the given data_type.
+        Matches are found stripe by stripe and values are decoded one at a time as
+        they are consumed, so the whole result is never kept in memory.
+        """
+        if self.log_operation():
+            self.logger.info("Getting all elements from cache for type %s", data_type)
+        now = time.time()
+        deadline = self.get_deadline(timeout) if reset_timeout else None
+        # Elements in the general cache may be in any stripe
+        stripes = self.stripes if user_id is None else [self.get_stripe(user_id=user_id)]
+        # Recorded as a single get, its latency excludes the time spent by the consumer
+        (hits, expirations, n_bytes, elapsed) = (0, 0, 0, 0.0)
+        try:
+            for stripe in stripes:
+                start = time.perf_counter()
+                with stripe.lock:
+                    expired = stripe.expirations
+                    found = stripe.lookup_type(data_type, user_id, now, deadline)
+                    expirations += stripe.expirations - expired
+                    seq = self.log_resets(stripe, [element_id for (element_id, elem) in found], deadline, user_id)
+                self.oplog_sync(seq)
+                elapsed += time.perf_counter() - start
+                for (element_id, elem) in found:
+                    start = time.perf_counter()
+                    value = self.decode_data(elem)
+                    hits += 1
+                    n_bytes += elem.get("size")
+                    elapsed += time.perf_counter() - start
+                    yield {"id": element_id, "data": value}
+        finally:
+            if self.metrics is not None:
+                self.metrics.record("get_elem", "general" if user_id is None else "user", data_type, hits, 0 if hits > 0 else 1, n_bytes, elapsed, expirations)
+
+    def count_by_type(self, data_type=None, user_id=None):
+        """
+        Returns the number of elements for the given data_type in the selected cache
+        or a dict data_type -> number of elements when no data_type is given.
+        Expired elements that were not cleaned yet are included.
+        """
+        stripes = self.stripes if user_id is None else [self.get_stripe(user_id=user_id)]
+        result = {}
+        for stripe in stripes:
+            with stripe.lock:
+                for key, element_ids in stripe.type_index.get(user_id, {}).items():
+                    result[key] = result.get(key, 0) + len(element_ids)
+        if data_type is not None:
+            return result.get(data_type, 0)
         return result
 
     def remove(self, element_id, user_id=None):
-        # Choose which cache should be used
-        cache = self.get_cache(user_id)
-        # Get the element
-        result = self.get_elem(element_id, user_id=user_id)
-        if len(result) > 0:
-            self.logger.info("Deleting element from cache " + str(self.id) + " (element id: " + str(element_id) + ")")
-            del cache[element_id]
+        start = time.perf_counter()
+        stripe = self.get_stripe(element_id, user_id)
+        with stripe.lock:
+            expirations = stripe.expirations
+            elem = stripe.pop(element_id, user_id)
+            expirations = stripe.expirations - expirations
+            seq = self.oplog.append(pack_record(OP_REMOVE, element_id, user_id)) if elem is not None and self.oplog is not None else None
+        if elem is None:
+            if self.metrics is not None:
+                self.metrics.record("remove", "general" if user_id is None else "user", None, 0, 1, 0, time.perf_counter() - start, expirations)
+            return []
+        self.changes += 1
+        self.oplog_sync(seq)
+        if self.log_operation():
+            self.logger.info("Deleting element from cache %s (element id: %s)", self.id, element_id)
         # Print the memory usage
         self.print_memory_usage()
         # Return the removed element
+        result = [self.decode_data(elem)]
+        if self.metrics is not None:
+            self.metrics.record("remove", "general" if user_id is None else "user", elem.get("data_type"), 1, 0, elem.get("size"), time.perf_counter() - start)
         return result
 
     def reset_timeout(self, element_id, timeout=None, user_id=None):
-        if timeout is None:
-            timeout = self.options.get("timeout", 10)
-
+        start = time.perf_counter()
         try:
-            timeout = int(timeout)
-            # Choose which cache should be used
-            cache = self.get_cache(user_id)
-            if str(element_id) in cache:
-                self.logger.info("Resetting timeout for element " + element_id + " in cache "+ str(self.id) + (" for user " + user_id if user_id is not None else ""))
-                cache.get(element_id)["timeout"] = datetime.datetime.now() + datetime.timedelta(minutes=timeout)
-                return True
-            else:
-                self.logger.info("Element " + element_id + " not found in cache " + str(self.id) + (" for user " + user_id if user_id is not None else ""))
-                return False
+            deadline = self.get_deadline(timeout)
+            stripe = self.get_stripe(element_id, user_id)
+            with stripe.lock:
+                elem = stripe.reset(element_id, deadline, user_id)
+                found = elem is not None
+                seq = self.log_resets(stripe, [element_id] if found else [], deadline, user_id)
+            self.oplog_sync(seq)
+            if self.metrics is not None:
+                self.metrics.record("reset_timeout", "general" if user_id is None else "user", elem.get("data_type") if found else None, 1 if found else 0, 0 if found else 1, 0, time.perf_counter() - start)
+            if found:
+                self.changes += 1
+            if self.log_operation():
+                if found:
+                    self.logger.info("Resetting timeout for element %s in cache %s%s", element_id, self.id, " for user " + user_id if user_id is not None else "")
+                else:
+                    self.logger.info("Element %s not found in cache %s%s", element_id, self.id, " for user " + user_id if user_id is not None else "")
+            return found
         except:
             return False
 
+    def add_many(self, elements, timeout=None, compress=None, user_id=None):
+        """
+        Stores several elements. Each element is a dict with element_id, data and data_type
+        and optionally timeout, compress, user_id and raw (the arguments of the method are
+        used by default). Returns the list of results (True or False) for each element.
+        """
+        result = []
+        for elem in elements:
+            result.append(self.add(
+                elem.get("element_id"), elem.get("data"), elem.get("data_type"),
+                timeout=elem.get("timeout", timeout),
+                compress=elem.get("compress", compress),
+                user_id=elem.get("user_id", user_id),
+                raw=elem.get("raw", False)
+            ))
+        return result
+
+    def get_many(self, element_ids, user_id=None, reset_timeout=False, timeout=None):
+        """
+        Returns, for each element id, the result of get_elem (an empty list if not found).
+        """
+        return [self.get_elem(element_id, user_id=user_id, reset_timeout=reset_timeout, timeout=timeout) if element_id is not None else [] for element_id in element_ids]
+
+    def remove_many(self, element_ids, user_id=None):
+        """
+        Returns, for each element id, the removed element (an empty list if not found).
+        """
+        return [self.remove(element_id, user_id=user_id) for element_id in element_ids]
+
+    def reset_many(self, element_ids, timeout=None, user_id=None):
+        """
+        Returns, for each element id, True if its timeout was reset.
+        """
+        return [self.reset_timeout(element_id, timeout=timeout, user_id=user_id) for element_id in element_ids]
+
     def clean_cache(self):
-        self.logger.debug("Cleaning cache " + str(self.id))
+        self.logger.debug("Cleaning cache %s", self.id)
         self.options["n_iteration"] = self.options.get("n_iteration", 0) + 1
-        now = datetime.datetime.now()
-        # First clean the values for the general cache
-        keys = list(self.general_cache.keys())
-        for key in keys:
-            if self.general_cache.get(key).get("timeout") < now:
-                self.logger.info("Removing item " + str(key) + " from cache " + str(self.id))
-                del self.general_cache[key]
-        # Now clean the cache for each user
-        user_ids = list(self.user_cache.keys())
-        for user_id in user_ids:
-            cache = self.user_cache.get(user_id)
-            keys = list(cache.keys())
-            for key in keys:
-                if cache.get(key).get("timeout") < now:
-                    self.logger.info("Removing item " + str(key) + " from " + user_id + "'s cache " + str(self.id))
-                    del cache[key]
-            if len(cache) == 0:
-                del self.user_cache[user_id]
+        start = time.perf_counter()
+        now = time.time()
+        # Only visit the entries whose deadline is already over, releasing the lock of
+        # the stripe after each batch so requests are not blocked for long
+        for stripe in self.stripes:
+            pending = True
+            while pending:
+                with stripe.lock:
+                    (removed, pending) = stripe.clean(now, self.options.get("clean_batch_size"))
+                for (user_id, key, elem) in removed:
+                    if self.log_operation():
+                        self.logger.info("Removing item %s from %scache %s", key, user_id + "'s " if user_id is not None else "", self.id)
+                    if self.metrics is not None:
+                        self.metrics.record("clean_cache", "general" if user_id is None else "user", elem.get("data_type"), 0, 0, elem.get("size"), None, 1)
+        if self.metrics is not None:
+            # The latency of a whole cleaning, for both caches
+            self.metrics.record("clean_cache", "all", None, 0, 0, 0, time.perf_counter() - start)
         # Print the memory usage
         level="debug"
         if self.options.get("n_iteration") > 10:
@@ -153,15 +696,294 @@ class PySiCa:
             level = "info"
         self.print_memory_usage(level=level)
 
-    def get_cache_size(self):
+    def log_resets(self, stripe, element_ids, deadline, user_id=None):
+        """
+        Adds the new timeouts to the operation log (the lock of the stripe must be held).
+        Returns the sequence number of the last record (None if nothing was logged).
+        """
+        seq = None
+        if self.oplog is not None and deadline is not None:
+            for element_id in element_ids:
+                seq = self.oplog.append(pack_record(OP_RESET, element_id, user_id, {"timeout": deadline}))
+        return seq
+
+    def oplog_sync(self, seq):
+        if seq is not None:
+            self.oplog.sync(seq)
+
+    def replay_log(self):
+        """
+        Rebuilds the cache from the operation log, elements already expired are dropped.
+        Returns the number of replayed operations.
+        """
+        start = time.time()
+        count = 0
+        try:
+            # Records are applied in order whatever their deadline (a later reset may
+            # extend it), evictions were logged as removes
+            for (operation, user_id, element_id, elem) in self.oplog.replay():
+                stripe = self.get_stripe(element_id, user_id)
+                with stripe.lock:
+                    if operation == OP_ADD:
+                        elem["size"] = get_data_size(elem.get("data"), compressed=elem.get("compressed"))
+                        stripe.insert(element_id, elem, user_id)
+                    elif operation == OP_RESET:
+                        stripe.reset(element_id, elem.get("timeout"), user_id)
+                    else:
+                        # Removed, evicted or expired
+                        cache = stripe.get_cache(user_id)
+                        if element_id in cache:
+                            stripe.delete_elem(cache, element_id, user_id)
+                count += 1
+            # Then drop the elements that are still expired, and evict if the limits are
+            # lower than when the log was written
+            now = time.time()
+            for stripe in self.stripes:
+                with stripe.lock:
+                    stripe.clean(now)
+                    self.evict(stripe)
+            self.logger.info("Replayed %d operations from %s in %.3f s", count, self.oplog.path, time.time() - start)
+        except Exception as e:
+            # Keep the log aside, a new one is started with the elements loaded so far
+            self.logger.error("Unable to replay operation log %s: %s", self.oplog.path, e)
+            os.rename(self.oplog.path, self.oplog.path + ".bad")
+            self.oplog.size = 0
+        return count
+
+    def iter_elements(self, lock=True):
+        """
+        Yields all the elements as tuples (user_id, element_id, elem). With lock=True the
+        elements of each stripe are copied while holding its lock, otherwise the stripes
+        are read directly (e.g. from a forked child, where nobody else changes them).
+        """
+        for stripe in self.stripes:
+            if lock:
+                with stripe.lock:
+                    elements = [(None, key, elem) for key, elem in stripe.general_cache.items()]
+                    for user_id, cache in stripe.user_cache.items():
+                        elements.extend((user_id, key, elem) for key, elem in cache.items())
+                for element in elements:
+                    yield element
+                continue
+            for key, elem in stripe.general_cache.items():
+                yield None, key, elem
+            for user_id, cache in stripe.user_cache.items():
+                for key, elem in cache.items():
+                    yield user_id, key, elem
+
+    def load_element(self, element_id, elem, user_id=None):
+        """
+        Stores an element read from a snapshot (as kept in the cache, already encoded).
+        """
+        elem["size"] = get_data_size(elem.get("data"), compressed=elem.get("compressed"))
+        stripe = self.get_stripe(element_id, user_id)
+        with stripe.lock:
+            stripe.insert(element_id, elem, user_id)
+            self.evict(stripe, exclude=(user_id, element_id))
+
+    def save_snapshot(self, path=None, fork=True, force=True):
+        """
+        Writes a snapshot of the cache to path (snapshot_file by default). With fork=True
+        (and if the platform supports it) the snapshot is written by a child process that
+        sees a copy-on-write view of the cache, so requests are only blocked while forking.
+        With force=False nothing is written if the cache did not change since the last
+        snapshot. Returns the pid of the child (0 when written by this process).
+        """
+        path = path or self.options.get("snapshot_file")
+        if not path or (not force and self.changes == 0):
+            return None
+        if self.snapshot_pid is not None and not fork:
+            # Wait for the child, the snapshot written here is more recent
+            deadline = time.time() + 30
+            while self.snapshot_pid is not None and time.time() < deadline:
+                time.sleep(0.05)
+        if self.snapshot_pid is not None:
+            self.logger.info("Skipping snapshot for cache %s, the previous one is still being written", self.id)
+            return None
+        changes = self.changes
+        self.changes = 0
+        try:
+            if not fork or not hasattr(os, "fork"):
+                start = time.time()
+                count = write_snapshot(self.iter_elements(), path)
+                self.logger.info("Snapshot of cache %s written to %s (%d elements, %.3f s)", self.id, path, count, time.time() - start)
+                return 0
+            # Hold all the locks so the child gets a consistent copy of the stripes
+            for stripe in self.stripes:
+                stripe.lock.acquire()
+            try:
+                pid = os.fork()
+                if pid == 0:
+                    # The child must not use the locks nor the logger (held by other threads)
+                    try:
+                        write_snapshot(self.iter_elements(lock=False), path)
+                        os._exit(0)
+                    except Exception:
+                        os._exit(1)
+            finally:
+                for stripe in self.stripes:
+                    stripe.lock.release()
+            self.snapshot_pid = pid
+            threading.Thread(target=self.wait_snapshot, args=(pid, path), daemon=True).start()
+            return pid
+        except Exception as e:
+            self.changes += changes
+            self.logger.error("Unable to write snapshot of cache %s: %s", self.id, e)
+            return None
+
+    def wait_snapshot(self, pid, path):
+        try:
+            (pid, status) = os.waitpid(pid, 0)
+            if status == 0:
+                self.logger.info("Snapshot of cache %s written to %s", self.id, path)
+            else:
+                self.logger.error("Unable to write snapshot of cache %s (exit status %s)", self.id, status)
+        finally:
+            self.snapshot_pid = None
+
+    def load_snapshot(self, path=None):
+        """
+        Loads the elements stored in a snapshot, expired ones are dropped. The indexes
+        (by type, expiry and eviction) are rebuilt as elements are inserted.
+        Returns the number of loaded elements.
+        """
+        path = path or self.options.get("snapshot_file")
+        start = time.time()
+        count = 0
+        for (user_id, element_id, elem) in read_snapshot(path, now=start):
+            self.load_element(element_id, elem, user_id)
+            count += 1
+        self.logger.info("Loaded %d elements from snapshot %s in %.3f s", count, path, time.time() - start)
+        return count
+
+    def encode_data(self, data, compress=True):
+        """
+        Encodes a value using the given codec (or the default one if compress is True).
+        Values smaller than compress_min_size once marshalled are not compressed.
+        Returns a tuple (codec name, encoded bytes).
+        """
+        codec = self.codecs.get(self.options.get("codec") if compress is True else str(compress).lower())
+        if codec is None:
+            raise Exception("Unknown codec " + str(compress))
+        start = time.perf_counter()
+        encoded = self.codecs.get("marshal").encode(data)
+        if codec.name != "marshal" and len(encoded) < self.options.get("compress_min_size", 0):
+            codec = self.codecs.get("marshal")
+        size = len(encoded)
+        encoded = codec.compress(encoded)
+        elapsed = time.perf_counter() - start
+        with self.stats_lock:
+            stats = self.codec_stats.get(codec.name)
+            stats["count"] += 1
+            stats["bytes_in"] += size
+            stats["bytes_out"] += len(encoded)
+            stats["encode_time"] += elapsed
+        return codec.name, encoded
+
+    def decode_data(self, elem):
+        if elem.get("raw"):
+            return RawValue(elem.get("data"))
+        if not elem.get("compressed"):
+            return elem.get("data")
+        codec_name = elem.get("codec", "marshal")
+        start = time.perf_counter()
+        data = self.codecs.get(codec_name).decode(elem.get("data"))
+        elapsed = time.perf_counter() - start
+        with self.stats_lock:
+            stats = self.codec_stats.get(codec_name)
+            stats["decode_count"] += 1
+            stats["decode_time"] += elapsed
+        return data
+
+    def get_codec_stats(self):
+        """
+        Returns, for each codec, the number of encoded values, the bytes saved by the
+        compression and the average time (in microseconds) spent encoding and decoding.
+        """
+        result = {}
+        with self.stats_lock:
+            for name, stats in self.codec_stats.items():
+                result[name] = {
+                    "count": stats.get("count"),
+                    "bytes_in": stats.get("bytes_in"),
+                    "bytes_out": stats.get("bytes_out"),
+                    "bytes_saved": stats.get("bytes_in") - stats.get("bytes_out"),
+                    "encode_us": 1e6 * stats.get("encode_time") / stats.get("count") if stats.get("count") else 0.0,
+                    "decode_us": 1e6 * stats.get("decode_time") / stats.get("decode_count") if stats.get("decode_count") else 0.0
+                }
+        return result
+
+    def evict(self, stripe, exclude=None):
+        """
+        Evicts elements from the given stripe (its lock must be held) while the whole
+        cache is over its limits. The limits are global but victims are chosen by the
+        policy of the stripe, so the policy is only approximated across stripes.
+        Returns the list of evicted keys (user_id, element_id).
+        """
+        max_elems = self.options.get("max_elems")
+        max_bytes = self.options.get("max_bytes")
+        evicted = []
+        while (max_elems and self.count_elems() > max_elems) or (max_bytes and self.count_bytes() > max_bytes):
+            key = stripe.eviction_policy.victim(exclude=exclude)
+            if key is None:
+                break
+            (user_id, element_id) = key
+            cache = stripe.get_cache(user_id)
+            if element_id not in cache:
+                # Should not happen, just forget the key
+                stripe.eviction_policy.on_remove(key)
+                continue
+            stripe.delete_elem(cache, element_id, user_id)
+            stripe.evictions["general" if user_id is None else "user"] += 1
+            evicted.append(key)
+        return evicted
+
+    def count_elems(self):
+        return sum(stripe.n_elems for stripe in self.stripes)
+
+    def count_bytes(self):
+        return sum(stripe.n_bytes for stripe in self.stripes)
+
+    def get_stats(self):
+        n_bytes = self.count_bytes()
+        bytes_general = sum(stripe.cache_bytes.get(None) for stripe in self.stripes)
+        evictions_general = sum(stripe.evictions.get("general") for stripe in self.stripes)
+        evictions_user = sum(stripe.evictions.get("user") for stripe in self.stripes)
+        return {
+            "elements": self.count_elems(),
+            "bytes": n_bytes,
+            "bytes_general": bytes_general,
+            "bytes_user": n_bytes - bytes_general,
+            "evictions": evictions_general + evictions_user,
+            "evictions_general": evictions_general,
+            "evictions_user": evictions_user,
+            "stripes": len(self.stripes)
+        }
+
+    def get_metrics(self):
+        """
+        Returns the counters and latency histograms of the operations (see pysica_metrics)
+        and the stats of the cache. Operations are empty if the metrics are disabled.
+        """
+        return {
+            "operations": self.metrics.get_metrics() if self.metrics is not None else [],
+            "stats": self.get_stats()
+        }
+
+    def get_cache_bytes(self, user_id=None, general=False):
+        """
+        Returns the size in bytes for the whole cache, for the cache of the given user
+        or for the general cache if general is True.
+        """
+        if general:
+            return sum(stripe.cache_bytes.get(None) for stripe in self.stripes)
+        if user_id is not None:
+            return self.get_stripe(user_id=user_id).cache_bytes.get(user_id, 0)
+        return self.count_bytes()
+
+    def get_cache_size(self, user_id=None, general=False):
         # First get the total size
-        size = 0
-        for value in self.general_cache.values():
-            size += getsizeof(value.get("data"))
-        for user_id in self.user_cache:
-            cache = self.user_cache.get(user_id)
-            for value in cache.values():
-                size += getsizeof(value.get("data"))
+        size = self.get_cache_bytes(user_id=user_id, general=general)
         # Now convert to human readable
         step_to_greater_unit = 1024.
         size = float(size)
@@ -189,6 +1011,8 @@ class PySiCa:
         # return str(psutil.virtual_memory().percent) + "%"
 
     def print_memory_usage(self, level="debug"):
+        if not self.logger.isEnabledFor(logging.INFO if level == "info" else logging.DEBUG):
+            return
         message = "Status for cache " + str(self.id) + ": Size is " + self.get_cache_size()
         # + ", RAM usage " + self.get_ram_usage()
         if level == "info":
@@ -196,21 +1020,21 @@ class PySiCa:
         else:
             self.logger.debug(message)
 
-    def get_cache(self, user_id):
-        if user_id is not None:
-            self.user_cache[user_id] = self.user_cache.get(user_id, {})  # Initialize if not present
-            return self.user_cache.get(user_id)
-        else:
-            return self.general_cache
-
     def set_option(self, key, value):
         self.options[key] = value
 
+    def log_operation(self):
+        """
+        Returns True if the current operation must be logged: INFO is enabled and the
+        operation is sampled (log_sample_rate and log_max_per_second).
+        """
+        return self.logger.isEnabledFor(logging.INFO) and self.log_sampler.sample()
+
     def set_logger(self, logger):
         self.logger = logger
 
     def start_schelude_tasks(self):
-        self.logger.info("Scheduling clean_cache for cache " + str(self.id))
+        self.logger.info("Scheduling clean_cache for cache %s", self.id)
 
         cron = BackgroundScheduler(daemon=True)
         try:
@@ -228,5 +1052,8 @@ class PySiCa:
             self.clean_cache()
 
         cron.add_job(schelude_task, trigger='interval', seconds=self.options.get("clean_interval", 30), id='clean_cache_job')
+        if self.options.get("snapshot_file") and self.options.get("snapshot_interval"):
+            self.logger.info("Scheduling save_snapshot for cache %s", self.id)
+            cron.add_job(self.save_snapshot, trigger='interval', seconds=self.options.get("snapshot_interval"), kwargs={"force": False}, id='save_snapshot_job')
         # Shutdown your cron thread if the web process is stopped
         atexit.register(lambda: cron.shutdown(wait=False))
@@ -0,0 +1,83 @@
+"""
+PySiCa, a simple Python Cache system
+
+Codecs used by PySiCa to encode the stored values. All of them serialize the value
+using marshal, zlib and lzma compress the resulting bytes too.
+"""
+
+import lzma
+import marshal
+import zlib
+
+
+class MarshalCodec(object):
+    name = "marshal"
+
+    def encode(self, data):
+        return marshal.dumps(data)
+
+    def decode(self, data):
+        return marshal.loads(data)
+
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+
+class ZlibCodec(MarshalCodec):
+    name = "zlib"
+
+    def __init__(self, level=None):
+        self.level = 6 if level is None else int(level)
+
+    def encode(self, data):
+        return self.compress(marshal.dumps(data))
+
+    def decode(self, data):
+        return marshal.loads(self.decompress(data))
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class LzmaCodec(MarshalCodec):
+    name = "lzma"
+
+    def __init__(self, level=None):
+        self.level = 0 if level is None else int(level)
+
+    def encode(self, data):
+        return self.compress(marshal.dumps(data))
+
+    def decode(self, data):
+        return marshal.loads(self.decompress(data))
+
+    def compress(self, data):
+        return lzma.compress(data, preset=self.level)
+
+    def decompress(self, data):
+        return lzma.decompress(data)
+
+
+CODECS = {
+    "marshal": MarshalCodec,
+    "zlib": ZlibCodec,
+    "lzma": LzmaCodec
+}
+
+
+def get_codec(name, level=None):
+    if name is None or name is True:
+        name = "zlib"
+    try:
+        codec = CODECS[str(name).lower()]
+    except KeyError:
+        raise Exception("Unknown codec " + str(name) + ". Valid options are " + ", ".join(sorted(CODECS)))
+    if codec is MarshalCodec:
+        return codec()
+    return codec(level=level)
@@ -0,0 +1,179 @@
+"""
+PySiCa, a simple Python Cache system
+
+Eviction policies used by PySiCa when the cache reaches its limits (max number
+of elements or max size in bytes).
+
+Policies keep track of the keys stored in all the caches (general and users'),
+a key is a tuple (user_id, element_id) where user_id is None for the general
+cache.
+"""
+
+import heapq
+import itertools
+from collections import OrderedDict
+
+
+class EvictionPolicy(object):
+    """
+    Base class for the eviction policies.
+    """
+
+    def on_insert(self, key, elem):
+        raise NotImplementedError()
+
+    def on_access(self, key, elem):
+        pass
+
+    def on_update(self, key, elem):
+        pass
+
+    def on_remove(self, key):
+        raise NotImplementedError()
+
+    def victim(self, exclude=None):
+        """
+        Returns the key for the next element to evict (other than exclude) or None if empty.
+        """
+        raise NotImplementedError()
+
+
+class LRUPolicy(EvictionPolicy):
+    """
+    Evicts the least recently used element. All the operations are O(1).
+    """
+
+    def __init__(self):
+        self.keys = OrderedDict()
+
+    def on_insert(self, key, elem):
+        self.keys[key] = None
+        self.keys.move_to_end(key)
+
+    def on_access(self, key, elem):
+        if key in self.keys:
+            self.keys.move_to_end(key)
+
+    def on_remove(self, key):
+        self.keys.pop(key, None)
+
+    def victim(self, exclude=None):
+        for key in self.keys:
+            if key != exclude:
+                return key
+        return None
+
+
+class LFUPolicy(EvictionPolicy):
+    """
+    Evicts the least frequently used element (the least recently used one when
+    several elements share the same frequency). All the operations are O(1).
+    """
+
+    def __init__(self):
+        self.freqs = {}
+        self.buckets = {}
+        self.min_freq = 0
+
+    def on_insert(self, key, elem):
+        if key in self.freqs:
+            self.on_remove(key)
+        self.freqs[key] = 1
+        self.buckets.setdefault(1, OrderedDict())[key] = None
+        self.min_freq = 1
+
+    def on_access(self, key, elem):
+        freq = self.freqs.get(key)
+        if freq is None:
+            return
+        bucket = self.buckets[freq]
+        del bucket[key]
+        if len(bucket) == 0:
+            del self.buckets[freq]
+            if self.min_freq == freq:
+                self.min_freq = freq + 1
+        self.freqs[key] = freq + 1
+        self.buckets.setdefault(freq + 1, OrderedDict())[key] = None
+
+    def on_remove(self, key):
+        freq = self.freqs.pop(key, None)
+        if freq is None:
+            return
+        bucket = self.buckets[freq]
+        del bucket[key]
+        if len(bucket) == 0:
+            del self.buckets[freq]
+            # min_freq is fixed lazily at victim()
+
+    def victim(self, exclude=None):
+        if len(self.freqs) == 0:
+            return None
+        if self.min_freq not in self.buckets:
+            self.min_freq = min(self.buckets)
+        for key in self.buckets[self.min_freq]:
+            if key != exclude:
+                return key
+        # Only the excluded key has the min frequency
+        for freq in sorted(self.buckets):
+            for key in self.buckets[freq]:
+                if key != exclude:
+                    return key
+        return None
+
+
+class TTLPolicy(EvictionPolicy):
+    """
+    Evicts the element closest to expire. Uses a heap with lazy deletion, so
+    operations are O(log n).
+    """
+
+    def __init__(self):
+        self.deadlines = {}
+        self.heap = []
+        self.seq = itertools.count()
+
+    def on_insert(self, key, elem):
+        self.deadlines[key] = elem.get("timeout")
+        heapq.heappush(self.heap, (elem.get("timeout"), next(self.seq), key))
+        # Drop stale entries when they take most of the heap
+        if len(self.heap) > 1024 and len(self.heap) > 2 * len(self.deadlines):
+            self.heap = [(deadline, next(self.seq), key) for key, deadline in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def on_update(self, key, elem):
+        self.on_insert(key, elem)
+
+    def on_remove(self, key):
+        self.deadlines.pop(key, None)
+
+    def victim(self, exclude=None):
+        skipped = None
+        result = None
+        while self.heap:
+            (deadline, seq, key) = self.heap[0]
+            if self.deadlines.get(key) != deadline:
+                heapq.heappop(self.heap)
+            elif key == exclude and skipped is None:
+                skipped = heapq.heappop(self.heap)
+            else:
+                result = key
+                break
+        if skipped is not None:
+            heapq.heappush(self.heap, skipped)
+        return result
+
+
+EVICTION_POLICIES = {
+    "lru": LRUPolicy,
+    "lfu": LFUPolicy,
+    "ttl": TTLPolicy
+}
+
+
+def get_eviction_policy(name):
+    if name is None:
+        name = "lru"
+    try:
+        return EVICTION_POLICIES[str(name).lower()]()
+    except KeyError:
+        raise Exception("Unknown eviction policy " + str(name) + ". Valid options are " + ", ".join(sorted(EVICTION_POLICIES)))
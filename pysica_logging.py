@@ -0,0 +1,102 @@
+"""
+PySiCa, a simple Python Cache system
+
+Logging off the request path: a QueueHandler replaces the handlers of a logger, which are
+moved to a QueueListener thread, so requests only put the records in a queue and never
+wait for the disk. Messages are formatted by the listener thread too.
+
+The OperationSampler decides which cache operations are logged (one of every N and at most
+some per second), so logging every operation can be kept enabled under load.
+"""
+
+import itertools
+import os
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+
+class OperationSampler(object):
+    """
+    Logs one of every 1/sample_rate operations (none if 0) and at most max_per_second of
+    them (no limit if 0). Counters are not locked, limits are approximate across threads.
+    """
+
+    def __init__(self, sample_rate=1.0, max_per_second=0):
+        self.sample_rate = float(sample_rate)
+        self.max_per_second = int(max_per_second or 0)
+        self.every = int(round(1 / self.sample_rate)) if self.sample_rate > 0 else 0
+        self.counter = itertools.count()
+        self.second = 0
+        self.logged = 0
+
+    def sample(self):
+        if self.every == 0:
+            return False
+        if self.every > 1 and next(self.counter) % self.every:
+            return False
+        if self.max_per_second:
+            now = int(time.time())
+            if now != self.second:
+                self.second = now
+                self.logged = 0
+            if self.logged >= self.max_per_second:
+                return False
+            self.logged += 1
+        return True
+
+
+class QueueLogHandler(QueueHandler):
+    """
+    Puts the records in a queue, the handlers write them from a QueueListener thread.
+    The listener is started on the first record of each process, so it also works in
+    processes forked after the logging was configured (e.g. uwsgi workers).
+    """
+
+    def __init__(self, handlers):
+        super(QueueLogHandler, self).__init__(queue.Queue(-1))
+        self.target_handlers = handlers
+        self.listener = None
+        self.pid = None
+
+    def prepare(self, record):
+        # The record is formatted by the listener thread (args must not change meanwhile)
+        return record
+
+    def enqueue(self, record):
+        # Called with the lock of the handler taken
+        if self.pid != os.getpid():
+            self.start_listener()
+        self.queue.put_nowait(record)
+
+    def start_listener(self):
+        # Records queued before a fork are left to the parent
+        self.queue = queue.Queue(-1)
+        self.listener = QueueListener(self.queue, *self.target_handlers, respect_handler_level=True)
+        self.listener.start()
+        self.pid = os.getpid()
+
+    def close(self):
+        # Writes the pending records (called on exit by logging.shutdown)
+        self.acquire()
+        try:
+            if self.listener is not None and self.pid == os.getpid():
+                self.listener.stop()
+            self.listener = None
+            self.pid = None
+        finally:
+            self.release()
+        super(QueueLogHandler, self).close()
+
+
+def start_queue_logging(logger):
+    """
+    Moves the handlers of the logger behind a QueueLogHandler, returns the new handler
+    (None if the logger had no handlers).
+    """
+    handlers = [handler for handler in logger.handlers if not isinstance(handler, QueueLogHandler)]
+    if not handlers:
+        return None
+    handler = QueueLogHandler(handlers)
+    logger.handlers = [handler]
+    return handler
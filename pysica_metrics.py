@@ -0,0 +1,200 @@
+"""
+PySiCa, a simple Python Cache system
+
+Counters (hits, misses, expirations and bytes) and latency histograms of the cache
+operations, by operation, cache (general or user) and data_type.
+
+Each thread records in its own table, so recording takes no lock: the tables are only
+added up when the metrics are read. The tables of finished threads are folded into a
+shared one, and data_types over max_data_types distinct ones are labelled "other", so
+the metrics do not grow with the threads nor with the data_types sent by the clients.
+Latencies are counted in buckets whose bounds are powers of two in microseconds (1us,
+2us, 4us ... ~16s and +Inf).
+"""
+
+import threading
+
+N_BUCKETS = 26
+# Upper bounds of the buckets in seconds, the last bucket (+Inf) has no bound
+BUCKET_BOUNDS = [(1 << i) / 1000000.0 for i in range(N_BUCKETS - 1)]
+# Position of the counters in each entry, followed by the buckets (the number of
+# latencies recorded is the sum of the buckets)
+HITS = 0
+MISSES = 1
+EXPIRATIONS = 2
+BYTES = 3
+TIME = 4
+BUCKETS = 5
+COUNTERS = [
+    ("hits", "Elements found (or stored) by the operations"),
+    ("misses", "Elements not found (or not stored) by the operations"),
+    ("expirations", "Elements removed because their timeout was over"),
+    ("bytes", "Size of the elements stored, returned or removed by the operations")
+]
+# Label of the data_types over the limit
+OTHER_DATA_TYPE = "other"
+
+
+def new_entry():
+    return [0, 0, 0, 0, 0.0] + [0] * N_BUCKETS
+
+
+class Metrics(object):
+
+    def __init__(self, max_data_types=100):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # Tables of the threads: list of (thread, {(operation, cache, data_type): entry})
+        self.tables = []
+        # Entries of the threads that already finished
+        self.retired = {}
+        # Distinct data_types with their own label (0 for no limit)
+        self.max_data_types = max_data_types
+        self.data_types = set()
+
+    def get_table(self):
+        table = {}
+        with self.lock:
+            self.retire_tables()
+            self.tables.append((threading.current_thread(), table))
+        self.local.table = table
+        return table
+
+    def retire_tables(self):
+        # Folds the tables of the finished threads into the retired entries (the lock
+        # must be held), nobody else writes in them
+        tables = []
+        for (thread, table) in self.tables:
+            if thread.is_alive():
+                tables.append((thread, table))
+            else:
+                merge_entries(self.retired, list(table.items()))
+        self.tables = tables
+
+    def get_data_type_label(self, data_type):
+        if data_type is None or data_type in self.data_types or not self.max_data_types:
+            return data_type
+        if len(self.data_types) >= self.max_data_types:
+            return OTHER_DATA_TYPE
+        with self.lock:
+            if len(self.data_types) < self.max_data_types:
+                self.data_types.add(data_type)
+                return data_type
+        return OTHER_DATA_TYPE
+
+    def get_entry(self, key):
+        try:
+            table = self.local.table
+        except AttributeError:
+            table = self.get_table()
+        return table.setdefault(key, new_entry())
+
+    def record(self, operation, cache, data_type, hits, misses, n_bytes, elapsed=None, expirations=0):
+        """
+        Adds the counters of an operation, and its latency (in seconds) if given.
+        Arguments are positional, it is called for every operation.
+        """
+        try:
+            entry = self.local.table[(operation, cache, data_type)]
+        except (AttributeError, KeyError):
+            # First operation of this thread with these labels (or a data_type over the limit)
+            entry = self.get_entry((operation, cache, self.get_data_type_label(data_type)))
+        entry[HITS] += hits
+        entry[MISSES] += misses
+        entry[BYTES] += n_bytes
+        if expirations:
+            entry[EXPIRATIONS] += expirations
+        if elapsed is not None:
+            entry[TIME] += elapsed
+            bucket = int(elapsed * 1000000).bit_length()
+            entry[BUCKETS + (bucket if bucket < N_BUCKETS else N_BUCKETS - 1)] += 1
+
+    def collect(self):
+        """
+        Returns the entries of all the threads added up: {(operation, cache, data_type): entry}.
+        Entries being updated may be read halfway, counters are at most one operation behind.
+        """
+        result = {}
+        with self.lock:
+            self.retire_tables()
+            merge_entries(result, list(self.retired.items()))
+            for (thread, table) in self.tables:
+                merge_entries(result, list(table.items()))
+        return result
+
+    def get_metrics(self):
+        """
+        Returns the list of entries as dicts, sorted by operation, cache and data_type.
+        """
+        result = []
+        for (key, entry) in sorted(self.collect().items(), key=lambda item: tuple(str(value) for value in item[0])):
+            result.append({
+                "operation": key[0],
+                "cache": key[1],
+                "data_type": key[2],
+                "hits": entry[HITS],
+                "misses": entry[MISSES],
+                "expirations": entry[EXPIRATIONS],
+                "bytes": entry[BYTES],
+                "count": sum(entry[BUCKETS:]),
+                "time": entry[TIME],
+                "buckets": entry[BUCKETS:]
+            })
+        return result
+
+
+def merge_entries(result, items):
+    for (key, entry) in items:
+        total = result.get(key)
+        if total is None:
+            result[key] = list(entry)
+        else:
+            for i in range(len(entry)):
+                total[i] += entry[i]
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(entry):
+    return "operation=\"" + escape_label(entry.get("operation")) + "\",cache=\"" + escape_label(entry.get("cache")) + "\",data_type=\"" + escape_label(entry.get("data_type") if entry.get("data_type") is not None else "") + "\""
+
+
+def format_prometheus(metrics, stats=None):
+    """
+    Returns the metrics (as returned by PySiCa.get_metrics) in the Prometheus text format.
+    """
+    lines = []
+    operations = metrics.get("operations", [])
+    for (name, description) in COUNTERS:
+        lines.append("# HELP pysica_" + name + "_total " + description)
+        lines.append("# TYPE pysica_" + name + "_total counter")
+        for entry in operations:
+            lines.append("pysica_" + name + "_total{" + format_labels(entry) + "} " + str(entry.get(name)))
+    lines.append("# HELP pysica_operation_duration_seconds Latency of the operations")
+    lines.append("# TYPE pysica_operation_duration_seconds histogram")
+    for entry in operations:
+        if entry.get("count") == 0:
+            continue
+        labels = format_labels(entry)
+        total = 0
+        for (bound, count) in zip(BUCKET_BOUNDS + ["+Inf"], entry.get("buckets")):
+            total += count
+            lines.append("pysica_operation_duration_seconds_bucket{" + labels + ",le=\"" + str(bound) + "\"} " + str(total))
+        lines.append("pysica_operation_duration_seconds_sum{" + labels + "} " + repr(entry.get("time")))
+        lines.append("pysica_operation_duration_seconds_count{" + labels + "} " + str(entry.get("count")))
+    stats = metrics.get("stats") if stats is None else stats
+    if stats:
+        lines.append("# HELP pysica_elements Elements in the cache")
+        lines.append("# TYPE pysica_elements gauge")
+        lines.append("pysica_elements " + str(stats.get("elements")))
+        lines.append("# HELP pysica_bytes Size of the elements in the cache")
+        lines.append("# TYPE pysica_bytes gauge")
+        lines.append("pysica_bytes{cache=\"general\"} " + str(stats.get("bytes_general")))
+        lines.append("pysica_bytes{cache=\"user\"} " + str(stats.get("bytes_user")))
+        lines.append("# HELP pysica_evictions_total Elements evicted to respect the limits of the cache")
+        lines.append("# TYPE pysica_evictions_total counter")
+        lines.append("pysica_evictions_total{cache=\"general\"} " + str(stats.get("evictions_general")))
+        lines.append("pysica_evictions_total{cache=\"user\"} " + str(stats.get("evictions_user")))
+    return "\n".join(lines) + "\n"
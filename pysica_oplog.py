@@ -0,0 +1,243 @@
+"""
+PySiCa, a simple Python Cache system
+
+Append-only log of the operations (add, remove and reset timeout) changing the cache,
+replayed on startup to rebuild its state.
+
+Records are buffered in memory and written by a background thread (group commit),
+the fsync mode sets the durability:
+    - "none": records are written every interval, the OS decides when they reach the disk
+    - "everysec": records are written and fsynced every interval (up to interval seconds are lost)
+    - "always": add, remove and reset wait until their record is fsynced (concurrent
+       requests share the same fsync)
+
+The log is compacted in the background once it grows over compact_size (and twice
+its size after the last compaction): it is rewritten with the current elements plus
+the operations received meanwhile.
+"""
+
+import mmap
+import os
+import threading
+import time
+import zlib
+from struct import pack, unpack_from, calcsize
+from pysica_snapshot import pack_entry, unpack_entry, get_entry_size
+
+MAGIC = b'PSOL'
+VERSION = 1
+HEADER_FORMAT = '<4sI'
+HEADER_SIZE = calcsize(HEADER_FORMAT)
+# operation, entry length, crc32 of the entry
+RECORD_FORMAT = '<BII'
+RECORD_SIZE = calcsize(RECORD_FORMAT)
+OP_ADD = 1
+OP_REMOVE = 2
+OP_RESET = 3
+FSYNC_MODES = ("none", "everysec", "always")
+
+
+def pack_record(operation, element_id, user_id=None, elem=None):
+    """
+    Returns the bytes for an operation, elem is only needed for OP_ADD (the stored
+    element) and OP_RESET (its new timeout).
+    """
+    entry = pack_entry(user_id, element_id, elem or {"timeout": 0.0, "data": None})
+    return pack(RECORD_FORMAT, operation, len(entry), zlib.crc32(entry)) + entry
+
+
+def read_log(path):
+    """
+    Yields the operations (operation, user_id, element_id, elem) stored in the log and,
+    at the end, (None, None, None, valid_size): a truncated or corrupted record (e.g. the
+    last one if the process died while writing it) ends the log.
+    """
+    with open(path, "rb") as input_file:
+        size = os.fstat(input_file.fileno()).st_size
+        if size < HEADER_SIZE:
+            yield None, None, None, 0
+            return
+        data = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        (magic, version) = unpack_from(HEADER_FORMAT, data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise Exception("Invalid operation log " + path)
+        offset = HEADER_SIZE
+        while offset + RECORD_SIZE <= size:
+            (operation, length, crc) = unpack_from(RECORD_FORMAT, data, offset)
+            start = offset + RECORD_SIZE
+            if start + length > size or zlib.crc32(data[start:start + length]) != crc or get_entry_size(data, start) != length:
+                break
+            (user_id, element_id, elem) = unpack_entry(data, start)
+            offset = start + length
+            yield operation, user_id, element_id, elem
+        yield None, None, None, offset
+    finally:
+        data.close()
+
+
+class OperationLog(object):
+    """
+    The operation log of a cache. Records (from pack_record) are added with append and,
+    in "always" mode, sync must be called (without holding any lock of the cache) before
+    answering the request.
+    """
+
+    def __init__(self, path, fsync="everysec", interval=1.0, compact_size=64 * 1024 * 1024, logger=None):
+        fsync = str(fsync or "none").lower()
+        if fsync not in FSYNC_MODES:
+            raise Exception("Unknown fsync mode " + fsync + ", valid options are " + ", ".join(FSYNC_MODES))
+        self.path = path
+        self.fsync = fsync
+        self.interval = float(interval or 1.0)
+        self.compact_size = compact_size
+        self.logger = logger
+        self.output = None
+        self.size = 0
+        self.base_size = 0
+        self.replayed = False
+        # True if the log was created (or was empty) when opened
+        self.created = False
+        # Records not written yet (guarded by buffer_lock) and the sequence numbers of the
+        # last appended and last written (and fsynced if enabled) records
+        self.buffer = []
+        self.buffer_lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        self.appended = 0
+        self.written = 0
+        # Records appended while compacting the log
+        self.capture = None
+        self.elements = None
+        self.compacting = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def replay(self):
+        """
+        Yields the operations (operation, user_id, element_id, elem) stored in the log.
+        """
+        self.replayed = True
+        if not os.path.exists(self.path):
+            return
+        for (operation, user_id, element_id, elem) in read_log(self.path):
+            if operation is None:
+                self.size = elem
+                break
+            yield operation, user_id, element_id, elem
+
+    def open(self, elements=None):
+        """
+        Opens the log for appending (dropping a truncated last record) and starts the
+        background writer. elements is a function returning the elements of the cache
+        (tuples user_id, element_id, elem), used to compact the log.
+        """
+        self.elements = elements
+        if not self.replayed:
+            for operation in self.replay():
+                pass
+        self.output = open(self.path, "ab")
+        if self.output.tell() > self.size:
+            self.output.truncate(self.size)
+        if self.size < HEADER_SIZE:
+            self.created = True
+            self.output.truncate(0)
+            self.output.write(pack(HEADER_FORMAT, MAGIC, VERSION))
+            self.output.flush()
+        self.size = self.output.tell()
+        self.base_size = self.size
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def append(self, record):
+        """
+        Adds a record to the log, returns its sequence number.
+        """
+        with self.buffer_lock:
+            self.buffer.append(record)
+            if self.capture is not None:
+                self.capture.append(record)
+            self.appended += 1
+            return self.appended
+
+    def sync(self, seq):
+        """
+        In "always" mode, waits until the record seq is fsynced. The first waiting thread
+        writes all the pending records, so concurrent requests share one fsync.
+        """
+        if self.fsync != "always" or self.written >= seq:
+            return
+        self.flush(seq=seq)
+
+    def flush(self, fsync=None, seq=None):
+        with self.file_lock:
+            if seq is not None and self.written >= seq:
+                # Written by another thread while waiting for the lock
+                return
+            with self.buffer_lock:
+                (records, self.buffer) = (self.buffer, [])
+                seq = self.appended
+            if records:
+                data = b''.join(records)
+                self.output.write(data)
+                self.output.flush()
+                self.size += len(data)
+            if records and (fsync if fsync is not None else self.fsync != "none"):
+                os.fsync(self.output.fileno())
+            self.written = seq
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+                if self.compact_size and self.size > self.compact_size and self.size > 2 * self.base_size and not self.compacting:
+                    self.compacting = True
+                    threading.Thread(target=self.compact, daemon=True).start()
+            except Exception as e:
+                if self.logger:
+                    self.logger.error("Unable to write operation log %s: %s", self.path, e)
+
+    def compact(self):
+        """
+        Rewrites the log with the current elements followed by the records appended
+        while writing them (replaying those again gives the same state).
+        """
+        tmp_path = self.path + ".tmp"
+        try:
+            start = time.time()
+            with self.buffer_lock:
+                self.capture = []
+            with open(tmp_path, "wb") as output:
+                output.write(pack(HEADER_FORMAT, MAGIC, VERSION))
+                for (user_id, element_id, elem) in self.elements():
+                    output.write(pack_record(OP_ADD, element_id, user_id, elem))
+                with self.file_lock:
+                    with self.buffer_lock:
+                        output.write(b''.join(self.capture))
+                        output.flush()
+                        os.fsync(output.fileno())
+                        os.rename(tmp_path, self.path)
+                        self.output.close()
+                        self.output = open(self.path, "ab")
+                        self.size = self.base_size = self.output.tell()
+                        # The pending records were captured too
+                        (self.capture, self.buffer) = (None, [])
+                        self.written = self.appended
+            if self.logger:
+                self.logger.info("Operation log %s compacted to %d bytes in %.3f s", self.path, self.size, time.time() - start)
+        except Exception as e:
+            with self.buffer_lock:
+                self.capture = None
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if self.logger:
+                self.logger.error("Unable to compact operation log %s: %s", self.path, e)
+        finally:
+            self.compacting = False
+
+    def close(self):
+        if self.output is None:
+            return
+        self.stopped.set()
+        self.flush(fsync=True)
+        self.output.close()
+        self.output = None
@@ -0,0 +1,1023 @@
+"""
+PySiCa, a simple Python Cache system
+
+Shared memory storage for PySiCa. The elements are kept in a file mapped in memory
+(e.g. under /dev/shm) so several processes, like the uwsgi workers running
+server_http.py, share the same cache.
+
+The file contains:
+ - A header with the geometry of the cache and the slab classes.
+ - An index split in stripes, each one an open addressing hash table (linear probing)
+   with its own lock. All the elements of a user are in the same stripe.
+ - For each stripe, an index by data_type: a small hash table with the first element of
+   each data_type (of the general cache or of a user), whose elements are linked through
+   their headers. Queries by type only visit the elements of that type.
+ - The data area, split in pages. Each page is assigned to a slab class the first
+   time it is needed and split in chunks of the size of the class, freed chunks are
+   kept in a free list per class.
+
+Locks are pairs of a threading.Lock (threads in this process) and a fcntl lock on
+one byte of the file (other processes), so they are released if a process dies.
+"""
+
+import errno
+import fcntl
+import hashlib
+import marshal
+import mmap
+import os
+import random
+import threading
+import time
+from struct import pack_into, unpack_from, calcsize
+from pysica import PySiCa, check_raw_value
+
+MAGIC = b'PSHM'
+VERSION = 2
+# magic, version, size, page_size, n_pages, n_stripes, n_buckets (per stripe), n_classes, pages_offset, stripes_offset, data_offset
+FILE_FORMAT = '<4sIQIIIIIQQQ'
+PAGES_USED_OFFSET = 64
+CLASSES_OFFSET = 72
+# chunk_size, n_pages, free_head, carve (next chunk never used), carve_end
+CLASS_FORMAT = '<IIQQQ'
+CLASS_SIZE = calcsize(CLASS_FORMAT)
+# n_elems, n_bytes, bytes_general, evictions_general, evictions_user, tombstones
+STRIPE_FORMAT = '<QQQQQQ'
+STRIPE_SIZE = calcsize(STRIPE_FORMAT)
+# hash, item offset (0 empty, 1 deleted)
+BUCKET_FORMAT = '<QQ'
+BUCKET_SIZE = calcsize(BUCKET_FORMAT)
+TOMBSTONE = 1
+# hash of the data_type key, first item, number of items (0 for free slots)
+TYPE_SLOT_FORMAT = '<QQQ'
+TYPE_SLOT_SIZE = calcsize(TYPE_SLOT_FORMAT)
+# Slots of the index by data_type of each stripe, plus one for the list of the items
+# whose data_type did not fit (scanned by every query)
+TYPE_SLOTS = 256
+TYPES_SIZE = (TYPE_SLOTS + 1) * TYPE_SLOT_SIZE
+# deadline, last access, hash (next free chunk for free chunks), hits, value length,
+# key length (0 for free chunks), data_type length, codec, flags, stripe, previous and
+# next items of the same data_type in the stripe
+ITEM_FORMAT = '<ddQIIHHBBHQQ'
+ITEM_SIZE = calcsize(ITEM_FORMAT)
+FLAGS_OFFSET = 37
+LINKS_OFFSET = 40
+FLAG_RAW = 0x01
+# The item is in the list of the data_types that did not fit in the index
+FLAG_TYPE_OVERFLOW = 0x02
+CODEC_NAMES = ["marshal", "zlib", "lzma"]
+# Byte offsets of the file used for the locks
+LOCK_INIT = 0
+LOCK_ALLOC = 1
+LOCK_CLEAN = 2
+LOCK_STRIPES = 3
+# Sampled elements when choosing a victim
+EVICTION_SAMPLES = 16
+
+
+class ProcessLock(object):
+    """
+    Lock shared by the threads of this process and by the processes using the file.
+    """
+
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+        self.lock = threading.Lock()
+
+    def acquire(self, blocking=True):
+        if not self.lock.acquire(blocking):
+            return False
+        while True:
+            try:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB, 1, self.offset)
+                return True
+            except OSError as e:
+                if blocking and e.errno == errno.EDEADLK:
+                    # fcntl locks belong to the process, so the kernel may report a deadlock
+                    # when threads of two processes wait for locks held by other threads
+                    time.sleep(0.0005)
+                    continue
+                self.lock.release()
+                if blocking:
+                    raise
+                return False
+
+    def release(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.offset)
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def hash_bytes(data):
+    return int.from_bytes(hashlib.md5(data).digest()[:8], "little")
+
+
+def align(value, size):
+    return (value + size - 1) // size * size
+
+
+class SharedStore(object):
+    """
+    Elements stored in a file mapped in memory. The file is created (or replaced if its
+    geometry does not match) by the first process and attached by the others.
+    Victims for eviction are chosen by sampling a few elements (approximated lru,
+    lfu or ttl).
+    """
+
+    def __init__(self, path, size=64 * 1024 * 1024, page_size=1024 * 1024, stripes=16, capacity=65536, max_elems=0, max_bytes=0, eviction_policy="lru"):
+        self.path = path
+        self.max_elems = max_elems
+        self.max_bytes = max_bytes
+        self.eviction_policy = (eviction_policy or "lru").lower()
+        self.pid = os.getpid()
+        # True if this process created (or replaced) the file
+        self.created = False
+        self.fd = None
+        while self.fd is None:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            with ProcessLock(fd, LOCK_INIT):
+                if not self.is_current(fd):
+                    # Replaced by another process while waiting for the lock, open it again
+                    pass
+                elif self.attach(fd, size, page_size, stripes):
+                    self.fd = fd
+                else:
+                    self.fd = self.create(size, page_size, stripes, capacity)
+            if self.fd != fd:
+                os.close(fd)
+        self.create_locks()
+
+    def is_current(self, fd):
+        try:
+            return os.fstat(fd).st_ino == os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return False
+
+    def attach(self, fd, size, page_size, stripes):
+        if os.fstat(fd).st_size != size:
+            return False
+        self.mm = mmap.mmap(fd, size)
+        header = unpack_from(FILE_FORMAT, self.mm, 0)
+        if header[0] != MAGIC or header[1] != VERSION or header[3] != page_size or header[5] != stripes:
+            self.mm.close()
+            return False
+        self.read_geometry()
+        return True
+
+    def create(self, size, page_size, stripes, capacity):
+        """
+        Creates a new file and renames it over the path, returns its descriptor. The file
+        in use is never truncated: processes still mapping it (e.g. with another geometry)
+        keep their copy instead of crashing when its pages disappear.
+        """
+        n_buckets = 64
+        while n_buckets * stripes < capacity * 2:
+            n_buckets *= 2
+        classes = []
+        chunk_size = 128
+        while chunk_size < page_size:
+            classes.append(chunk_size)
+            chunk_size = align(int(chunk_size * 1.25), 8)
+        classes.append(page_size)
+        n_pages = size // page_size
+        pages_offset = CLASSES_OFFSET + len(classes) * CLASS_SIZE
+        stripes_offset = align(pages_offset + n_pages, 8)
+        data_offset = align(stripes_offset + stripes * (STRIPE_SIZE + TYPES_SIZE + n_buckets * BUCKET_SIZE), 4096)
+        n_pages = min(n_pages, (size - data_offset) // page_size)
+        if n_pages < 1:
+            raise Exception("Shared memory size (" + str(size) + " bytes) is too small")
+        # Start from an empty (zeroed) file
+        tmp_path = self.path + "." + str(os.getpid()) + ".tmp"
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+            pack_into(FILE_FORMAT, self.mm, 0, MAGIC, VERSION, size, page_size, n_pages, stripes, n_buckets, len(classes), pages_offset, stripes_offset, data_offset)
+            for (class_id, chunk_size) in enumerate(classes):
+                pack_into(CLASS_FORMAT, self.mm, CLASSES_OFFSET + class_id * CLASS_SIZE, chunk_size, 0, 0, 0, 0)
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.close(fd)
+            os.unlink(tmp_path)
+            raise
+        self.created = True
+        self.read_geometry()
+        return fd
+
+    def read_geometry(self):
+        (magic, version, self.size, self.page_size, self.n_pages, self.n_stripes, self.n_buckets, self.n_classes, self.pages_offset, self.stripes_offset, self.data_offset) = unpack_from(FILE_FORMAT, self.mm, 0)
+        self.chunk_sizes = [unpack_from(CLASS_FORMAT, self.mm, CLASSES_OFFSET + class_id * CLASS_SIZE)[0] for class_id in range(self.n_classes)]
+
+    def create_locks(self):
+        self.alloc_lock = ProcessLock(self.fd, LOCK_ALLOC)
+        self.clean_lock = ProcessLock(self.fd, LOCK_CLEAN)
+        self.stripe_locks = [ProcessLock(self.fd, LOCK_STRIPES + stripe) for stripe in range(self.n_stripes)]
+
+    def check_fork(self):
+        # Threading locks copied by fork may be held by threads that do not exist in the child
+        if os.getpid() != self.pid:
+            self.pid = os.getpid()
+            self.create_locks()
+
+    # ------------------------------------------------------------------------------------------
+    # KEYS AND INDEX
+    # ------------------------------------------------------------------------------------------
+    def make_key(self, element_id, user_id=None):
+        """
+        Returns the key, its hash and its stripe. Keys of a user are in the stripe of the user.
+        """
+        if user_id is None:
+            key = b'\x00' + str(element_id).encode("utf-8")
+            key_hash = hash_bytes(key)
+            return key, key_hash, (key_hash >> 40) % self.n_stripes
+        key = b'\x01' + str(user_id).encode("utf-8") + b'\x00' + str(element_id).encode("utf-8")
+        return key, hash_bytes(key), self.get_user_stripe(user_id)
+
+    def get_user_stripe(self, user_id):
+        return (hash_bytes(b'\x01' + str(user_id).encode("utf-8")) >> 40) % self.n_stripes
+
+    def parse_key(self, key):
+        """
+        Returns the tuple (user_id, element_id) for a key.
+        """
+        if key[:1] == b'\x00':
+            return None, key[1:].decode("utf-8")
+        (user_id, element_id) = key[1:].split(b'\x00', 1)
+        return user_id.decode("utf-8"), element_id.decode("utf-8")
+
+    def get_stripe_offset(self, stripe):
+        return self.stripes_offset + stripe * (STRIPE_SIZE + TYPES_SIZE + self.n_buckets * BUCKET_SIZE)
+
+    def get_types_offset(self, stripe):
+        return self.get_stripe_offset(stripe) + STRIPE_SIZE
+
+    def get_buckets_offset(self, stripe):
+        return self.get_stripe_offset(stripe) + STRIPE_SIZE + TYPES_SIZE
+
+    def find(self, stripe, key_hash, key):
+        """
+        Returns (bucket, item offset) for the key or, if not found, (free bucket, 0).
+        The stripe lock must be held.
+        """
+        base = self.get_buckets_offset(stripe)
+        mask = self.n_buckets - 1
+        index = key_hash & mask
+        free = None
+        for i in range(self.n_buckets):
+            bucket = base + ((index + i) & mask) * BUCKET_SIZE
+            (bucket_hash, offset) = unpack_from(BUCKET_FORMAT, self.mm, bucket)
+            if offset == 0:
+                return (bucket if free is None else free), 0
+            if offset == TOMBSTONE:
+                if free is None:
+                    free = bucket
+            elif bucket_hash == key_hash and self.read_key(offset) == key:
+                return bucket, offset
+        return free, 0
+
+    def iter_buckets(self, stripe, start=0, end=None):
+        """
+        Yields (bucket, item offset) for the elements in the stripe. The lock must be held.
+        """
+        base = self.get_buckets_offset(stripe)
+        for index in range(start, min(end or self.n_buckets, self.n_buckets)):
+            bucket = base + index * BUCKET_SIZE
+            offset = unpack_from(BUCKET_FORMAT, self.mm, bucket)[1]
+            if offset > TOMBSTONE:
+                yield bucket, offset
+
+    def rehash(self, stripe):
+        """
+        Rebuilds the table of the stripe without the deleted entries.
+        """
+        entries = [(unpack_from(BUCKET_FORMAT, self.mm, bucket)[0], offset) for (bucket, offset) in self.iter_buckets(stripe)]
+        base = self.get_buckets_offset(stripe)
+        mask = self.n_buckets - 1
+        self.mm[base:base + self.n_buckets * BUCKET_SIZE] = bytes(self.n_buckets * BUCKET_SIZE)
+        for (key_hash, offset) in entries:
+            index = key_hash & mask
+            while unpack_from(BUCKET_FORMAT, self.mm, base + index * BUCKET_SIZE)[1] != 0:
+                index = (index + 1) & mask
+            pack_into(BUCKET_FORMAT, self.mm, base + index * BUCKET_SIZE, key_hash, offset)
+        self.update_counters(stripe, tombstones=-self.get_counters(stripe)[5])
+
+    def get_counters(self, stripe):
+        return unpack_from(STRIPE_FORMAT, self.mm, self.get_stripe_offset(stripe))
+
+    def update_counters(self, stripe, elems=0, n_bytes=0, bytes_general=0, evictions_general=0, evictions_user=0, tombstones=0):
+        offset = self.get_stripe_offset(stripe)
+        counters = unpack_from(STRIPE_FORMAT, self.mm, offset)
+        pack_into(STRIPE_FORMAT, self.mm, offset, counters[0] + elems, counters[1] + n_bytes, counters[2] + bytes_general, counters[3] + evictions_general, counters[4] + evictions_user, counters[5] + tombstones)
+
+    # ------------------------------------------------------------------------------------------
+    # INDEX BY DATA_TYPE
+    # ------------------------------------------------------------------------------------------
+    def make_type_key(self, data_type, user_id=None):
+        """
+        Returns the key of a data_type in the index, parsed as the keys of the elements.
+        """
+        if user_id is None:
+            return b'\x00' + data_type
+        return b'\x01' + str(user_id).encode("utf-8") + b'\x00' + data_type
+
+    def read_type_key(self, offset):
+        header = self.read_header(offset)
+        start = offset + ITEM_SIZE
+        key = self.mm[start:start + header[5]]
+        data_type = self.mm[start + header[5]:start + header[5] + header[6]]
+        if key[:1] == b'\x00':
+            return b'\x00' + data_type
+        return key[:key.index(b'\x00', 1) + 1] + data_type
+
+    def find_type(self, stripe, type_hash, type_key):
+        """
+        Returns (slot, found) for the data_type key in the index of the stripe or, if not
+        found, (free slot, False). The slot is None if the index is full. The lock must be held.
+        """
+        base = self.get_types_offset(stripe)
+        mask = TYPE_SLOTS - 1
+        for i in range(TYPE_SLOTS):
+            slot = base + ((type_hash + i) & mask) * TYPE_SLOT_SIZE
+            (slot_hash, first, n_items) = unpack_from(TYPE_SLOT_FORMAT, self.mm, slot)
+            if n_items == 0:
+                return slot, False
+            if slot_hash == type_hash and self.read_type_key(first) == type_key:
+                return slot, True
+        return None, False
+
+    def link_type(self, stripe, offset):
+        """
+        Adds the item to the index by data_type of the stripe. The lock must be held.
+        """
+        type_key = self.read_type_key(offset)
+        type_hash = hash_bytes(type_key)
+        (slot, found) = self.find_type(stripe, type_hash, type_key)
+        if slot is None:
+            slot = self.get_types_offset(stripe) + TYPE_SLOTS * TYPE_SLOT_SIZE
+            type_hash = 0
+            self.mm[offset + FLAGS_OFFSET] |= FLAG_TYPE_OVERFLOW
+        (slot_hash, first, n_items) = unpack_from(TYPE_SLOT_FORMAT, self.mm, slot)
+        pack_into('<QQ', self.mm, offset + LINKS_OFFSET, 0, first)
+        if first:
+            pack_into('<Q', self.mm, first + LINKS_OFFSET, offset)
+        pack_into(TYPE_SLOT_FORMAT, self.mm, slot, type_hash, offset, n_items + 1)
+
+    def unlink_type(self, stripe, offset):
+        """
+        Removes the item from the index by data_type of the stripe. The lock must be held.
+        """
+        (previous, following) = unpack_from('<QQ', self.mm, offset + LINKS_OFFSET)
+        if self.mm[offset + FLAGS_OFFSET] & FLAG_TYPE_OVERFLOW:
+            slot = self.get_types_offset(stripe) + TYPE_SLOTS * TYPE_SLOT_SIZE
+        else:
+            type_key = self.read_type_key(offset)
+            slot = self.find_type(stripe, hash_bytes(type_key), type_key)[0]
+        (slot_hash, first, n_items) = unpack_from(TYPE_SLOT_FORMAT, self.mm, slot)
+        if previous:
+            pack_into('<Q', self.mm, previous + LINKS_OFFSET + 8, following)
+        else:
+            first = following
+        if following:
+            pack_into('<Q', self.mm, following + LINKS_OFFSET, previous)
+        if n_items > 1:
+            pack_into(TYPE_SLOT_FORMAT, self.mm, slot, slot_hash, first, n_items - 1)
+        else:
+            self.free_type_slot(stripe, slot)
+
+    def free_type_slot(self, stripe, slot):
+        """
+        Empties a slot of the index, moving back the next ones of the probe sequence
+        (the table has no deleted entries).
+        """
+        pack_into(TYPE_SLOT_FORMAT, self.mm, slot, 0, 0, 0)
+        base = self.get_types_offset(stripe)
+        if slot == base + TYPE_SLOTS * TYPE_SLOT_SIZE:
+            return
+        mask = TYPE_SLOTS - 1
+        empty = (slot - base) // TYPE_SLOT_SIZE
+        index = empty
+        while True:
+            index = (index + 1) & mask
+            entry = unpack_from(TYPE_SLOT_FORMAT, self.mm, base + index * TYPE_SLOT_SIZE)
+            if entry[2] == 0:
+                return
+            # Entries placed before the empty slot in their probe sequence are moved to it
+            if (index - (entry[0] & mask)) & mask >= (index - empty) & mask:
+                pack_into(TYPE_SLOT_FORMAT, self.mm, base + empty * TYPE_SLOT_SIZE, *entry)
+                pack_into(TYPE_SLOT_FORMAT, self.mm, base + index * TYPE_SLOT_SIZE, 0, 0, 0)
+                empty = index
+
+    def iter_type_slots(self, stripe):
+        """
+        Yields (first item, number of items) for each data_type of the stripe, the items
+        that did not fit in the index last. The lock must be held.
+        """
+        base = self.get_types_offset(stripe)
+        for index in range(TYPE_SLOTS + 1):
+            (slot_hash, first, n_items) = unpack_from(TYPE_SLOT_FORMAT, self.mm, base + index * TYPE_SLOT_SIZE)
+            if n_items > 0:
+                yield first, n_items
+
+    def iter_type_items(self, first):
+        """
+        Yields the offsets of the linked items from the first one. The lock must be held.
+        """
+        offset = first
+        while offset:
+            yield offset
+            offset = unpack_from('<Q', self.mm, offset + LINKS_OFFSET + 8)[0]
+
+    def find_type_items(self, stripe, type_key):
+        """
+        Returns the offsets of the items for the data_type key in the stripe. The lock must be held.
+        """
+        (slot, found) = self.find_type(stripe, hash_bytes(type_key), type_key)
+        result = list(self.iter_type_items(unpack_from(TYPE_SLOT_FORMAT, self.mm, slot)[1])) if found else []
+        overflow = unpack_from(TYPE_SLOT_FORMAT, self.mm, self.get_types_offset(stripe) + TYPE_SLOTS * TYPE_SLOT_SIZE)[1]
+        result.extend(offset for offset in self.iter_type_items(overflow) if self.read_type_key(offset) == type_key)
+        return result
+
+    # ------------------------------------------------------------------------------------------
+    # ITEMS
+    # ------------------------------------------------------------------------------------------
+    def read_header(self, offset):
+        return unpack_from(ITEM_FORMAT, self.mm, offset)
+
+    def read_key(self, offset):
+        key_length = unpack_from('<H', self.mm, offset + 32)[0]
+        return self.mm[offset + ITEM_SIZE:offset + ITEM_SIZE + key_length]
+
+    def read_item(self, offset):
+        """
+        Returns the tuple (key, data_type, codec, flags, value) for the item.
+        """
+        (deadline, access, key_hash, hits, value_length, key_length, type_length, codec, flags, stripe, previous, following) = self.read_header(offset)
+        start = offset + ITEM_SIZE
+        key = self.mm[start:start + key_length]
+        data_type = self.mm[start + key_length:start + key_length + type_length]
+        value = self.mm[start + key_length + type_length:start + key_length + type_length + value_length]
+        return key, data_type, codec, flags & ~FLAG_TYPE_OVERFLOW, value
+
+    def touch(self, offset, now):
+        (hits,) = unpack_from('<I', self.mm, offset + 24)
+        pack_into('<d', self.mm, offset + 8, now)
+        pack_into('<I', self.mm, offset + 24, min(hits + 1, 0xFFFFFFFF))
+
+    def unlink(self, stripe, bucket, offset, eviction=False):
+        """
+        Removes the item from the index of the stripe (the lock must be held) and
+        returns its offset, to be freed once the lock is released.
+        """
+        header = self.read_header(offset)
+        general = self.read_key(offset)[:1] == b'\x00'
+        pack_into(BUCKET_FORMAT, self.mm, bucket, 0, TOMBSTONE)
+        self.unlink_type(stripe, offset)
+        self.update_counters(stripe, elems=-1, n_bytes=-header[4], bytes_general=-header[4] if general else 0, tombstones=1,
+                             evictions_general=1 if eviction and general else 0, evictions_user=1 if eviction and not general else 0)
+        return offset
+
+    def score(self, header):
+        """
+        Victims are the sampled elements with the lowest score.
+        """
+        if self.eviction_policy == "ttl":
+            return header[0]
+        if self.eviction_policy == "lfu":
+            return header[3], header[1]
+        return header[1]
+
+    def sample_victim(self, stripe, exclude=None):
+        """
+        Returns (bucket, offset) for the victim among some random elements of the stripe.
+        """
+        base = self.get_buckets_offset(stripe)
+        victim = None
+        found = 0
+        for i in range(EVICTION_SAMPLES * 4):
+            bucket = base + random.randrange(self.n_buckets) * BUCKET_SIZE
+            offset = unpack_from(BUCKET_FORMAT, self.mm, bucket)[1]
+            if offset <= TOMBSTONE or offset == exclude:
+                continue
+            score = self.score(self.read_header(offset))
+            if victim is None or score < victim[0]:
+                victim = (score, bucket, offset)
+            found += 1
+            if found >= EVICTION_SAMPLES:
+                break
+        if victim is None:
+            # Few elements in the stripe, look for any of them
+            for (bucket, offset) in self.iter_buckets(stripe):
+                if offset != exclude:
+                    return bucket, offset
+            return None
+        return victim[1], victim[2]
+
+    # ------------------------------------------------------------------------------------------
+    # SLAB ALLOCATOR
+    # ------------------------------------------------------------------------------------------
+    def get_class(self, size):
+        for (class_id, chunk_size) in enumerate(self.chunk_sizes):
+            if chunk_size >= size:
+                return class_id
+        raise Exception("element size (" + str(size) + " bytes) exceeds the page size for the shared cache (" + str(self.page_size) + " bytes)")
+
+    def allocate(self, size):
+        class_id = self.get_class(size)
+        for attempt in range(EVICTION_SAMPLES):
+            with self.alloc_lock:
+                offset = self.pop_chunk(class_id)
+            if offset:
+                return offset
+            # No memory left for this size, evict an element of the same class
+            if not self.evict_from_class(class_id):
+                break
+        raise Exception("not enough shared memory for an element of " + str(size) + " bytes")
+
+    def pop_chunk(self, class_id):
+        """
+        Returns a free chunk of the class (0 if no memory left). The allocator lock must be held.
+        """
+        class_offset = CLASSES_OFFSET + class_id * CLASS_SIZE
+        (chunk_size, n_pages, free_head, carve, carve_end) = unpack_from(CLASS_FORMAT, self.mm, class_offset)
+        if free_head:
+            next_free = unpack_from('<Q', self.mm, free_head + 16)[0]
+            pack_into(CLASS_FORMAT, self.mm, class_offset, chunk_size, n_pages, next_free, carve, carve_end)
+            return free_head
+        if carve + chunk_size > carve_end:
+            # Assign a new page to the class
+            (pages_used,) = unpack_from('<Q', self.mm, PAGES_USED_OFFSET)
+            if pages_used >= self.n_pages:
+                return 0
+            pack_into('<Q', self.mm, PAGES_USED_OFFSET, pages_used + 1)
+            self.mm[self.pages_offset + pages_used] = class_id + 1
+            n_pages += 1
+            carve = self.data_offset + pages_used * self.page_size
+            carve_end = carve + (self.page_size // chunk_size) * chunk_size
+        pack_into(CLASS_FORMAT, self.mm, class_offset, chunk_size, n_pages, free_head, carve + chunk_size, carve_end)
+        return carve
+
+    def free_chunks(self, offsets):
+        if len(offsets) == 0:
+            return
+        with self.alloc_lock:
+            for offset in offsets:
+                class_id = self.mm[self.pages_offset + (offset - self.data_offset) // self.page_size] - 1
+                class_offset = CLASSES_OFFSET + class_id * CLASS_SIZE
+                (chunk_size, n_pages, free_head, carve, carve_end) = unpack_from(CLASS_FORMAT, self.mm, class_offset)
+                pack_into(ITEM_FORMAT, self.mm, offset, 0.0, 0.0, free_head, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+                pack_into(CLASS_FORMAT, self.mm, class_offset, chunk_size, n_pages, offset, carve, carve_end)
+
+    def evict_from_class(self, class_id):
+        """
+        Evicts one of some random elements in a page of the class. Returns False if the
+        class has no pages.
+        """
+        pages = [page for (page, value) in enumerate(self.mm[self.pages_offset:self.pages_offset + self.n_pages]) if value == class_id + 1]
+        if len(pages) == 0:
+            return False
+        chunk_size = self.chunk_sizes[class_id]
+        page_offset = self.data_offset + random.choice(pages) * self.page_size
+        victim = None
+        for i in range(EVICTION_SAMPLES):
+            offset = page_offset + random.randrange(self.page_size // chunk_size) * chunk_size
+            header = self.read_header(offset)
+            if header[5] == 0:
+                # Free chunk
+                continue
+            if victim is None or self.score(header) < victim[0]:
+                victim = (self.score(header), offset, header)
+        if victim is None:
+            return True
+        (score, offset, header) = victim
+        key = self.read_key(offset)
+        stripe = header[9]
+        if stripe >= self.n_stripes:
+            # Chunk being written by another process
+            return True
+        freed = []
+        with self.stripe_locks[stripe]:
+            (bucket, found) = self.find(stripe, header[2], key)
+            # It may have been removed (or not linked yet) since it was sampled
+            if found == offset:
+                freed.append(self.unlink(stripe, bucket, offset, eviction=True))
+        self.free_chunks(freed)
+        return True
+
+    # ------------------------------------------------------------------------------------------
+    # OPERATIONS
+    # ------------------------------------------------------------------------------------------
+    def put(self, element_id, user_id, data_type, value, codec, flags, deadline):
+        """
+        Stores an element replacing the previous one for the key. Returns the list of
+        evicted keys (user_id, element_id).
+        """
+        self.check_fork()
+        (key, key_hash, stripe) = self.make_key(element_id, user_id)
+        data_type = (str(data_type) if data_type is not None else "").encode("utf-8")
+        offset = self.allocate(ITEM_SIZE + len(key) + len(data_type) + len(value))
+        # The chunk is not reachable by other processes until it is in the index
+        pack_into(ITEM_FORMAT, self.mm, offset, deadline, time.time(), key_hash, 0, len(value), len(key), len(data_type), codec, flags, stripe, 0, 0)
+        start = offset + ITEM_SIZE
+        self.mm[start:start + len(key) + len(data_type) + len(value)] = key + data_type + value
+        freed = []
+        evicted = []
+        with self.stripe_locks[stripe]:
+            (bucket, old_offset) = self.find(stripe, key_hash, key)
+            if old_offset:
+                freed.append(self.unlink(stripe, bucket, old_offset))
+            else:
+                counters = self.get_counters(stripe)
+                if counters[0] + counters[5] + 1 > self.n_buckets * 3 // 4:
+                    if counters[5] > 0:
+                        self.rehash(stripe)
+                    if self.get_counters(stripe)[0] + 1 > self.n_buckets * 3 // 4:
+                        # The table of the stripe is full
+                        victim = self.sample_victim(stripe)
+                        evicted.append(self.parse_key(self.read_key(victim[1])))
+                        freed.append(self.unlink(stripe, victim[0], victim[1], eviction=True))
+                    (bucket, old_offset) = self.find(stripe, key_hash, key)
+            reused = unpack_from(BUCKET_FORMAT, self.mm, bucket)[1] == TOMBSTONE
+            pack_into(BUCKET_FORMAT, self.mm, bucket, key_hash, offset)
+            self.link_type(stripe, offset)
+            self.update_counters(stripe, elems=1, n_bytes=len(value), bytes_general=len(value) if user_id is None else 0, tombstones=-1 if reused else 0)
+            # Global limits, victims are chosen in this stripe
+            while (self.max_elems and self.count_elems() > self.max_elems) or (self.max_bytes and self.count_bytes() > self.max_bytes):
+                victim = self.sample_victim(stripe, exclude=offset)
+                if victim is None:
+                    break
+                evicted.append(self.parse_key(self.read_key(victim[1])))
+                freed.append(self.unlink(stripe, victim[0], victim[1], eviction=True))
+        self.free_chunks(freed)
+        return evicted
+
+    def get(self, element_id, user_id=None, now=None, deadline=None, remove=False):
+        """
+        Returns the tuple (codec, flags, value) for the element (None if not found or
+        expired), resetting its timeout to deadline or removing it if requested.
+        """
+        self.check_fork()
+        (key, key_hash, stripe) = self.make_key(element_id, user_id)
+        now = now or time.time()
+        result = None
+        freed = []
+        with self.stripe_locks[stripe]:
+            (bucket, offset) = self.find(stripe, key_hash, key)
+            if offset:
+                header = self.read_header(offset)
+                if header[0] < now or remove:
+                    freed.append(self.unlink(stripe, bucket, offset))
+                if header[0] >= now:
+                    (key, data_type, codec, flags, value) = self.read_item(offset)
+                    result = (codec, flags, value)
+                    if not remove:
+                        self.touch(offset, now)
+                        if deadline is not None:
+                            pack_into('<d', self.mm, offset, deadline)
+        self.free_chunks(freed)
+        return result
+
+    def get_type(self, data_type, user_id=None, now=None, deadline=None):
+        """
+        Returns the list of (element_id, codec, flags, value) for the elements of the given type.
+        """
+        self.check_fork()
+        stripes = range(self.n_stripes) if user_id is None else [self.get_user_stripe(user_id)]
+        type_key = self.make_type_key(str(data_type).encode("utf-8"), user_id)
+        now = now or time.time()
+        result = []
+        freed = []
+        for stripe in stripes:
+            with self.stripe_locks[stripe]:
+                for offset in self.find_type_items(stripe, type_key):
+                    header = self.read_header(offset)
+                    if header[0] < now:
+                        freed.append(self.unlink(stripe, self.find(stripe, header[2], self.read_key(offset))[0], offset))
+                        continue
+                    (key, item_type, codec, flags, value) = self.read_item(offset)
+                    self.touch(offset, now)
+                    if deadline is not None:
+                        pack_into('<d', self.mm, offset, deadline)
+                    result.append((self.parse_key(key)[1], codec, flags, value))
+        self.free_chunks(freed)
+        return result
+
+    def reset(self, element_id, deadline, user_id=None):
+        self.check_fork()
+        (key, key_hash, stripe) = self.make_key(element_id, user_id)
+        with self.stripe_locks[stripe]:
+            (bucket, offset) = self.find(stripe, key_hash, key)
+            if not offset:
+                return False
+            pack_into('<d', self.mm, offset, deadline)
+            return True
+
+    def count_by_type(self, user_id=None):
+        self.check_fork()
+        stripes = range(self.n_stripes) if user_id is None else [self.get_user_stripe(user_id)]
+        result = {}
+        for stripe in stripes:
+            with self.stripe_locks[stripe]:
+                for (first, n_items) in self.iter_type_slots(stripe):
+                    if self.mm[first + FLAGS_OFFSET] & FLAG_TYPE_OVERFLOW:
+                        # Items of several data_types, counted one by one
+                        keys = [self.parse_key(self.read_type_key(offset)) for offset in self.iter_type_items(first)]
+                    else:
+                        keys = [self.parse_key(self.read_type_key(first))] * n_items
+                    for (item_user_id, data_type) in keys:
+                        if item_user_id == user_id:
+                            result[data_type] = result.get(data_type, 0) + 1
+        return result
+
+    def clean(self, now, batch_size=1000):
+        """
+        Removes the expired elements, visiting batch_size buckets per lock. Only one
+        process cleans at a time. Returns the list of removed keys (user_id, element_id).
+        """
+        self.check_fork()
+        if not self.clean_lock.acquire(blocking=False):
+            return []
+        removed = []
+        try:
+            for stripe in range(self.n_stripes):
+                for start in range(0, self.n_buckets, batch_size or self.n_buckets):
+                    freed = []
+                    with self.stripe_locks[stripe]:
+                        for (bucket, offset) in list(self.iter_buckets(stripe, start, start + (batch_size or self.n_buckets))):
+                            if self.read_header(offset)[0] < now:
+                                removed.append(self.parse_key(self.read_key(offset)))
+                                freed.append(self.unlink(stripe, bucket, offset))
+                    self.free_chunks(freed)
+                with self.stripe_locks[stripe]:
+                    if self.get_counters(stripe)[5] > self.n_buckets // 4:
+                        self.rehash(stripe)
+        finally:
+            self.clean_lock.release()
+        return removed
+
+    def count_elems(self):
+        return sum(self.get_counters(stripe)[0] for stripe in range(self.n_stripes))
+
+    def count_bytes(self):
+        return sum(self.get_counters(stripe)[1] for stripe in range(self.n_stripes))
+
+    def get_user_bytes(self, user_id):
+        self.check_fork()
+        stripe = self.get_user_stripe(user_id)
+        total = 0
+        with self.stripe_locks[stripe]:
+            for (bucket, offset) in self.iter_buckets(stripe):
+                if self.parse_key(self.read_key(offset))[0] == user_id:
+                    total += self.read_header(offset)[4]
+        return total
+
+    def items(self):
+        """
+        Yields (user_id, element_id, deadline, data_type, codec, flags, value) for all the
+        elements, copying those of each stripe while holding its lock.
+        """
+        self.check_fork()
+        for stripe in range(self.n_stripes):
+            with self.stripe_locks[stripe]:
+                items = []
+                for (bucket, offset) in self.iter_buckets(stripe):
+                    (key, data_type, codec, flags, value) = self.read_item(offset)
+                    items.append(self.parse_key(key) + (self.read_header(offset)[0], data_type.decode("utf-8") or None, codec, flags, value))
+            for item in items:
+                yield item
+
+    def get_stats(self):
+        counters = [self.get_counters(stripe) for stripe in range(self.n_stripes)]
+        return {
+            "elements": sum(counter[0] for counter in counters),
+            "bytes": sum(counter[1] for counter in counters),
+            "bytes_general": sum(counter[2] for counter in counters),
+            "evictions_general": sum(counter[3] for counter in counters),
+            "evictions_user": sum(counter[4] for counter in counters),
+            "pages": unpack_from('<Q', self.mm, PAGES_USED_OFFSET)[0],
+            "max_pages": self.n_pages
+        }
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+
+class SharedPySiCa(PySiCa):
+    """
+    PySiCa keeping the elements in a SharedStore, so all the processes using the same
+    file (e.g. forked uwsgi workers) share the cache. Values are always encoded (at
+    least marshalled) because they are stored as bytes.
+
+    Metrics are kept by each process. Gets by id and cleanings do not read the type of
+    the elements (labelled with the data_type of the request, if any) and the elements
+    found expired by a get are counted as misses.
+    """
+
+    def __init__(self, path="/dev/shm/pysica.cache", size=64 * 1024 * 1024, page_size=1024 * 1024, timeout=10, compress=True, max_elems=0, clean_interval=30, logger=None, max_bytes=0, eviction_policy="lru", codec="zlib", compress_level=1, compress_min_size=1024, stripes=16, clean_batch_size=1000, snapshot_file=None, snapshot_interval=0,
+                 oplog_file=None, oplog_fsync="everysec", oplog_interval=1.0, oplog_compact_size=64 * 1024 * 1024, metrics=True,
+                 log_sample_rate=1.0, log_max_per_second=0, metrics_max_data_types=100):
+        if oplog_file:
+            # Processes would append to the log in any order, use snapshots instead
+            raise Exception("The operation log (" + str(oplog_file) + ") is not available for the shared storage, use a snapshot file instead")
+        self.store = SharedStore(path, size=int(size), page_size=int(page_size), stripes=max(1, int(stripes or 1)),
+                                 capacity=max_elems or int(size) // 1024, max_elems=max_elems, max_bytes=max_bytes, eviction_policy=eviction_policy)
+        super(SharedPySiCa, self).__init__(timeout=timeout, compress=compress, max_elems=max_elems, clean_interval=clean_interval, logger=logger,
+                                           max_bytes=max_bytes, eviction_policy=eviction_policy, codec=codec, compress_level=compress_level,
+                                           compress_min_size=compress_min_size, stripes=1, clean_batch_size=clean_batch_size,
+                                           snapshot_file=snapshot_file, snapshot_interval=snapshot_interval, metrics=metrics,
+                                           log_sample_rate=log_sample_rate, log_max_per_second=log_max_per_second, metrics_max_data_types=metrics_max_data_types)
+
+    def add(self, element_id, data, data_type, timeout=None, compress=None, user_id=None, raw=False):
+        start = time.perf_counter()
+        try:
+            if compress is None:
+                compress = self.options.get("compress", True)
+            # Sampled once, the evictions of this operation are logged with it
+            log = self.log_operation()
+            if log:
+                self.logger.info("Storing new element in shared cache %s%s%s", self.id, " (compressed)" if compress and not raw else "", " for user " + user_id if user_id is not None else "")
+            if raw:
+                (codec, value, flags) = ("marshal", check_raw_value(data).encode("utf-8"), FLAG_RAW)
+            else:
+                (codec, value) = self.encode_data(data, compress if compress else "marshal")
+                flags = 0
+            max_bytes = self.options.get("max_bytes")
+            if max_bytes and len(value) > max_bytes:
+                raise Exception("element size (" + str(len(value)) + " bytes) exceeds the max size for the cache")
+            self.store.max_elems = self.options.get("max_elems")
+            self.store.max_bytes = max_bytes
+            evicted = self.store.put(str(element_id), user_id, data_type, value, CODEC_NAMES.index(codec), flags, self.get_deadline(timeout))
+            self.changes += 1
+            for (evicted_user_id, evicted_id) in evicted:
+                if log:
+                    self.logger.info("Evicting item %s from shared cache %s%s", evicted_id, self.id, " for user " + evicted_user_id if evicted_user_id is not None else "")
+            self.print_memory_usage()
+            if self.metrics is not None:
+                self.metrics.record("add", "general" if user_id is None else "user", data_type, 1, 0, len(value), time.perf_counter() - start)
+            return True
+        except Exception as e:
+            self.logger.error("Unable to add new element to shared cache %s: %s", self.id, e)
+            if self.metrics is not None:
+                self.metrics.record("add", "general" if user_id is None else "user", data_type, 0, 1, 0, time.perf_counter() - start)
+            return False
+
+    def get_elem(self, element_id=None, data_type=None, user_id=None, reset_timeout=False, timeout=None):
+        start = time.perf_counter()
+        result = []
+        now = time.time()
+        deadline = self.get_deadline(timeout) if reset_timeout else None
+        if element_id is not None:
+            item = self.store.get(element_id, user_id, now, deadline)
+            if item is not None:
+                if self.log_operation():
+                    self.logger.info("Getting element from shared cache with ID %s", self.id)
+                result.append(self.decode_item(*item))
+                if self.metrics is not None:
+                    self.metrics.record("get_elem", "general" if user_id is None else "user", data_type, 1, 0, len(item[2]), time.perf_counter() - start)
+                return result
+            if self.metrics is not None:
+                self.metrics.record("get_elem", "general" if user_id is None else "user", data_type, 0, 1, 0, time.perf_counter() - start)
+        if data_type is not None:
+            result.extend(self.iter_type(data_type, user_id=user_id, reset_timeout=reset_timeout, timeout=timeout))
+        return result
+
+    def iter_type(self, data_type, user_id=None, reset_timeout=False, timeout=None):
+        if self.log_operation():
+            self.logger.info("Getting all elements from shared cache for type %s", data_type)
+        deadline = self.get_deadline(timeout) if reset_timeout else None
+        (hits, n_bytes, elapsed) = (0, 0, 0.0)
+        start = time.perf_counter()
+        try:
+            # Values are copied (encoded) from the store, they are decoded as they are consumed
+            items = self.store.get_type(data_type, user_id, time.time(), deadline)
+            elapsed += time.perf_counter() - start
+            for (element_id, codec, flags, value) in items:
+                start = time.perf_counter()
+                item = {"id": element_id, "data": self.decode_item(codec, flags, value)}
+                hits += 1
+                n_bytes += len(value)
+                elapsed += time.perf_counter() - start
+                yield item
+        finally:
+            if self.metrics is not None:
+                self.metrics.record("get_elem", "general" if user_id is None else "user", data_type, hits, 0 if hits > 0 else 1, n_bytes, elapsed)
+
+    def iter_elements(self, lock=True):
+        for (user_id, element_id, deadline, data_type, codec, flags, value) in self.store.items():
+            elem = {"timeout": deadline, "data_type": data_type}
+            if flags & FLAG_RAW:
+                elem.update(compressed=False, raw=True, data=value.decode("utf-8"))
+            else:
+                elem.update(compressed=True, codec=CODEC_NAMES[codec], data=value)
+            yield user_id, element_id, elem
+
+    def load_element(self, element_id, elem, user_id=None):
+        if elem.get("raw"):
+            (codec, flags, value) = (0, FLAG_RAW, elem.get("data").encode("utf-8"))
+        elif elem.get("compressed"):
+            (codec, flags, value) = (CODEC_NAMES.index(elem.get("codec", "marshal")), 0, elem.get("data"))
+        else:
+            (codec, flags, value) = (0, 0, marshal.dumps(elem.get("data")))
+        self.store.put(str(element_id), user_id, elem.get("data_type"), value, codec, flags, elem.get("timeout"))
+
+    def save_snapshot(self, path=None, fork=True, force=True):
+        # The file is shared by the processes (not copied on write by fork), so the
+        # elements are copied stripe by stripe under their locks instead
+        return super(SharedPySiCa, self).save_snapshot(path=path, fork=False, force=force)
+
+    def load_snapshot(self, path=None):
+        # Only the process that created the shared file loads the snapshot
+        if not self.store.created:
+            return 0
+        return super(SharedPySiCa, self).load_snapshot(path=path)
+
+    def decode_item(self, codec, flags, value):
+        if flags & FLAG_RAW:
+            return self.decode_data({"raw": True, "data": value.decode("utf-8")})
+        return self.decode_data({"compressed": True, "codec": CODEC_NAMES[codec], "data": value})
+
+    def count_by_type(self, data_type=None, user_id=None):
+        result = self.store.count_by_type(user_id)
+        if data_type is not None:
+            return result.get(data_type, 0)
+        return result
+
+    def remove(self, element_id, user_id=None):
+        start = time.perf_counter()
+        item = self.store.get(element_id, user_id, remove=True)
+        if item is None:
+            if self.metrics is not None:
+                self.metrics.record("remove", "general" if user_id is None else "user", None, 0, 1, 0, time.perf_counter() - start)
+            return []
+        self.changes += 1
+        if self.log_operation():
+            self.logger.info("Deleting element from shared cache %s (element id: %s)", self.id, element_id)
+        self.print_memory_usage()
+        result = [self.decode_item(*item)]
+        if self.metrics is not None:
+            self.metrics.record("remove", "general" if user_id is None else "user", None, 1, 0, len(item[2]), time.perf_counter() - start)
+        return result
+
+    def reset_timeout(self, element_id, timeout=None, user_id=None):
+        start = time.perf_counter()
+        try:
+            found = self.store.reset(element_id, self.get_deadline(timeout), user_id)
+            if self.metrics is not None:
+                self.metrics.record("reset_timeout", "general" if user_id is None else "user", None, 1 if found else 0, 0 if found else 1, 0, time.perf_counter() - start)
+            if found:
+                self.changes += 1
+            if self.log_operation():
+                if found:
+                    self.logger.info("Resetting timeout for element %s in shared cache %s%s", element_id, self.id, " for user " + user_id if user_id is not None else "")
+                else:
+                    self.logger.info("Element %s not found in shared cache %s%s", element_id, self.id, " for user " + user_id if user_id is not None else "")
+            return found
+        except:
+            return False
+
+    def clean_cache(self):
+        self.logger.debug("Cleaning shared cache %s", self.id)
+        start = time.perf_counter()
+        for (user_id, key) in self.store.clean(time.time(), self.options.get("clean_batch_size")):
+            if self.log_operation():
+                self.logger.info("Removing item %s from %sshared cache %s", key, user_id + "'s " if user_id is not None else "", self.id)
+            if self.metrics is not None:
+                self.metrics.record("clean_cache", "general" if user_id is None else "user", None, 0, 0, 0, None, 1)
+        if self.metrics is not None:
+            self.metrics.record("clean_cache", "all", None, 0, 0, 0, time.perf_counter() - start)
+        self.print_memory_usage()
+
+    def count_elems(self):
+        return self.store.count_elems()
+
+    def count_bytes(self):
+        return self.store.count_bytes()
+
+    def get_stats(self):
+        stats = self.store.get_stats()
+        return {
+            "elements": stats.get("elements"),
+            "bytes": stats.get("bytes"),
+            "bytes_general": stats.get("bytes_general"),
+            "bytes_user": stats.get("bytes") - stats.get("bytes_general"),
+            "evictions": stats.get("evictions_general") + stats.get("evictions_user"),
+            "evictions_general": stats.get("evictions_general"),
+            "evictions_user": stats.get("evictions_user"),
+            "stripes": self.store.n_stripes,
+            "pages": stats.get("pages"),
+            "max_pages": stats.get("max_pages")
+        }
+
+    def get_cache_bytes(self, user_id=None, general=False):
+        if general:
+            return self.store.get_stats().get("bytes_general")
+        if user_id is not None:
+            return self.store.get_user_bytes(user_id)
+        return self.store.count_bytes()
@@ -0,0 +1,128 @@
+"""
+PySiCa, a simple Python Cache system
+
+Snapshots of the cache, used to keep the elements when the server restarts.
+
+A snapshot starts with a header (magic, version, creation time and number of
+entries) followed by the entries: a fixed size header (deadline, flags, codec and
+lengths) and the element id, the user id and data_type (marshalled) and the value.
+Values are stored as they are kept in the cache (already encoded if compressed).
+"""
+
+import marshal
+import mmap
+import os
+import time
+from struct import pack, unpack_from, calcsize
+
+MAGIC = b'PSSN'
+VERSION = 1
+# magic, version, creation time, number of entries
+HEADER_FORMAT = '<4sIdQ'
+HEADER_SIZE = calcsize(HEADER_FORMAT)
+# deadline, flags, codec, element id length, user id length, data_type length, value length
+ENTRY_FORMAT = '<dBBHHHI'
+ENTRY_SIZE = calcsize(ENTRY_FORMAT)
+FLAG_COMPRESSED = 0x01
+FLAG_RAW = 0x02
+CODEC_NAMES = ["marshal", "zlib", "lzma"]
+
+
+def pack_entry(user_id, element_id, elem):
+    """
+    Returns the bytes for an element (entry header, element id, user id, data_type and value).
+    """
+    (flags, codec, data) = (0, 0, elem.get("data"))
+    if elem.get("raw"):
+        (flags, data) = (FLAG_RAW, data.encode("utf-8"))
+    elif elem.get("compressed"):
+        (flags, codec) = (FLAG_COMPRESSED, CODEC_NAMES.index(elem.get("codec", "marshal")))
+    else:
+        data = marshal.dumps(data)
+    key = str(element_id).encode("utf-8")
+    user = marshal.dumps(user_id)
+    data_type = marshal.dumps(elem.get("data_type"))
+    return pack(ENTRY_FORMAT, elem.get("timeout"), flags, codec, len(key), len(user), len(data_type), len(data)) + key + user + data_type + data
+
+
+def get_entry_size(data, offset):
+    (deadline, flags, codec, key_length, user_length, type_length, data_length) = unpack_from(ENTRY_FORMAT, data, offset)
+    return ENTRY_SIZE + key_length + user_length + type_length + data_length
+
+
+def unpack_entry(data, offset):
+    """
+    Returns the tuple (user_id, element_id, elem) for the entry at offset.
+    """
+    (deadline, flags, codec, key_length, user_length, type_length, data_length) = unpack_from(ENTRY_FORMAT, data, offset)
+    start = offset + ENTRY_SIZE
+    element_id = data[start:start + key_length].decode("utf-8")
+    start += key_length
+    user_id = marshal.loads(data[start:start + user_length])
+    start += user_length
+    elem = {
+        "timeout": deadline,
+        "compressed": bool(flags & FLAG_COMPRESSED),
+        "data_type": marshal.loads(data[start:start + type_length])
+    }
+    start += type_length
+    value = data[start:start + data_length]
+    if flags & FLAG_RAW:
+        elem["data"] = value.decode("utf-8")
+        elem["raw"] = True
+    elif flags & FLAG_COMPRESSED:
+        elem["data"] = value
+        elem["codec"] = CODEC_NAMES[codec]
+    else:
+        elem["data"] = marshal.loads(value)
+    return user_id, element_id, elem
+
+
+def write_snapshot(elements, path):
+    """
+    Writes the elements, tuples (user_id, element_id, elem), to path. The snapshot is
+    written to a temporary file and then renamed, so the previous snapshot is kept if
+    something fails. Returns the number of entries.
+    """
+    tmp_path = path + "." + str(os.getpid()) + ".tmp"
+    count = 0
+    try:
+        with open(tmp_path, "wb") as output:
+            output.write(pack(HEADER_FORMAT, MAGIC, VERSION, time.time(), 0))
+            for (user_id, element_id, elem) in elements:
+                output.write(pack_entry(user_id, element_id, elem))
+                count += 1
+            output.seek(0)
+            output.write(pack(HEADER_FORMAT, MAGIC, VERSION, time.time(), count))
+            output.flush()
+            os.fsync(output.fileno())
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return count
+
+
+def read_snapshot(path, now=None):
+    """
+    Yields the tuples (user_id, element_id, elem) stored in the snapshot, skipping the
+    expired ones. The file is mapped in memory and only the valid entries are copied.
+    """
+    now = now or time.time()
+    with open(path, "rb") as input_file:
+        if os.fstat(input_file.fileno()).st_size < HEADER_SIZE:
+            raise Exception("Invalid snapshot file " + path)
+        data = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        (magic, version, created, count) = unpack_from(HEADER_FORMAT, data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise Exception("Invalid snapshot file " + path)
+        offset = HEADER_SIZE
+        for i in range(count):
+            entry_offset = offset
+            offset += get_entry_size(data, offset)
+            if unpack_from('<d', data, entry_offset)[0] < now:
+                continue
+            yield unpack_entry(data, entry_offset)
+    finally:
+        data.close()
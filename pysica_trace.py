@@ -0,0 +1,184 @@
+"""
+PySiCa, a simple Python Cache system
+
+Tracing of the requests served by the servers and a sampling profiler.
+
+A RequestTrace keeps the duration of each phase of a request (e.g. recv, decompress,
+loads, cache, dumps, compress, send), requests slower than a threshold are logged
+with this breakdown. Tracing is disabled by default and can be enabled at runtime.
+
+The SamplingProfiler takes the stacks of all the threads at a fixed interval for some
+seconds and writes them collapsed (the frames of each stack separated by ";" and the
+number of samples), the format used by flamegraph.pl and speedscope. Stacks are taken
+from the running process (wall-clock), so threads waiting for requests are included.
+"""
+
+import itertools
+import os
+import sys
+import threading
+import time
+
+
+class RequestTrace(object):
+
+    def __init__(self, trace_id, request_id=None, start=None):
+        self.trace_id = trace_id
+        # Request id sent by the client (e.g. the id of a version 2 frame), if any
+        self.request_id = request_id
+        self.target = None
+        self.start = start if start is not None else time.perf_counter()
+        self.last = self.start
+        self.phases = []
+
+    def mark(self, phase):
+        """
+        Ends a phase, its duration is the time since the previous mark.
+        """
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def get_duration(self):
+        return self.last - self.start
+
+    def get_phases(self):
+        """
+        Returns the duration of each phase in seconds, phases repeated (e.g. the frames
+        of a streamed respond) are added up.
+        """
+        result = {}
+        for (phase, duration) in self.phases:
+            result[phase] = result.get(phase, 0.0) + duration
+        return result
+
+    def __str__(self):
+        phases = " ".join("%s=%.3f" % (phase, duration * 1000) for (phase, duration) in self.phases)
+        request_id = " (client id " + str(self.request_id) + ")" if self.request_id is not None else ""
+        return "Request " + str(self.trace_id) + request_id + " " + str(self.target) + ": %.3f ms [%s]" % (self.get_duration() * 1000, phases)
+
+
+class NullTrace(object):
+    """
+    Trace used while tracing is disabled, marks are ignored.
+    """
+    trace_id = None
+    request_id = None
+    target = None
+
+    def mark(self, phase):
+        pass
+
+
+NO_TRACE = NullTrace()
+
+
+class Tracer(object):
+
+    def __init__(self, logger, enabled=False, slow_threshold=0.1):
+        self.logger = logger
+        self.enabled = enabled
+        # Seconds, slower requests are logged with their phases (all of them if 0)
+        self.slow_threshold = slow_threshold
+        self.ids = itertools.count(1)
+
+    def configure(self, enabled=None, slow_threshold=None):
+        if enabled is not None:
+            self.enabled = bool(enabled)
+        if slow_threshold is not None:
+            self.slow_threshold = float(slow_threshold)
+        self.logger.info("Request tracing " + ("enabled" if self.enabled else "disabled") + " (slow requests over " + str(self.slow_threshold) + " s)")
+        return {"enabled": self.enabled, "slow_threshold": self.slow_threshold}
+
+    def start(self, request_id=None, start=None):
+        """
+        Returns a new trace for a request (NO_TRACE if tracing is disabled). start is the
+        perf_counter time when the request started to be received, now if not given.
+        """
+        if not self.enabled:
+            return NO_TRACE
+        return RequestTrace(next(self.ids), request_id, start)
+
+    def finish(self, trace, target=None):
+        if trace is NO_TRACE:
+            return
+        if target is not None:
+            trace.target = target
+        # Time since the last phase (e.g. the framework handling the request)
+        trace.mark("other")
+        if trace.get_duration() >= self.slow_threshold:
+            if self.slow_threshold > 0:
+                self.logger.warning("Slow request. " + str(trace))
+            else:
+                self.logger.info(str(trace))
+
+
+class SamplingProfiler(object):
+
+    def __init__(self, logger, directory="/tmp", interval=0.01, max_time=60):
+        self.logger = logger
+        self.directory = directory
+        # Seconds between samples and max duration of a profile (0 disables the profiler)
+        self.interval = interval
+        self.max_time = max_time
+        self.lock = threading.Lock()
+        self.thread = None
+        self.path = None
+
+    def start(self, seconds):
+        """
+        Starts profiling for the given seconds in a background thread, returns the path
+        of the file where the collapsed stacks are written when done.
+        """
+        seconds = float(seconds)
+        if not self.max_time:
+            raise Exception("The profiler is disabled")
+        if seconds <= 0 or seconds > self.max_time:
+            raise Exception("Profiling time must be between 0 and " + str(self.max_time) + " seconds")
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                raise Exception("The profiler is already running (" + self.path + ")")
+            self.path = os.path.join(self.directory, "pysica-profile-" + str(os.getpid()) + "-" + time.strftime("%Y%m%d-%H%M%S") + ".folded")
+            self.thread = threading.Thread(target=self.run, args=(seconds, self.path), name="pysica-profiler")
+            self.thread.daemon = True
+            self.thread.start()
+        self.logger.info("Profiling for " + str(seconds) + " s, collapsed stacks will be written to " + self.path)
+        return self.path
+
+    def run(self, seconds, path):
+        try:
+            stacks = {}
+            samples = 0
+            own_id = threading.current_thread().ident
+            # Labels of the code objects, so each frame is formatted once
+            labels = {}
+            end = time.time() + seconds
+            while time.time() < end:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for (thread_id, frame) in sys._current_frames().items():
+                    if thread_id == own_id:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        label = labels.get(code)
+                        if label is None:
+                            label = labels[code] = code.co_name + " (" + os.path.basename(code.co_filename) + ":" + str(code.co_firstlineno) + ")"
+                        stack.append(label)
+                        frame = frame.f_back
+                    stack.append(names.get(thread_id, "thread-" + str(thread_id)))
+                    key = ";".join(reversed(stack))
+                    stacks[key] = stacks.get(key, 0) + 1
+                samples += 1
+                time.sleep(self.interval)
+            with open(path + ".tmp", "w") as output:
+                for (stack, count) in sorted(stacks.items()):
+                    output.write(stack + " " + str(count) + "\n")
+            os.rename(path + ".tmp", path)
+            self.logger.info("Profile written to " + path + " (" + str(samples) + " samples)")
+        except Exception as e:
+            self.logger.error("Unable to write profile " + path + ". Error message: " + str(e))
+
+    def get_status(self):
+        with self.lock:
+            return {"running": self.thread is not None and self.thread.is_alive(), "file": self.path}
@@ -10,7 +10,11 @@ import ujson
 import logging.config
 from logging.handlers import RotatingFileHandler
 from shutil import copyfile
-from pysica import PySiCa
+from pysica import PySiCa, check_raw_value, dumps_respond, run_batch, iter_ndjson
+from pysica_shm import SharedPySiCa
+from pysica_metrics import format_prometheus
+from pysica_trace import Tracer, SamplingProfiler
+from pysica_logging import start_queue_logging
 
 
 class Application(object):
@@ -24,41 +28,94 @@ class Application(object):
         # Enable the logging to file for production
         self.logger= self.configure_logging()
         # Create the instance for the cache
-        self.cache_instance = PySiCa(
+        options = dict(
             logger=self.logger,
             timeout=self.settings.get("TIMEOUT"),
             compress=self.settings.get("COMPRESS"),
+            codec=self.settings.get("CODEC"),
+            compress_level=self.settings.get("COMPRESS_LEVEL"),
+            compress_min_size=self.settings.get("COMPRESS_MIN_SIZE"),
             max_elems=self.settings.get("MAX_ELEMS"),
-            clean_interval=self.settings.get("CLEAN_INTERVAL")
+            max_bytes=self.settings.get("MAX_BYTES"),
+            eviction_policy=self.settings.get("EVICTION_POLICY"),
+            clean_interval=self.settings.get("CLEAN_INTERVAL"),
+            stripes=self.settings.get("STRIPES"),
+            clean_batch_size=self.settings.get("CLEAN_BATCH_SIZE"),
+            snapshot_file=os.path.join(self.settings.get("TMP_DIRECTORY"), self.settings.get("SNAPSHOT_FILE")) if self.settings.get("SNAPSHOT_FILE") else None,
+            snapshot_interval=self.settings.get("SNAPSHOT_INTERVAL"),
+            oplog_file=os.path.join(self.settings.get("TMP_DIRECTORY"), self.settings.get("OPLOG_FILE")) if self.settings.get("OPLOG_FILE") else None,
+            oplog_fsync=self.settings.get("OPLOG_FSYNC"),
+            oplog_interval=self.settings.get("OPLOG_INTERVAL"),
+            oplog_compact_size=self.settings.get("OPLOG_COMPACT_SIZE"),
+            metrics=self.settings.get("METRICS"),
+            metrics_max_data_types=self.settings.get("METRICS_MAX_DATA_TYPES"),
+            log_sample_rate=self.settings.get("LOG_SAMPLE_RATE"),
+            log_max_per_second=self.settings.get("LOG_MAX_PER_SECOND")
         )
+        if self.settings.get("STORAGE") == "shared":
+            # Elements in shared memory, several processes can serve the same cache
+            self.cache_instance = SharedPySiCa(path=self.settings.get("SHARED_FILE"), size=self.settings.get("SHARED_SIZE"), page_size=self.settings.get("SHARED_PAGE_SIZE"), **options)
+        else:
+            self.cache_instance = PySiCa(**options)
+        # Phases of the requests (opt-in) and profiler, both can be enabled at runtime
+        self.tracer = Tracer(self.logger, enabled=self.settings.get("SERVER_TRACE"), slow_threshold=self.settings.get("SERVER_SLOW_REQUEST_THRESHOLD"))
+        self.profiler = SamplingProfiler(self.logger, directory=self.settings.get("TMP_DIRECTORY"), interval=self.settings.get("SERVER_PROFILE_INTERVAL"), max_time=self.settings.get("SERVER_PROFILE_MAX_TIME"))
 
     def on_get(self, req, resp, element_id=None):
+        trace = req.context["trace"]
         try:
             data_type = req.params.get('data_type')
             user_id   = req.params.get('user_id')
             reset_timeout = req.params.get('reset_timeout', False)
             timeout   = req.params.get('timeout')
 
+            if element_id is None and data_type is not None and req.get_param_as_bool('stream'):
+                # Streamed respond: an element per line and a summary line at the end
+                items = self.cache_instance.iter_type(data_type, user_id=user_id, reset_timeout=reset_timeout, timeout=timeout)
+                resp.status = falcon.HTTP_200
+                resp.content_type = "application/x-ndjson"
+                resp.stream = iter_ndjson(items, self.dumps, self.settings.get("SERVER_STREAM_CHUNK_SIZE"))
+                return
+
             result = self.cache_instance.get_elem(element_id, data_type=data_type, user_id=user_id, reset_timeout=reset_timeout, timeout=timeout)
+            trace.mark("cache")
             resp.status = falcon.HTTP_200
             if len(result) > 0:
-                resp.body = ujson.dumps({'success': True, 'result': result}, ensure_ascii=False)
+                resp.body = dumps_respond({'success': True, 'result': result}, self.dumps)
             else:
                 resp.body = ujson.dumps({'success': False}, ensure_ascii=False)
+            trace.mark("dumps")
         except Exception as e:
             resp.status = falcon.HTTP_200
             resp.body = ujson.dumps({'success': False, 'message': "Failed while getting element. Error message: " + str(e)})
 
     def on_post(self, req, resp):
+        trace = req.context["trace"]
         try:
-            element_id = req.media.get("element_id")
-            data       = req.media.get("data")
-            data_type  = req.media.get("data_type")
-            user_id    = req.media.get("user_id")
-            timeout    = req.media.get("timeout")  # in minutes
-            compress   = req.media.get("compress")
+            if req.get_param_as_bool("raw"):
+                # Raw mode: the body is the encoded value, stored as it is once checked
+                element_id = req.params.get("element_id")
+                data       = check_raw_value(req.bounded_stream.read())
+                data_type  = req.params.get("data_type")
+                user_id    = req.params.get("user_id")
+                timeout    = req.params.get("timeout")  # in minutes
+                compress   = None
+                raw        = True
+            else:
+                element_id = req.media.get("element_id")
+                data       = req.media.get("data")
+                data_type  = req.media.get("data_type")
+                user_id    = req.media.get("user_id")
+                timeout    = req.media.get("timeout")  # in minutes
+                compress   = req.media.get("compress")
+                raw        = req.media.get("raw", False)
+                if raw:
+                    data = check_raw_value(data)
+            # Body read and parsed by falcon
+            trace.mark("body")
 
-            success = self.cache_instance.add(element_id, data, data_type, timeout=timeout, compress=compress, user_id=user_id)
+            success = self.cache_instance.add(element_id, data, data_type, timeout=timeout, compress=compress, user_id=user_id, raw=raw)
+            trace.mark("cache")
 
             resp.status = falcon.HTTP_200
             resp.body = ujson.dumps({'success': success, 'element_id': element_id})
@@ -67,14 +124,16 @@ class Application(object):
             resp.body = ujson.dumps({'success': False, 'message': "Failed while storing new element. Error message: " + str(e)})
 
     def on_delete(self, req, resp, element_id):
+        trace = req.context["trace"]
         try:
             user_id     = req.params.get("user_id", None)
             return_elem = req.params.get("return", False)
 
             result = self.cache_instance.remove(element_id, user_id=user_id)
+            trace.mark("cache")
 
             if return_elem:
-                resp.body = ujson.dumps({'success': len(result) > 0, 'result': result}, ensure_ascii=False)
+                resp.body = dumps_respond({'success': len(result) > 0, 'result': result}, self.dumps)
             else:
                 resp.body = ujson.dumps({'success': len(result) > 0}, ensure_ascii=False)
         except Exception as e:
@@ -82,11 +141,13 @@ class Application(object):
             resp.body = ujson.dumps({'success': False, 'message': "Failed while removing element. Error message: " + str(e)})
 
     def on_put(self, req, resp, element_id):
+        trace = req.context["trace"]
         try:
             timeout = req.params.get("timeout", None)
             user_id = req.params.get("user_id", None)
 
             result = self.cache_instance.reset_timeout(element_id, timeout=timeout, user_id=user_id)
+            trace.mark("cache")
 
             if result:
                 resp.body = ujson.dumps({'success': True}, ensure_ascii=False)
@@ -96,6 +157,55 @@ class Application(object):
             resp.status = falcon.HTTP_200
             resp.body = ujson.dumps({'success': False, 'message': "Failed while removing element. Error message: " + str(e)})
 
+    def on_batch(self, req, resp):
+        trace = req.context["trace"]
+        try:
+            request = req.media
+            trace.mark("body")
+            resp.status = falcon.HTTP_200
+            result = run_batch(self.cache_instance, request, max_size=self.settings.get("MAX_BATCH_SIZE"))
+            trace.mark("cache")
+            resp.body = dumps_respond({'success': True, 'result': result}, self.dumps)
+            trace.mark("dumps")
+        except Exception as e:
+            resp.status = falcon.HTTP_200
+            resp.body = ujson.dumps({'success': False, 'message': "Failed while running batch. Error message: " + str(e)})
+
+    def on_metrics(self, req, resp):
+        try:
+            resp.status = falcon.HTTP_200
+            resp.content_type = "text/plain; version=0.0.4"
+            resp.body = format_prometheus(self.cache_instance.get_metrics())
+        except Exception as e:
+            resp.status = falcon.HTTP_500
+            resp.content_type = "text/plain"
+            resp.body = "Failed while getting metrics. Error message: " + str(e)
+
+    def on_trace(self, req, resp):
+        try:
+            enabled = req.get_param_as_bool("enabled")
+            slow_threshold = req.params.get("slow_threshold")
+            resp.status = falcon.HTTP_200
+            resp.body = ujson.dumps({'success': True, 'result': self.tracer.configure(enabled=enabled, slow_threshold=slow_threshold)})
+        except Exception as e:
+            resp.status = falcon.HTTP_200
+            resp.body = ujson.dumps({'success': False, 'message': "Failed while configuring tracing. Error message: " + str(e)})
+
+    def on_profile(self, req, resp):
+        try:
+            seconds = req.params.get("seconds")
+            resp.status = falcon.HTTP_200
+            if seconds is None:
+                resp.body = ujson.dumps({'success': True, 'result': self.profiler.get_status()})
+            else:
+                resp.body = ujson.dumps({'success': True, 'result': {"running": True, "file": self.profiler.start(seconds)}})
+        except Exception as e:
+            resp.status = falcon.HTTP_200
+            resp.body = ujson.dumps({'success': False, 'message': "Failed while starting the profiler. Error message: " + str(e)})
+
+    def dumps(self, data):
+        return ujson.dumps(data, ensure_ascii=False)
+
     def read_settings_file(self):
         conf_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "conf/server.cfg")
         logging_conf_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "conf/logging.cfg")
@@ -115,12 +225,41 @@ class Application(object):
             settings["DEBUG"] = SERVER_SETTINGS.get('DEBUG', False)
             settings["TMP_DIRECTORY"] = SERVER_SETTINGS.get('TMP_DIRECTORY', "/tmp")
             settings["LOG_FILE"] = SERVER_SETTINGS.get('LOG_FILE', "/tmp/queue.log")
+            settings["LOG_QUEUE"] = SERVER_SETTINGS.get('LOG_QUEUE', True)
+            settings["MAX_BATCH_SIZE"] = int(SERVER_SETTINGS.get('MAX_BATCH_SIZE', 1000))
+            settings["SERVER_STREAM_CHUNK_SIZE"] = int(SERVER_SETTINGS.get('SERVER_STREAM_CHUNK_SIZE', 65536))
+            settings["SERVER_TRACE"] = SERVER_SETTINGS.get('SERVER_TRACE', False)
+            settings["SERVER_SLOW_REQUEST_THRESHOLD"] = float(SERVER_SETTINGS.get('SERVER_SLOW_REQUEST_THRESHOLD', 0.1))
+            settings["SERVER_PROFILE_INTERVAL"] = float(SERVER_SETTINGS.get('SERVER_PROFILE_INTERVAL', 0.01))
+            settings["SERVER_PROFILE_MAX_TIME"] = float(SERVER_SETTINGS.get('SERVER_PROFILE_MAX_TIME', 60))
+            settings["ADMIN_ENDPOINTS"] = SERVER_SETTINGS.get('ADMIN_ENDPOINTS', False)
 
             CACHE_SETTINGS = config.get("CACHE_SETTINGS", {})
             settings["TIMEOUT"] = CACHE_SETTINGS.get('TIMEOUT', 10)
             settings["COMPRESS"] = CACHE_SETTINGS.get('COMPRESS', True)
-            settings["MAX_ELEMS"] = CACHE_SETTINGS.get('MAX_ELEMS', 50)
+            settings["CODEC"] = CACHE_SETTINGS.get('CODEC', "zlib")
+            settings["COMPRESS_LEVEL"] = CACHE_SETTINGS.get('COMPRESS_LEVEL', 1)
+            settings["COMPRESS_MIN_SIZE"] = CACHE_SETTINGS.get('COMPRESS_MIN_SIZE', 1024)
+            settings["MAX_ELEMS"] = CACHE_SETTINGS.get('MAX_ELEMS', 0)
+            settings["MAX_BYTES"] = CACHE_SETTINGS.get('MAX_BYTES', 0)
+            settings["EVICTION_POLICY"] = CACHE_SETTINGS.get('EVICTION_POLICY', "lru")
             settings["CLEAN_INTERVAL"] = CACHE_SETTINGS.get('CLEAN_INTERVAL', 30)
+            settings["STRIPES"] = CACHE_SETTINGS.get('STRIPES', 16)
+            settings["CLEAN_BATCH_SIZE"] = CACHE_SETTINGS.get('CLEAN_BATCH_SIZE', 1000)
+            settings["STORAGE"] = CACHE_SETTINGS.get('STORAGE', "memory")
+            settings["SHARED_FILE"] = CACHE_SETTINGS.get('SHARED_FILE', "/dev/shm/pysica.cache")
+            settings["SHARED_SIZE"] = int(CACHE_SETTINGS.get('SHARED_SIZE', 64 * 1024 * 1024))
+            settings["SHARED_PAGE_SIZE"] = int(CACHE_SETTINGS.get('SHARED_PAGE_SIZE', 1024 * 1024))
+            settings["SNAPSHOT_FILE"] = CACHE_SETTINGS.get('SNAPSHOT_FILE', "")
+            settings["SNAPSHOT_INTERVAL"] = CACHE_SETTINGS.get('SNAPSHOT_INTERVAL', 300)
+            settings["OPLOG_FILE"] = CACHE_SETTINGS.get('OPLOG_FILE', "")
+            settings["OPLOG_FSYNC"] = CACHE_SETTINGS.get('OPLOG_FSYNC', "everysec")
+            settings["OPLOG_INTERVAL"] = float(CACHE_SETTINGS.get('OPLOG_INTERVAL', 1.0))
+            settings["OPLOG_COMPACT_SIZE"] = int(CACHE_SETTINGS.get('OPLOG_COMPACT_SIZE', 64 * 1024 * 1024))
+            settings["METRICS"] = CACHE_SETTINGS.get('METRICS', True)
+            settings["METRICS_MAX_DATA_TYPES"] = int(CACHE_SETTINGS.get('METRICS_MAX_DATA_TYPES', 100))
+            settings["LOG_SAMPLE_RATE"] = float(CACHE_SETTINGS.get('LOG_SAMPLE_RATE', 1.0))
+            settings["LOG_MAX_PER_SECOND"] = int(CACHE_SETTINGS.get('LOG_MAX_PER_SECOND', 0))
 
         # PREPARE LOGGING
         logging.config.fileConfig(logging_conf_path)
@@ -128,6 +267,7 @@ class Application(object):
         return settings
 
     def configure_logging(self):
+        logger = logging.root
         if not self.settings.get("DEBUG", True):
             try:
                 logger = logging.getLogger()
@@ -138,17 +278,98 @@ class Application(object):
                 handler.setLevel(logging.INFO)
                 handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(filename)s : %(funcName)s - %(message)s'))
                 logger.root.addHandler(handler)
-                return logger
+                # Debug messages are not written, skip them before building the records
+                logger.setLevel(logging.INFO)
             except Exception as e:
                 raise Exception("Unable to open log file " + self.settings.get("LOG_FILE", "LOG FILE NOT SPECIFIED") + ". Error message: " + str(e))
-        else:
-            return logging.root
+        if self.settings.get("LOG_QUEUE"):
+            # Records are written by a background thread, requests never wait for the disk
+            start_queue_logging(logger)
+        return logger
+
+class BatchResource(object):
+    """
+    Resource for /api/batch, runs several operations of the same type in a single request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def on_post(self, req, resp):
+        self.app.on_batch(req, resp)
+
+
+class TraceMiddleware(object):
+    """
+    Starts a trace for each request (see pysica_trace) and logs it if it is slow. The
+    id of the request is taken from the X-Request-Id header if sent. The respond is
+    sent by the WSGI server once the handler returns, so it is not part of the trace.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def process_request(self, req, resp):
+        req.context["trace"] = self.app.tracer.start(req.get_header("X-Request-Id"))
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        trace = req.context.get("trace")
+        if trace is not None:
+            self.app.tracer.finish(trace, req.method + " " + req.path)
+
+
+class MetricsResource(object):
+    """
+    Resource for /api/metrics, the metrics of the cache in the Prometheus text format.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def on_get(self, req, resp):
+        self.app.on_metrics(req, resp)
+
+
+class TraceResource(object):
+    """
+    Resource for /api/admin/trace, enables or disables the tracing of the requests
+    (enabled) and sets the threshold for the slow requests log (slow_threshold, seconds).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def on_post(self, req, resp):
+        self.app.on_trace(req, resp)
+
+
+class ProfileResource(object):
+    """
+    Resource for /api/admin/profile, starts the sampling profiler for some seconds (POST
+    with seconds) or returns its status (GET).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def on_get(self, req, resp):
+        self.app.on_profile(req, resp)
+
+    def on_post(self, req, resp):
+        self.app.on_profile(req, resp)
+
 
-api = application = falcon.API()
-application.req_options.auto_parse_form_urlencoded = True
 application_functions = Application()
+api = application = falcon.API(middleware=[TraceMiddleware(application_functions)])
+application.req_options.auto_parse_form_urlencoded = True
 application.add_route('/api/get/{element_id}', application_functions)
 application.add_route('/api/get', application_functions)
 application.add_route('/api/remove/{element_id}', application_functions)
 application.add_route('/api/reset/{element_id}', application_functions)
 application.add_route('/api/add', application_functions)
+application.add_route('/api/batch', BatchResource(application_functions))
+application.add_route('/api/metrics', MetricsResource(application_functions))
+if application_functions.settings.get("ADMIN_ENDPOINTS"):
+    # Tracing and profiling can be changed at runtime, only exposed when enabled
+    application.add_route('/api/admin/trace', TraceResource(application_functions))
+    application.add_route('/api/admin/profile', ProfileResource(application_functions))
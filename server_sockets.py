@@ -5,14 +5,33 @@ v0.2 December 2018
 """
 
 import os
+import errno
+import time
+import argparse
+import asyncio
 import ujson
 import socket
+import select
+import selectors
+import signal
 import logging.config
 import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from logging.handlers import RotatingFileHandler
 from shutil import copyfile
-from pysica import PySiCa
-from struct import unpack, pack
+from pysica import PySiCa, check_raw_value, dumps_respond, loads_raw_values, run_batch, iter_ndjson
+from pysica_shm import SharedPySiCa
+from pysica_trace import Tracer, SamplingProfiler, NO_TRACE
+from pysica_logging import start_queue_logging
+from pysica_framing import parse_header, pack_header, recv_header, recv_exactly, send_buffers, stream_frames, dumps_payload, compress_payload, loads_payload, SendBuffer, FrameReader, FrameTooLargeError, FLAG_CLOSE, FLAG_MARSHAL, FLAG_PLAIN, FLAG_ADAPTIVE, HEADER_SIZE, LENGTH_SIZE, PROTOCOL_MAGIC, MAX_FRAME_SIZE
+
+# Python < 3.7 has no get_running_loop, get_event_loop returns the running loop there
+get_running_loop = getattr(asyncio, "get_running_loop", asyncio.get_event_loop)
+# Errors of accept() after which the server stops accepting for ACCEPT_PAUSE seconds (out
+# of file descriptors or memory), the pending connections wait in the backlog
+ACCEPT_PAUSE_ERRORS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+ACCEPT_PAUSE = 0.1
 
 
 class Application(object):
@@ -23,16 +42,48 @@ class Application(object):
         self.settings = self.read_settings_file()
         self.buffer_size = 0
         self.socket = None
+        self.selector = None
+        self.executor = None
+        # Connections whose respond was prepared by a worker, waiting to be sent
+        self.ready = deque()
+        self.wakeup = None
+        # Time until which the selector engine does not accept new connections
+        self.accept_paused = None
         # Enable the logging to file for production
         self.logger = self.configure_logging()
         # Create the instance for the cache
-        self.cache_instance = PySiCa(
+        options = dict(
             logger=self.logger,
             timeout=self.settings.get("TIMEOUT"),
             compress=self.settings.get("COMPRESS"),
+            codec=self.settings.get("CODEC"),
+            compress_level=self.settings.get("COMPRESS_LEVEL"),
+            compress_min_size=self.settings.get("COMPRESS_MIN_SIZE"),
             max_elems=self.settings.get("MAX_ELEMS"),
-            clean_interval=self.settings.get("CLEAN_INTERVAL")
+            max_bytes=self.settings.get("MAX_BYTES"),
+            eviction_policy=self.settings.get("EVICTION_POLICY"),
+            clean_interval=self.settings.get("CLEAN_INTERVAL"),
+            stripes=self.settings.get("STRIPES"),
+            clean_batch_size=self.settings.get("CLEAN_BATCH_SIZE"),
+            snapshot_file=os.path.join(self.settings.get("TMP_DIRECTORY"), self.settings.get("SNAPSHOT_FILE")) if self.settings.get("SNAPSHOT_FILE") else None,
+            snapshot_interval=self.settings.get("SNAPSHOT_INTERVAL"),
+            oplog_file=os.path.join(self.settings.get("TMP_DIRECTORY"), self.settings.get("OPLOG_FILE")) if self.settings.get("OPLOG_FILE") else None,
+            oplog_fsync=self.settings.get("OPLOG_FSYNC"),
+            oplog_interval=self.settings.get("OPLOG_INTERVAL"),
+            oplog_compact_size=self.settings.get("OPLOG_COMPACT_SIZE"),
+            metrics=self.settings.get("METRICS"),
+            metrics_max_data_types=self.settings.get("METRICS_MAX_DATA_TYPES"),
+            log_sample_rate=self.settings.get("LOG_SAMPLE_RATE"),
+            log_max_per_second=self.settings.get("LOG_MAX_PER_SECOND")
         )
+        if self.settings.get("STORAGE") == "shared":
+            # Elements in shared memory, several processes can serve the same cache
+            self.cache_instance = SharedPySiCa(path=self.settings.get("SHARED_FILE"), size=self.settings.get("SHARED_SIZE"), page_size=self.settings.get("SHARED_PAGE_SIZE"), **options)
+        else:
+            self.cache_instance = PySiCa(**options)
+        # Phases of the requests (opt-in) and profiler, both can be enabled at runtime
+        self.tracer = Tracer(self.logger, enabled=self.settings.get("SERVER_TRACE"), slow_threshold=self.settings.get("SERVER_SLOW_REQUEST_THRESHOLD"))
+        self.profiler = SamplingProfiler(self.logger, directory=self.settings.get("TMP_DIRECTORY"), interval=self.settings.get("SERVER_PROFILE_INTERVAL"), max_time=self.settings.get("SERVER_PROFILE_MAX_TIME"))
 
     def run_server(self):
         self.buffer_size = self.settings.get("SERVER_BUFFER_SIZE")
@@ -50,41 +101,491 @@ class Application(object):
         else:
             # Use network socket by default
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Allow restarting the server while old connections are in TIME_WAIT
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             host = self.settings.get("SERVER_HOST_NAME")
             port = self.settings.get("SERVER_PORT_NUMBER")
             self.socket.bind((host, port))
             self.logger.info("Listening on %s:%s..." % (host, str(port)))
         # Listen to the socket
-        self.socket.listen(1)
+        self.socket.listen(self.settings.get("SERVER_BACKLOG"))
 
     def handle_requests(self):
+        engine = self.settings.get("SERVER_ENGINE")
+        if engine == "blocking":
+            self.handle_requests_blocking()
+        elif engine == "asyncio":
+            self.handle_requests_asyncio()
+        else:
+            self.handle_requests_selector()
+
+    def handle_requests_selector(self):
+        """
+        Serves the requests using an event loop (selectors) with non-blocking sockets, so
+        a slow client does not stall the others. The cache operations are run in the loop
+        or, if SERVER_WORKERS > 0, in a pool of worker threads.
+        """
+        workers = self.settings.get("SERVER_WORKERS")
+        connection_timeout = self.settings.get("SERVER_CONNECTION_TIMEOUT")
+        self.logger.info("Serving requests using selectors" + (" and " + str(workers) + " workers" if workers > 0 else ""))
+        self.selector = selectors.DefaultSelector()
+        self.socket.setblocking(False)
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+        if workers > 0:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+            # Workers write to this socket pair to wake up the event loop
+            self.wakeup = socket.socketpair()
+            self.wakeup[0].setblocking(False)
+            self.wakeup[1].setblocking(False)
+            self.selector.register(self.wakeup[0], selectors.EVENT_READ, "wakeup")
         try:
-            while True:
-                # First read the entire request
-                (request, connection) = self.read_request()
-                # Now, check the target function to use
-                target = request.get("target")
-                respond = None
-                if target == "add":
-                    respond = self.on_post(request)
-                elif target == "get":
-                    respond = self.on_get(request)
-                elif target == "remove":
-                    respond = self.on_delete(request)
-                elif target == "reset":
-                    respond = self.on_reset(request)
+            last_check = time.time()
+            while self.socket is not None:
+                timeout = 1 if self.accept_paused is None else max(0, min(1, self.accept_paused - time.time()))
+                for (key, mask) in self.selector.select(timeout=timeout):
+                    if key.data is None:
+                        self.accept_connection()
+                    elif key.data == "wakeup":
+                        self.flush_ready()
+                    else:
+                        self.service_connection(key.data, mask)
+                now = time.time()
+                if self.accept_paused is not None and now >= self.accept_paused and self.socket is not None:
+                    self.accept_paused = None
+                    self.selector.register(self.socket, selectors.EVENT_READ, None)
+                # Close the connections that have been inactive for too long
+                if connection_timeout and now - last_check >= 1:
+                    last_check = now
+                    for key in list(self.selector.get_map().values()):
+                        if isinstance(key.data, Connection) and key.data.pending == 0 and now - key.data.last_activity > connection_timeout:
+                            self.logger.warning("Closing connection after " + str(connection_timeout) + " seconds of inactivity")
+                            self.close_connection(key.data)
+        except Exception as ex:
+            self.logger.error("Failed while serving requests. Error message: " + str(ex))
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+            self.selector.close()
+            self.close()
+
+    def accept_connection(self):
+        try:
+            (connection, addr) = self.socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as ex:
+            # Only this connection failed (e.g. aborted by the client), keep serving
+            self.logger.warning("Failed while accepting a connection. Error message: " + str(ex))
+            if ex.errno in ACCEPT_PAUSE_ERRORS:
+                # The listening socket stays readable, stop polling it for a while so the
+                # loop does not spin until some connections are closed
+                self.selector.unregister(self.socket)
+                self.accept_paused = time.time() + ACCEPT_PAUSE
+            return
+        connection.setblocking(False)
+        self.update_interest(Connection(connection, self.buffer_size, self.settings.get("SERVER_MAX_FRAME_SIZE")))
+
+    def service_connection(self, conn, mask):
+        try:
+            conn.last_activity = time.time()
+            if mask & selectors.EVENT_READ:
+                start = time.perf_counter()
+                if conn.reader.read(conn.socket) == 0:
+                    # Client closed its side, answer the pending requests and close
+                    conn.reading = False
                 else:
-                    respond = {'success': False, 'message': target + " is not a valid option."}
-                # Return the respond
-                self.send_respond(connection, respond)
+                    frame = conn.next_frame()
+                    while frame is not None:
+                        conn.pending += 1
+                        # The recv phase is the read that completed the frame
+                        trace = self.tracer.start(frame[1], start)
+                        trace.mark("recv")
+                        if self.executor is not None:
+                            self.executor.submit(self.process_frame, conn, frame, trace)
+                        else:
+                            self.process_frame(conn, frame, trace)
+                        frame = conn.next_frame()
+            if mask & selectors.EVENT_WRITE:
+                self.fill_respond(conn)
+            if mask & selectors.EVENT_WRITE and len(conn.respond) > 0:
+                conn.respond.send(conn.socket)
+            self.update_interest(conn)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except FrameTooLargeError as ex:
+            # The payload is not read, answer and close the connection
+            self.logger.warning("Rejected request. Error message: " + str(ex))
+            conn.reading = False
+            conn.respond.extend(self.encode_respond({'success': False, 'message': str(ex)}, request_id=ex.request_id, flags=FLAG_CLOSE if ex.request_id is not None else 0))
+            self.update_interest(conn)
+        except Exception as ex:
+            self.logger.error("Failed while serving connection. Error message: " + str(ex))
+            self.close_connection(conn)
+
+    def process_frame(self, conn, frame, trace=NO_TRACE):
+        (version, request_id, flags, payload) = frame
+        # Time waiting for a worker (or for the previous frames of the same read)
+        trace.mark("wait")
+        request = {}
+        try:
+            request = self.decode_request(payload, flags, trace)
+            if version > 1 and self.is_stream(request):
+                # The frames are produced by the event loop as the client reads them
+                self.queue_respond(conn, self.encode_stream(request, request_id))
+                self.tracer.finish(trace, "stream")
+                return
+            respond = self.process_request(request)
+            trace.mark("cache")
+        except Exception as ex:
+            respond = {'success': False, 'message': "Failed while reading request data. Error message: " + str(ex)}
+        try:
+            data = self.encode_respond(respond, request_id=request_id if version > 1 else None, request_flags=flags, trace=trace)
+        except Exception as ex:
+            data = self.encode_respond({'success': False, 'message': "Failed while encoding respond. Error message: " + str(ex)}, request_id=request_id if version > 1 else None, request_flags=flags)
+        # Sent by the event loop once the socket is writable
+        self.queue_respond(conn, data)
+        trace.mark("queue")
+        self.tracer.finish(trace, request.get("target"))
+
+    def queue_respond(self, conn, data):
+        """
+        Adds a respond (a list of buffers, or a generator of frames for streamed responds) to the
+        connection, through the event loop thread when using workers.
+        """
+        if self.executor is not None:
+            # Back to the event loop thread
+            self.ready.append((conn, data))
+            try:
+                self.wakeup[1].send(b"\0")
+            except (BlockingIOError, InterruptedError):
+                pass
+        elif isinstance(data, list):
+            conn.respond.extend(data)
+            conn.pending -= 1
+        else:
+            conn.streams.append(data)
+
+    def fill_respond(self, conn):
+        # Frames of the streamed responds are produced while there is room in the buffer
+        limit = self.settings.get("SERVER_STREAM_CHUNK_SIZE")
+        while len(conn.streams) > 0 and len(conn.respond) < limit:
+            frame = next(conn.streams[0], None)
+            if frame is None:
+                conn.streams.popleft()
+                conn.pending -= 1
+            else:
+                conn.respond.extend(frame)
+
+    def flush_ready(self):
+        try:
+            self.wakeup[0].recv(4096)
+        except (BlockingIOError, InterruptedError):
+            pass
+        while len(self.ready) > 0:
+            (conn, data) = self.ready.popleft()
+            if conn.closed:
+                continue
+            if isinstance(data, list):
+                conn.respond.extend(data)
+                conn.pending -= 1
+            else:
+                conn.streams.append(data)
+            conn.last_activity = time.time()
+            try:
+                self.update_interest(conn)
+            except Exception as ex:
+                self.logger.error("Failed while sending respond. Error message: " + str(ex))
+                self.close_connection(conn)
+
+    def update_interest(self, conn):
+        """
+        Registers the connection in the selector for the events it is waiting for, or
+        closes it once there is nothing else to read or send.
+        """
+        if conn.closed:
+            return
+        if not conn.reading and conn.pending == 0 and len(conn.respond) == 0:
+            try:
+                conn.socket.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+            self.close_connection(conn)
+            return
+        events = (selectors.EVENT_READ if conn.reading else 0) | (selectors.EVENT_WRITE if len(conn.respond) > 0 or len(conn.streams) > 0 else 0)
+        if events == 0:
+            # Waiting for the workers
+            if conn.events != 0:
+                self.selector.unregister(conn.socket)
+        elif conn.events == 0:
+            self.selector.register(conn.socket, events, conn)
+        elif conn.events != events:
+            self.selector.modify(conn.socket, events, conn)
+        conn.events = events
+
+    def close_connection(self, conn):
+        conn.closed = True
+        try:
+            self.selector.unregister(conn.socket)
+        except (KeyError, ValueError):
+            pass
+        try:
+            conn.socket.close()
+        except OSError:
+            pass
+
+    def process_request(self, request):
+        # Check the target function to use
+        target = request.get("target")
+        if target == "add":
+            return self.on_post(request)
+        elif target == "get":
+            return self.on_get(request)
+        elif target == "remove":
+            return self.on_delete(request)
+        elif target == "reset":
+            return self.on_reset(request)
+        elif target == "batch":
+            return self.on_batch(request)
+        elif target == "stats":
+            return self.on_stats(request)
+        elif target == "trace":
+            return self.on_trace(request)
+        elif target == "profile":
+            return self.on_profile(request)
+        else:
+            return {'success': False, 'message': str(target) + " is not a valid option."}
+
+    def handle_requests_asyncio(self):
+        """
+        Serves the requests using asyncio streams, a coroutine per connection. Besides the
+        socket opened by run_server, when SERVER_SOCKET_FILE is set the server listens on
+        SERVER_HOST_NAME:SERVER_PORT_NUMBER too. The cache operations are run in the loop
+        or, if SERVER_WORKERS > 0, in a pool of worker threads.
+        """
+        workers = self.settings.get("SERVER_WORKERS")
+        self.logger.info("Serving requests using asyncio" + (" and " + str(workers) + " workers" if workers > 0 else ""))
+        # A loop of its own (get_event_loop is deprecated outside of a running loop)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        if workers > 0:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+        servers = []
+        try:
+            if self.socket.family == socket.AF_UNIX:
+                servers.append(loop.run_until_complete(asyncio.start_unix_server(self.handle_connection_async, sock=self.socket)))
+                host = self.settings.get("SERVER_HOST_NAME")
+                port = self.settings.get("SERVER_PORT_NUMBER")
+                servers.append(loop.run_until_complete(asyncio.start_server(self.handle_connection_async, host, port, backlog=self.settings.get("SERVER_BACKLOG"))))
+                self.logger.info("Listening on %s:%s..." % (host, str(port)))
+            else:
+                servers.append(loop.run_until_complete(asyncio.start_server(self.handle_connection_async, sock=self.socket)))
+            loop.run_forever()
+        except Exception as ex:
+            self.logger.error("Failed while serving requests. Error message: " + str(ex))
+        finally:
+            for server in servers:
+                server.close()
+                loop.run_until_complete(server.wait_closed())
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+            loop.close()
+            self.socket = None
+
+    async def handle_connection_async(self, reader, writer):
+        connection_timeout = self.settings.get("SERVER_CONNECTION_TIMEOUT") or None
+        lock = asyncio.Lock()
+        tasks = []
+        try:
+            while True:
+                try:
+                    bs = await asyncio.wait_for(reader.readexactly(LENGTH_SIZE), connection_timeout)
+                except asyncio.IncompleteReadError:
+                    # Client closed the connection
+                    break
+                if bs[:2] == PROTOCOL_MAGIC:
+                    bs += await asyncio.wait_for(reader.readexactly(HEADER_SIZE - LENGTH_SIZE), connection_timeout)
+                try:
+                    (version, request_id, flags, data_length, header_size) = parse_header(bs, self.settings.get("SERVER_MAX_FRAME_SIZE"))
+                except FrameTooLargeError as ex:
+                    # The payload is not read, answer and close the connection
+                    self.logger.warning("Rejected request. Error message: " + str(ex))
+                    writer.writelines(self.encode_respond({'success': False, 'message': str(ex)}, request_id=ex.request_id, flags=FLAG_CLOSE if ex.request_id is not None else 0))
+                    await writer.drain()
+                    break
+                trace = self.tracer.start(request_id)
+                data = await asyncio.wait_for(reader.readexactly(data_length), connection_timeout)
+                trace.mark("recv")
+                if version == 1:
+                    await self.respond_async(writer, lock, data, trace=trace)
+                    break
+                # Pipelined requests are processed concurrently, responds carry the request id
+                tasks = [task for task in tasks if not task.done()]
+                tasks.append(asyncio.ensure_future(self.respond_async(writer, lock, data, request_id=request_id, flags=flags, trace=trace)))
+                if flags & FLAG_CLOSE:
+                    break
+            if len(tasks) > 0:
+                await asyncio.wait(tasks)
+            writer.write_eof()
+        except asyncio.TimeoutError:
+            self.logger.debug("Closing connection after " + str(connection_timeout) + " seconds of inactivity")
+        except Exception as ex:
+            self.logger.error("Failed while serving connection. Error message: " + str(ex))
+        finally:
+            writer.close()
+
+    async def respond_async(self, writer, lock, data, request_id=None, flags=0, trace=NO_TRACE):
+        request = {}
+        try:
+            request = self.decode_request(data, flags, trace)
+            if request_id is not None and self.is_stream(request):
+                await self.stream_async(writer, lock, self.encode_stream(request, request_id))
+                trace.mark("stream")
+                self.tracer.finish(trace, "stream")
+                return
+            respond = await self.process_request_async(request)
+            trace.mark("cache")
+        except Exception as ex:
+            respond = {'success': False, 'message': "Failed while reading request data. Error message: " + str(ex)}
+        async with lock:
+            trace.mark("wait")
+            writer.writelines(self.encode_respond(respond, request_id=request_id, request_flags=flags, trace=trace))
+            await writer.drain()
+            trace.mark("send")
+        self.tracer.finish(trace, request.get("target"))
+
+    async def stream_async(self, writer, lock, frames):
+        while True:
+            frame = await self.run_async(lambda frames: next(frames, None), frames)
+            if frame is None:
+                break
+            # Other responds can be sent between the frames
+            async with lock:
+                writer.writelines(frame)
+                await writer.drain()
+
+    async def process_request_async(self, request):
+        # Check the target function to use
+        target = request.get("target")
+        if target == "add":
+            return await self.on_post_async(request)
+        elif target == "get":
+            return await self.on_get_async(request)
+        elif target == "remove":
+            return await self.on_delete_async(request)
+        elif target == "reset":
+            return await self.on_reset_async(request)
+        elif target == "batch":
+            return await self.on_batch_async(request)
+        elif target == "stats":
+            return await self.on_stats_async(request)
+        elif target == "trace":
+            return self.on_trace(request)
+        elif target == "profile":
+            return self.on_profile(request)
+        else:
+            return {'success': False, 'message': str(target) + " is not a valid option."}
+
+    async def on_post_async(self, request):
+        return await self.run_async(self.on_post, request)
+
+    async def on_get_async(self, request):
+        return await self.run_async(self.on_get, request)
+
+    async def on_delete_async(self, request):
+        return await self.run_async(self.on_delete, request)
+
+    async def on_reset_async(self, request):
+        return await self.run_async(self.on_reset, request)
+
+    async def on_batch_async(self, request):
+        return await self.run_async(self.on_batch, request)
+
+    async def on_stats_async(self, request):
+        return await self.run_async(self.on_stats, request)
+
+    async def run_async(self, function, request):
+        if self.executor is not None:
+            return await get_running_loop().run_in_executor(self.executor, function, request)
+        return function(request)
+
+    def handle_requests_blocking(self):
+        try:
+            while True:
+                try:
+                    (connection, addr) = self.socket.accept()
+                except OSError as ex:
+                    if ex.errno not in ACCEPT_PAUSE_ERRORS + (errno.ECONNABORTED, errno.EPROTO):
+                        raise
+                    self.logger.warning("Failed while accepting a connection. Error message: " + str(ex))
+                    if ex.errno in ACCEPT_PAUSE_ERRORS:
+                        time.sleep(ACCEPT_PAUSE)
+                    continue
+                try:
+                    self.handle_connection_blocking(connection)
+                except Exception as ex:
+                    # Only this connection failed (e.g. unsupported protocol version or the
+                    # client closed it in the middle of a frame), keep serving the rest
+                    self.logger.warning("Failed while reading request data. Error message: " + str(ex))
+                    self.reject_connection(connection, ex)
         except Exception as ex:
-            self.logger.error("Failed while reading request data. Error message: " + str(ex))
+            self.logger.error("Failed while accepting connections. Error message: " + str(ex))
         finally:
             self.close()
 
+    def handle_connection_blocking(self, connection):
+        """
+        Serves the requests of a connection. This engine serves a connection at a time, so
+        version 2 connections are only kept while the client already sent more requests
+        (pipelined): the respond to the last one has FLAG_CLOSE and the connection is closed.
+        """
+        more = True
+        while more:
+            # First read the entire request
+            try:
+                (data, request_id, flags, trace) = self.read_request(connection)
+            except FrameTooLargeError:
+                # Already answered by read_request
+                return
+            try:
+                request = self.decode_request(data, flags, trace)
+            except Exception as ex:
+                self.send_respond(connection, {'success': False, 'message': "Failed while reading request data. Error message: " + str(ex)}, request_id=request_id, request_flags=flags)
+                return
+            if request_id is not None and self.is_stream(request):
+                self.send_stream(connection, self.encode_stream(request, request_id, flags=FLAG_CLOSE))
+                trace.mark("stream")
+                self.tracer.finish(trace, "stream")
+                return
+            # Now, run the target function
+            respond = self.process_request(request)
+            trace.mark("cache")
+            # Return the respond, the connection is closed unless the next request is waiting
+            more = request_id is not None and not flags & FLAG_CLOSE and self.has_next_request(connection)
+            self.send_respond(connection, respond, request_id=request_id, request_flags=flags, trace=trace, close=not more)
+            self.tracer.finish(trace, request.get("target"))
+
+    def has_next_request(self, connection):
+        # Data already received, not the end of the connection
+        if len(select.select([connection], [], [], 0)[0]) == 0:
+            return False
+        try:
+            return len(connection.recv(1, socket.MSG_PEEK)) > 0
+        except OSError:
+            return False
+
+    def reject_connection(self, connection, ex):
+        # Answers with the error if the client is still there (as a version 1 frame, the
+        # request id is unknown) and closes the connection
+        try:
+            self.send_respond(connection, {'success': False, 'message': "Failed while reading request data. Error message: " + str(ex)})
+        except OSError:
+            connection.close()
+
     def on_post(self, request):
         try:
-            success = self.cache_instance.add(request.get("element_id"), request.get("data"), request.get("data_type"), timeout=request.get("timeout"), compress=request.get("compress"), user_id=request.get("user_id"))
+            # Raw payloads are checked here so the error reaches the client
+            data = check_raw_value(request.get("data")) if request.get("raw") else request.get("data")
+            success = self.cache_instance.add(request.get("element_id"), data, request.get("data_type"), timeout=request.get("timeout"), compress=request.get("compress"), user_id=request.get("user_id"), raw=request.get("raw", False))
             return {'success': success, 'element_id': request.get("element_id")}
         except Exception as e:
             return {'success': False, 'message': "Failed while storing new element. Error message: " + str(e)}
@@ -102,6 +603,8 @@ class Application(object):
     def on_delete(self, request):
         try:
             result = self.cache_instance.remove(request.get("element_id"), user_id=request.get("user_id"))
+            if request.get("return"):
+                return {'success': len(result) > 0, 'result': result}
             return {'success': len(result) > 0}
         except Exception as e:
             return {'success': False, 'message': "Failed while removing element. Error message: " + str(e)}
@@ -113,29 +616,117 @@ class Application(object):
         except Exception as e:
             return {'success': False, 'message': "Element " + request.get("element_id") + " is not in cache."}
 
-    def send_respond(self, connection, data):
+    def on_batch(self, request):
+        try:
+            return {'success': True, 'result': run_batch(self.cache_instance, request, max_size=self.settings.get("MAX_BATCH_SIZE"))}
+        except Exception as e:
+            return {'success': False, 'message': "Failed while running batch. Error message: " + str(e)}
+
+    def on_stats(self, request):
+        try:
+            return {'success': True, 'result': self.cache_instance.get_metrics()}
+        except Exception as e:
+            return {'success': False, 'message': "Failed while getting metrics. Error message: " + str(e)}
+
+    def on_trace(self, request):
+        if not self.settings.get("ADMIN_ENDPOINTS"):
+            return {'success': False, 'message': "trace is not a valid option, the admin targets are disabled (ADMIN_ENDPOINTS)."}
         try:
-            data = zlib.compress(ujson.dumps(data).encode("utf-8"))
-            # use struct to make sure we have a consistent endianness on the length
-            length = pack('>Q', len(data))
-            # sendall to make sure it blocks if there's back-pressure on the socket
-            connection.sendall(length)
-            connection.sendall(data)
+            return {'success': True, 'result': self.tracer.configure(enabled=request.get("enabled"), slow_threshold=request.get("slow_threshold"))}
+        except Exception as e:
+            return {'success': False, 'message': "Failed while configuring tracing. Error message: " + str(e)}
+
+    def on_profile(self, request):
+        if not self.settings.get("ADMIN_ENDPOINTS"):
+            return {'success': False, 'message': "profile is not a valid option, the admin targets are disabled (ADMIN_ENDPOINTS)."}
+        try:
+            if request.get("seconds") is None:
+                return {'success': True, 'result': self.profiler.get_status()}
+            return {'success': True, 'result': {"running": True, "file": self.profiler.start(request.get("seconds"))}}
+        except Exception as e:
+            return {'success': False, 'message': "Failed while starting the profiler. Error message: " + str(e)}
+
+    def is_stream(self, request):
+        return request.get("target") == "get" and request.get("stream") and request.get("data_type") is not None
+
+    def encode_stream(self, request, request_id, flags=0):
+        """
+        Yields the frames for a streamed query by data_type: chunks of NDJSON (an element
+        per line and a summary line at the end) compressed by a single zlib stream that
+        is flushed at the end of each frame, so the client can decompress them as they arrive.
+        """
+        items = self.cache_instance.iter_type(request.get("data_type"), user_id=request.get("user_id"), reset_timeout=request.get("reset_timeout"), timeout=request.get("timeout"))
+        return stream_frames(iter_ndjson(items, ujson.dumps, self.settings.get("SERVER_STREAM_CHUNK_SIZE")), request_id, flags=flags)
+
+    def send_stream(self, connection, frames):
+        try:
+            for frame in frames:
+                send_buffers(connection, frame)
+        except OSError as ex:
+            # The client stopped reading (e.g. closed the connection), keep serving
+            self.logger.warning("Streamed respond interrupted. Error message: " + str(ex))
         finally:
-            connection.shutdown(socket.SHUT_WR)
+            try:
+                connection.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
             connection.close()
 
-    def read_request(self):
-        (connection, addr) = self.socket.accept()
-        bs = connection.recv(8)
-        (data_length,) = unpack('>Q', bs)
-        data = b''
-        while len(data) < data_length:
-            # doing it in batches is generally better than trying
-            # to do it all in one go, so I believe.
-            to_read = data_length - len(data)
-            data += connection.recv(self.buffer_size if to_read > self.buffer_size else to_read)
-        return ujson.loads(zlib.decompress(data)), connection
+    def decode_request(self, payload, flags, trace=NO_TRACE):
+        if flags & FLAG_MARSHAL and not self.settings.get("SERVER_WIRE_MARSHAL"):
+            raise Exception("Requests serialized with marshal are not accepted (SERVER_WIRE_MARSHAL)")
+        if not flags & FLAG_PLAIN:
+            payload = zlib.decompress(payload)
+            trace.mark("decompress")
+        request = loads_payload(payload, flags, ujson.loads)
+        trace.mark("loads")
+        return request
+
+    def encode_respond(self, data, request_id=None, flags=0, request_flags=0, trace=NO_TRACE):
+        """
+        Returns the frame for a respond as a list of buffers (header and payload), sent
+        without joining them. Responds use the serializer of their request, and small
+        responds are not compressed if the client sent FLAG_ADAPTIVE.
+        """
+        if request_flags & FLAG_MARSHAL:
+            (data, encoding) = dumps_payload(loads_raw_values(data, ujson.loads), "marshal")
+        else:
+            (data, encoding) = dumps_payload(data, "json", lambda respond: dumps_respond(respond, ujson.dumps))
+        trace.mark("dumps")
+        if request_flags & FLAG_ADAPTIVE:
+            (data, encoding) = compress_payload(data, encoding, self.settings.get("SERVER_WIRE_COMPRESS_LEVEL"), self.settings.get("SERVER_WIRE_COMPRESS_MIN_SIZE"))
+        else:
+            # Older clients expect all the responds compressed
+            data = zlib.compress(data, self.settings.get("SERVER_WIRE_COMPRESS_LEVEL"))
+        trace.mark("compress")
+        return [pack_header(len(data), request_id, flags | encoding), data]
+
+    def send_respond(self, connection, data, request_id=None, request_flags=0, trace=NO_TRACE, close=True):
+        try:
+            # blocks if there's back-pressure on the socket
+            send_buffers(connection, self.encode_respond(data, request_id=request_id, flags=FLAG_CLOSE if request_id is not None and close else 0, request_flags=request_flags, trace=trace))
+            trace.mark("send")
+        except Exception:
+            close = True
+            raise
+        finally:
+            if close:
+                connection.shutdown(socket.SHUT_WR)
+                connection.close()
+
+    def read_request(self, connection):
+        try:
+            (version, request_id, flags, data_length, header_size) = recv_header(connection, self.settings.get("SERVER_MAX_FRAME_SIZE"))
+        except FrameTooLargeError as ex:
+            # The payload is not read, answer and close the connection
+            self.logger.warning("Rejected request. Error message: " + str(ex))
+            self.send_respond(connection, {'success': False, 'message': str(ex)}, request_id=ex.request_id)
+            raise
+        # The payload is received into a buffer of its size
+        trace = self.tracer.start(request_id)
+        data = recv_exactly(connection, data_length)
+        trace.mark("recv")
+        return data, request_id, flags, trace
 
     def close(self):
         self.socket.close()
@@ -155,19 +746,56 @@ class Application(object):
 
             SERVER_SETTINGS = config.get("SERVER_SETTINGS", {})
             settings["SERVER_SOCKET_FILE"] = SERVER_SETTINGS.get('SERVER_SOCKET_FILE', '')
-            settings["SERVER_BUFFER_SIZE"] = int(SERVER_SETTINGS.get('SERVER_BUFFER_SIZE', 4096))
+            settings["SERVER_BUFFER_SIZE"] = int(SERVER_SETTINGS.get('SERVER_BUFFER_SIZE', 65536))
+            settings["SERVER_MAX_FRAME_SIZE"] = int(SERVER_SETTINGS.get('SERVER_MAX_FRAME_SIZE', MAX_FRAME_SIZE))
+            settings["SERVER_WIRE_COMPRESS_LEVEL"] = int(SERVER_SETTINGS.get('SERVER_WIRE_COMPRESS_LEVEL', 1))
+            settings["SERVER_WIRE_COMPRESS_MIN_SIZE"] = int(SERVER_SETTINGS.get('SERVER_WIRE_COMPRESS_MIN_SIZE', 1024))
+            settings["SERVER_WIRE_MARSHAL"] = SERVER_SETTINGS.get('SERVER_WIRE_MARSHAL', False)
+            settings["SERVER_ENGINE"] = SERVER_SETTINGS.get('SERVER_ENGINE', "selector")
+            settings["SERVER_BACKLOG"] = int(SERVER_SETTINGS.get('SERVER_BACKLOG', 128))
+            settings["SERVER_WORKERS"] = int(SERVER_SETTINGS.get('SERVER_WORKERS', 0))
+            settings["SERVER_CONNECTION_TIMEOUT"] = float(SERVER_SETTINGS.get('SERVER_CONNECTION_TIMEOUT', 30))
+            settings["MAX_BATCH_SIZE"] = int(SERVER_SETTINGS.get('MAX_BATCH_SIZE', 1000))
+            settings["SERVER_STREAM_CHUNK_SIZE"] = int(SERVER_SETTINGS.get('SERVER_STREAM_CHUNK_SIZE', 65536))
             settings["SERVER_HOST_NAME"] = SERVER_SETTINGS.get('SERVER_HOST_NAME', "0.0.0.0")
             settings["SERVER_SUBDOMAIN"] = SERVER_SETTINGS.get('SERVER_SUBDOMAIN', "")
             settings["SERVER_PORT_NUMBER"] = SERVER_SETTINGS.get('SERVER_PORT_NUMBER', 8081)
             settings["DEBUG"] = SERVER_SETTINGS.get('DEBUG', False)
             settings["TMP_DIRECTORY"] = SERVER_SETTINGS.get('TMP_DIRECTORY', "/tmp")
             settings["LOG_FILE"] = SERVER_SETTINGS.get('LOG_FILE', "/tmp/queue.log")
+            settings["LOG_QUEUE"] = SERVER_SETTINGS.get('LOG_QUEUE', True)
+            settings["SERVER_TRACE"] = SERVER_SETTINGS.get('SERVER_TRACE', False)
+            settings["SERVER_SLOW_REQUEST_THRESHOLD"] = float(SERVER_SETTINGS.get('SERVER_SLOW_REQUEST_THRESHOLD', 0.1))
+            settings["SERVER_PROFILE_INTERVAL"] = float(SERVER_SETTINGS.get('SERVER_PROFILE_INTERVAL', 0.01))
+            settings["SERVER_PROFILE_MAX_TIME"] = float(SERVER_SETTINGS.get('SERVER_PROFILE_MAX_TIME', 60))
+            settings["ADMIN_ENDPOINTS"] = SERVER_SETTINGS.get('ADMIN_ENDPOINTS', False)
 
             CACHE_SETTINGS = config.get("CACHE_SETTINGS", {})
             settings["TIMEOUT"] = CACHE_SETTINGS.get('TIMEOUT', 10)
             settings["COMPRESS"] = CACHE_SETTINGS.get('COMPRESS', True)
-            settings["MAX_ELEMS"] = CACHE_SETTINGS.get('MAX_ELEMS', 50)
+            settings["CODEC"] = CACHE_SETTINGS.get('CODEC', "zlib")
+            settings["COMPRESS_LEVEL"] = CACHE_SETTINGS.get('COMPRESS_LEVEL', 1)
+            settings["COMPRESS_MIN_SIZE"] = CACHE_SETTINGS.get('COMPRESS_MIN_SIZE', 1024)
+            settings["MAX_ELEMS"] = CACHE_SETTINGS.get('MAX_ELEMS', 0)
+            settings["MAX_BYTES"] = CACHE_SETTINGS.get('MAX_BYTES', 0)
+            settings["EVICTION_POLICY"] = CACHE_SETTINGS.get('EVICTION_POLICY', "lru")
             settings["CLEAN_INTERVAL"] = CACHE_SETTINGS.get('CLEAN_INTERVAL', 30)
+            settings["STRIPES"] = CACHE_SETTINGS.get('STRIPES', 16)
+            settings["CLEAN_BATCH_SIZE"] = CACHE_SETTINGS.get('CLEAN_BATCH_SIZE', 1000)
+            settings["STORAGE"] = CACHE_SETTINGS.get('STORAGE', "memory")
+            settings["SHARED_FILE"] = CACHE_SETTINGS.get('SHARED_FILE', "/dev/shm/pysica.cache")
+            settings["SHARED_SIZE"] = int(CACHE_SETTINGS.get('SHARED_SIZE', 64 * 1024 * 1024))
+            settings["SHARED_PAGE_SIZE"] = int(CACHE_SETTINGS.get('SHARED_PAGE_SIZE', 1024 * 1024))
+            settings["SNAPSHOT_FILE"] = CACHE_SETTINGS.get('SNAPSHOT_FILE', "")
+            settings["SNAPSHOT_INTERVAL"] = CACHE_SETTINGS.get('SNAPSHOT_INTERVAL', 300)
+            settings["OPLOG_FILE"] = CACHE_SETTINGS.get('OPLOG_FILE', "")
+            settings["OPLOG_FSYNC"] = CACHE_SETTINGS.get('OPLOG_FSYNC', "everysec")
+            settings["OPLOG_INTERVAL"] = float(CACHE_SETTINGS.get('OPLOG_INTERVAL', 1.0))
+            settings["OPLOG_COMPACT_SIZE"] = int(CACHE_SETTINGS.get('OPLOG_COMPACT_SIZE', 64 * 1024 * 1024))
+            settings["METRICS"] = CACHE_SETTINGS.get('METRICS', True)
+            settings["METRICS_MAX_DATA_TYPES"] = int(CACHE_SETTINGS.get('METRICS_MAX_DATA_TYPES', 100))
+            settings["LOG_SAMPLE_RATE"] = float(CACHE_SETTINGS.get('LOG_SAMPLE_RATE', 1.0))
+            settings["LOG_MAX_PER_SECOND"] = int(CACHE_SETTINGS.get('LOG_MAX_PER_SECOND', 0))
 
         # PREPARE LOGGING
         logging.config.fileConfig(logging_conf_path)
@@ -175,6 +803,7 @@ class Application(object):
         return settings
 
     def configure_logging(self):
+        logger = logging.root
         if not self.settings.get("DEBUG", True):
             try:
                 logger = logging.getLogger()
@@ -185,11 +814,14 @@ class Application(object):
                 handler.setLevel(logging.INFO)
                 handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(filename)s : %(funcName)s - %(message)s'))
                 logger.root.addHandler(handler)
-                return logger
+                # Debug messages are not written, skip them before building the records
+                logger.setLevel(logging.INFO)
             except Exception as e:
                 raise Exception("Unable to open log file " + self.settings.get("LOG_FILE", "LOG FILE NOT SPECIFIED") + ". Error message: " + str(e))
-        else:
-            return logging.root
+        if self.settings.get("LOG_QUEUE"):
+            # Records are written by a background thread, requests never wait for the disk
+            start_queue_logging(logger)
+        return logger
 
     def humanize_bytes(self, size):
         for unit in ['', 'k', 'M', 'G', 'T', 'P', 'E', 'Z']:
@@ -199,7 +831,56 @@ class Application(object):
         return "%.1f%s%s" % (size, 'Yi', 'B')
 
 
+class Connection(object):
+    """
+    State of a client connection served by the event loop.
+    """
+
+    def __init__(self, connection, buffer_size=65536, max_frame_size=0):
+        self.socket = connection
+        self.reader = FrameReader(buffer_size, max_frame_size)
+        self.respond = SendBuffer()
+        # Generators of frames for the streamed responds, sent one after the other
+        self.streams = deque()
+        # Requests being processed and events registered in the selector
+        self.pending = 0
+        self.events = 0
+        self.reading = True
+        self.closed = False
+        self.last_activity = time.time()
+
+    def next_frame(self):
+        """
+        Extracts the next complete frame from the received data, returns a tuple
+        (version, request_id, flags, payload) or None if there is no complete frame yet.
+        """
+        frame = self.reader.next_frame()
+        if frame is None:
+            return None
+        (version, request_id, flags, payload) = frame
+        if version == 1 or flags & FLAG_CLOSE:
+            # Version 1 connections are closed after the respond
+            self.reading = False
+        return version, request_id, flags, payload
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="PySiCa cache server based on sockets")
+    parser.add_argument("--host", default=None, help="Overrides SERVER_HOST_NAME")
+    parser.add_argument("--port", type=int, default=None, help="Overrides SERVER_PORT_NUMBER")
+    parser.add_argument("--socket-file", default=None, help="Overrides SERVER_SOCKET_FILE")
+    args = parser.parse_args()
+
     app = Application()
+    # Several servers can run from the same directory (e.g. one per shard)
+    if args.host is not None:
+        app.settings["SERVER_HOST_NAME"] = args.host
+    if args.port is not None:
+        app.settings["SERVER_PORT_NUMBER"] = args.port
+        app.settings["SERVER_SOCKET_FILE"] = ""
+    if args.socket_file is not None:
+        app.settings["SERVER_SOCKET_FILE"] = args.socket_file
+    # Exit cleanly on SIGTERM (e.g. docker stop), so the snapshot is written
+    signal.signal(signal.SIGTERM, lambda signum, frame: exit(0))
     app.run_server()
     app.handle_requests()
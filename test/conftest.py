@@ -0,0 +1,8 @@
+"""
+PySiCa, a simple Python Cache system
+
+The scripts in sockets/ and webserver/ run against a running server (python server_sockets.py
+or uwsgi), pytest only collects the unit tests in core/.
+"""
+
+collect_ignore = ["sockets/test_1.py", "webserver/test_1.py"]
@@ -0,0 +1,91 @@
+"""
+PySiCa, a simple Python Cache system
+
+Tests for the batch operations (pysica.py): run_batch with each operation, errors of
+single items and the limit of the batch size, and the *_many methods of PySiCa.
+
+Usage: python -m pytest test/core
+"""
+
+import logging
+import os
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, ROOT)
+
+from pysica import PySiCa, RawValue, run_batch
+
+
+def new_cache(**options):
+    logger = logging.getLogger("test_batch")
+    logger.setLevel(logging.CRITICAL)
+    return PySiCa(logger=logger, clean_interval=3600, metrics=False, **options)
+
+
+class RunBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = new_cache()
+
+    def test_operations(self):
+        items = [{"element_id": str(i), "data": {"value": i}, "data_type": "object"} for i in range(5)]
+        self.assertEqual(run_batch(self.cache, {"operation": "add", "items": items}), [{'success': True, 'element_id': str(i)} for i in range(5)])
+        self.assertEqual(run_batch(self.cache, {"operation": "get", "items": ["0", "4", "9"]}), [{'success': True, 'result': [{"value": 0}]}, {'success': True, 'result': [{"value": 4}]}, {'success': False}])
+        self.assertEqual(run_batch(self.cache, {"operation": "reset", "items": ["1", "9"], "timeout": 60}), [{'success': True}, {'success': False}])
+        self.assertEqual(run_batch(self.cache, {"operation": "remove", "items": ["2", "9"], "return": True}), [{'success': True, 'result': [{"value": 2}]}, {'success': False, 'result': []}])
+        self.assertEqual(run_batch(self.cache, {"operation": "remove", "items": ["3", "3"]}), [{'success': True}, {'success': False}])
+        self.assertEqual(self.cache.count_elems(), 3)
+
+    def test_options(self):
+        items = [{"element_id": "1", "data": "x" * 2048, "data_type": "text"}, {"element_id": "2", "data": 2, "data_type": "number", "user_id": "other"}]
+        run_batch(self.cache, {"operation": "add", "items": items, "user_id": "user", "compress": "zlib"})
+        # Options of the batch are the defaults of the items
+        self.assertEqual(self.cache.get_elem("1", user_id="user"), ["x" * 2048])
+        self.assertTrue(self.cache.get_stripe(user_id="user").user_cache.get("user").get("1").get("compressed"))
+        self.assertEqual(self.cache.get_elem("2", user_id="other"), [2])
+        self.assertEqual(run_batch(self.cache, {"operation": "get", "items": ["1", "2"], "user_id": "user"})[1], {'success': False})
+
+    def test_item_errors(self):
+        cache = new_cache(max_bytes=10000)
+        items = [
+            {"element_id": "1", "data": 1, "data_type": "number"},
+            {"element_id": "2", "data": "x" * 20000, "data_type": "text", "compress": False},
+            {"element_id": "3", "data": '{"y": 1', "data_type": "object", "raw": True},
+            {"element_id": "4", "data": '{"y": 1}', "data_type": "object", "raw": True}
+        ]
+        # Each item fails on its own, the rest of the batch is stored
+        self.assertEqual([respond.get("success") for respond in run_batch(cache, {"operation": "add", "items": items})], [True, False, False, True])
+        self.assertEqual(cache.count_elems(), 2)
+        result = run_batch(cache, {"operation": "get", "items": ["4", "3"]})
+        self.assertIsInstance(result[0].get("result")[0], RawValue)
+        self.assertEqual(result[1], {'success': False})
+
+    def test_invalid_operation(self):
+        with self.assertRaises(Exception):
+            run_batch(self.cache, {"operation": "update", "items": ["1"]})
+
+    def test_max_size(self):
+        items = [{"element_id": str(i), "data": i, "data_type": "number"} for i in range(11)]
+        with self.assertRaises(Exception) as context:
+            run_batch(self.cache, {"operation": "add", "items": items}, max_size=10)
+        self.assertIn("exceeds the limit (10)", str(context.exception))
+        # Nothing was stored
+        self.assertEqual(self.cache.count_elems(), 0)
+        self.assertEqual(len(run_batch(self.cache, {"operation": "add", "items": items[:10]}, max_size=10)), 10)
+        self.assertEqual(len(run_batch(self.cache, {"operation": "get", "items": [str(i) for i in range(11)]}, max_size=0)), 11)
+
+
+class ManyTest(unittest.TestCase):
+
+    def test_many(self):
+        cache = new_cache()
+        self.assertEqual(cache.add_many([{"element_id": "1", "data": 1, "data_type": "number"}, {"element_id": "2", "data": 2, "data_type": "number", "timeout": -1}]), [True, True])
+        self.assertEqual(cache.get_many(["1", "2", None]), [[1], [], []])
+        self.assertEqual(cache.reset_many(["1", "2"], timeout=60), [True, False])
+        self.assertEqual(cache.remove_many(["1", "1"]), [[1], []])
+
+
+if __name__ == '__main__':
+    unittest.main()
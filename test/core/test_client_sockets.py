@@ -0,0 +1,93 @@
+"""
+PySiCa, a simple Python Cache system
+
+Tests for the retries of the sockets client (api/pysica_api_sockets.py): requests that
+failed on a pooled connection are only sent again if the server did not apply them or
+applying them twice has the same effect.
+
+Usage: python -m pytest test/core
+"""
+
+import os
+import socket
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, os.path.join(ROOT, "api"))
+
+from pysica_api_sockets import send_request, add_request, get_request, remove_request, reset_request, batch_request, RequestNotSentError
+from pysica_framing import ConnectionClosedError
+
+
+class FailingHandler(object):
+    """
+    Connection raising the given error (if any) instead of answering.
+    """
+
+    def __init__(self, error=None):
+        self.error = error
+        self.requests = []
+        self.socket = object()
+
+    def send_data(self, request, buffer_size=4096):
+        self.requests.append(request)
+        if self.error is not None:
+            raise self.error
+        return {"success": True, "result": ["value"]}
+
+
+class FakePool(object):
+
+    def __init__(self, handlers):
+        self.handlers = list(handlers)
+        self.released = []
+
+    def acquire(self):
+        return self.handlers.pop(0)
+
+    def release(self, handler, discard=False):
+        self.released.append((handler, discard))
+
+
+class SendRequestTest(unittest.TestCase):
+
+    def send(self, request, error):
+        (failing, fresh) = (FailingHandler(error), FailingHandler())
+        pool = FakePool([failing, fresh])
+        response = send_request(request, "Failed.", pool=pool)
+        # The failed connection is never reused
+        self.assertIn((failing, True), pool.released)
+        return (response, len(fresh.requests) > 0)
+
+    def test_not_sent_requests_are_retried(self):
+        for request in [add_request("1", 1, "number"), remove_request("1", return_elem=True), batch_request("add", [{"element_id": "1", "data": 1}])]:
+            (response, retried) = self.send(request, RequestNotSentError("Broken pipe"))
+            self.assertTrue(retried)
+            self.assertTrue(response.success)
+
+    def test_idempotent_requests_are_retried(self):
+        for request in [get_request("1"), reset_request("1"), batch_request("get", [{"element_id": "1"}])]:
+            for error in [ConnectionClosedError("Connection closed by the server"), ConnectionResetError("Connection reset by peer")]:
+                (response, retried) = self.send(request, error)
+                self.assertTrue(retried, request)
+                self.assertTrue(response.success)
+
+    def test_other_requests_are_not_retried(self):
+        # The server may have applied them before the connection failed
+        for request in [add_request("1", 1, "number"), remove_request("1", return_elem=True), batch_request("add", [{"element_id": "1", "data": 1}])]:
+            for error in [ConnectionClosedError("Connection closed by the server"), ConnectionResetError("Connection reset by peer")]:
+                (response, retried) = self.send(request, error)
+                self.assertFalse(retried, request)
+                self.assertFalse(response.success)
+
+    def test_timeouts_are_not_retried(self):
+        for request in [get_request("1"), add_request("1", 1, "number")]:
+            (response, retried) = self.send(request, socket.timeout("timed out"))
+            self.assertFalse(retried)
+            self.assertFalse(response.success)
+            self.assertIn("timed out", response.message)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""
+PySiCa, a simple Python Cache system
+
+Tests for the codecs of the stored values (pysica_codecs.py).
+
+Usage: python -m pytest test/core
+"""
+
+import logging
+import os
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, ROOT)
+
+from pysica import PySiCa
+from pysica_codecs import CODECS, get_codec
+
+VALUES = [
+    None,
+    0,
+    "text with unicode: ñá€",
+    {"name": "element", "values": list(range(100)), "nested": {"a": [1.5, True, None]}},
+    ["x" * 5000] * 3
+]
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for name in CODECS:
+            for level in [None, 1, 9]:
+                codec = get_codec(name, level=level)
+                for value in VALUES:
+                    self.assertEqual(codec.decode(codec.encode(value)), value)
+
+    def test_compress_matches_encode(self):
+        # The cache marshals once and compresses with the chosen codec
+        marshal_codec = get_codec("marshal")
+        for name in CODECS:
+            codec = get_codec(name, level=1)
+            for value in VALUES:
+                self.assertEqual(codec.decode(codec.compress(marshal_codec.encode(value))), value)
+                self.assertEqual(marshal_codec.decode(codec.decompress(codec.encode(value))), value)
+
+    def test_compression(self):
+        value = ["x" * 5000] * 3
+        size = len(get_codec("marshal").encode(value))
+        self.assertLess(len(get_codec("zlib").encode(value)), size)
+        self.assertLess(len(get_codec("lzma").encode(value)), size)
+
+    def test_get_codec(self):
+        self.assertEqual(get_codec(None).name, "zlib")
+        self.assertEqual(get_codec(True).name, "zlib")
+        self.assertEqual(get_codec("LZMA").name, "lzma")
+        self.assertRaises(Exception, get_codec, "gzip")
+
+
+class CacheCodecsTest(unittest.TestCase):
+
+    def setUp(self):
+        logger = logging.getLogger("test_codecs")
+        logger.setLevel(logging.WARNING)
+        self.cache = PySiCa(logger=logger, clean_interval=3600, metrics=False, compress_min_size=100)
+
+    def test_values_with_each_codec(self):
+        value = {"values": list(range(1000))}
+        for compress in [False, True, "marshal", "zlib", "lzma"]:
+            self.assertTrue(self.cache.add(str(compress), value, "object", compress=compress))
+            self.assertEqual(self.cache.get_elem(str(compress)), [value])
+
+    def test_small_values_are_not_compressed(self):
+        self.assertEqual(self.cache.encode_data("small", "lzma")[0], "marshal")
+        self.assertEqual(self.cache.encode_data("x" * 1000, "lzma")[0], "lzma")
+
+    def test_stored_with_other_default_codec(self):
+        # Elements keep the name of their codec, so changing the default one is safe
+        self.cache.add("1", "x" * 1000, "string")
+        self.cache.set_option("codec", "lzma")
+        self.cache.add("2", "y" * 1000, "string")
+        self.assertEqual(self.cache.get_elem("1"), ["x" * 1000])
+        self.assertEqual(self.cache.get_elem("2"), ["y" * 1000])
+        stats = self.cache.get_codec_stats()
+        self.assertEqual(stats.get("zlib").get("count"), 1)
+        self.assertEqual(stats.get("lzma").get("count"), 1)
+
+    def test_unknown_codec(self):
+        self.assertFalse(self.cache.add("1", "value", "string", compress="gzip"))
+
+
+if __name__ == '__main__':
+    unittest.main()
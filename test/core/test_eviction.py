@@ -0,0 +1,131 @@
+"""
+PySiCa, a simple Python Cache system
+
+Tests for the eviction policies (pysica_eviction.py) and the limits of the cache.
+
+Usage: python -m pytest test/core
+"""
+
+import logging
+import os
+import sys
+import time
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, ROOT)
+
+from pysica import PySiCa
+from pysica_eviction import LRUPolicy, LFUPolicy, TTLPolicy, get_eviction_policy
+
+
+def new_cache(**options):
+    logger = logging.getLogger("test_eviction")
+    logger.setLevel(logging.WARNING)
+    # A single stripe, so the eviction order is exact
+    return PySiCa(logger=logger, clean_interval=3600, stripes=1, metrics=False, **options)
+
+
+class PolicyTest(unittest.TestCase):
+
+    def test_lru(self):
+        policy = LRUPolicy()
+        for key in ["a", "b", "c"]:
+            policy.on_insert(key, {})
+        policy.on_access("a", {})
+        self.assertEqual(policy.victim(), "b")
+        self.assertEqual(policy.victim(exclude="b"), "c")
+        policy.on_remove("b")
+        self.assertEqual(policy.victim(), "c")
+
+    def test_lfu(self):
+        policy = LFUPolicy()
+        for key in ["a", "b", "c"]:
+            policy.on_insert(key, {})
+        policy.on_access("a", {})
+        policy.on_access("a", {})
+        policy.on_access("b", {})
+        self.assertEqual(policy.victim(), "c")
+        policy.on_remove("c")
+        self.assertEqual(policy.victim(), "b")
+        # Only the excluded key has the min frequency
+        self.assertEqual(policy.victim(exclude="b"), "a")
+        # Inserting again resets the frequency
+        policy.on_insert("a", {})
+        self.assertEqual(policy.victim(), "a")
+
+    def test_ttl(self):
+        policy = TTLPolicy()
+        policy.on_insert("a", {"timeout": 30})
+        policy.on_insert("b", {"timeout": 10})
+        policy.on_insert("c", {"timeout": 20})
+        self.assertEqual(policy.victim(), "b")
+        policy.on_update("b", {"timeout": 40})
+        self.assertEqual(policy.victim(), "c")
+        self.assertEqual(policy.victim(exclude="c"), "a")
+        # The excluded entry is kept
+        self.assertEqual(policy.victim(), "c")
+        for key in ["a", "b", "c"]:
+            policy.on_remove(key)
+        self.assertIsNone(policy.victim())
+
+    def test_empty(self):
+        for policy in [LRUPolicy(), LFUPolicy(), TTLPolicy()]:
+            self.assertIsNone(policy.victim())
+            policy.on_insert("a", {"timeout": 1})
+            self.assertIsNone(policy.victim(exclude="a"))
+
+    def test_get_eviction_policy(self):
+        self.assertIsInstance(get_eviction_policy(None), LRUPolicy)
+        self.assertIsInstance(get_eviction_policy("LFU"), LFUPolicy)
+        self.assertRaises(Exception, get_eviction_policy, "fifo")
+
+
+class CacheLimitsTest(unittest.TestCase):
+
+    def test_no_limit_by_default(self):
+        cache = new_cache()
+        for i in range(200):
+            cache.add(str(i), i, "number", compress=False)
+        self.assertEqual(cache.count_elems(), 200)
+
+    def test_max_elems_lru(self):
+        cache = new_cache(max_elems=3)
+        for key in ["a", "b", "c"]:
+            cache.add(key, key, "letter", compress=False)
+        cache.get_elem("a")
+        cache.add("d", "d", "letter", compress=False)
+        self.assertEqual(cache.count_elems(), 3)
+        self.assertEqual(cache.get_elem("b"), [])
+        self.assertEqual(cache.get_elem("a"), ["a"])
+        self.assertEqual(cache.get_stats().get("evictions_general"), 1)
+
+    def test_max_elems_ttl(self):
+        cache = new_cache(max_elems=2, eviction_policy="ttl")
+        cache.add("long", 1, "number", timeout=60, compress=False)
+        cache.add("short", 2, "number", timeout=1, compress=False)
+        cache.add("new", 3, "number", timeout=30, compress=False)
+        self.assertEqual(cache.get_elem("short"), [])
+        self.assertEqual(cache.get_elem("long"), [1])
+
+    def test_max_bytes(self):
+        cache = new_cache(max_bytes=3000)
+        for i in range(10):
+            cache.add(str(i), "x" * 1000, "string", compress=False)
+        self.assertLessEqual(cache.count_bytes(), 3000)
+        self.assertEqual(cache.get_elem("9"), ["x" * 1000])
+        # Larger than the whole cache
+        self.assertFalse(cache.add("big", "x" * 5000, "string", compress=False))
+
+    def test_user_elements(self):
+        cache = new_cache(max_elems=2)
+        cache.add("1", 1, "number", user_id="u1", compress=False)
+        cache.add("2", 2, "number", user_id="u1", compress=False)
+        cache.add("3", 3, "number", user_id="u1", compress=False)
+        self.assertEqual(cache.get_elem("1", user_id="u1"), [])
+        self.assertEqual(cache.count_by_type(user_id="u1"), {"number": 2})
+        self.assertEqual(cache.get_stats().get("evictions_user"), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+"""
+PySiCa, a simple Python Cache system
+
+Tests for the expiry index of the cache stripes (heap with lazy deletion).
+
+Usage: python -m pytest test/core
+"""
+
+import logging
+import os
+import sys
+import time
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, ROOT)
+
+from pysica import PySiCa, CacheStripe
+
+
+def new_elem(deadline, data_type="object"):
+    return {"timeout": deadline, "compressed": False, "data_type": data_type, "data": 1, "size": 10}
+
+
+class ExpiryIndexTest(unittest.TestCase):
+
+    def test_clean_removes_only_expired(self):
+        stripe = CacheStripe()
+        now = time.time()
+        stripe.insert("old", new_elem(now - 10))
+        stripe.insert("new", new_elem(now + 60))
+        stripe.insert("old", new_elem(now - 5), user_id="u1")
+        (removed, pending) = stripe.clean(now)
+        self.assertEqual(set((user_id, key) for (user_id, key, elem) in removed), {(None, "old"), ("u1", "old")})
+        self.assertFalse(pending)
+        self.assertEqual(list(stripe.general_cache), ["new"])
+        self.assertEqual(stripe.user_cache, {})
+        self.assertEqual(stripe.n_elems, 1)
+        self.assertEqual(stripe.expirations, 2)
+
+    def test_reset_skips_stale_entry(self):
+        stripe = CacheStripe()
+        now = time.time()
+        stripe.insert("1", new_elem(now - 10))
+        stripe.reset("1", now + 60)
+        # The old entry is still in the heap but no longer matches the element
+        self.assertEqual(len(stripe.expiry_heap), 2)
+        (removed, pending) = stripe.clean(now)
+        self.assertEqual(removed, [])
+        self.assertIn("1", stripe.general_cache)
+        self.assertEqual(len(stripe.expiry_heap), 1)
+
+    def test_removed_and_replaced_elements(self):
+        stripe = CacheStripe()
+        now = time.time()
+        stripe.insert("removed", new_elem(now - 10))
+        stripe.pop("removed", now=now - 20)
+        stripe.insert("replaced", new_elem(now - 10))
+        stripe.insert("replaced", new_elem(now + 60))
+        (removed, pending) = stripe.clean(now)
+        self.assertEqual(removed, [])
+        self.assertEqual(list(stripe.general_cache), ["replaced"])
+
+    def test_clean_in_batches(self):
+        stripe = CacheStripe()
+        now = time.time()
+        for i in range(10):
+            stripe.insert(str(i), new_elem(now - 10 + i * 0.1))
+        (removed, pending) = stripe.clean(now, max_work=4)
+        self.assertEqual([key for (user_id, key, elem) in removed], ["0", "1", "2", "3"])
+        self.assertTrue(pending)
+        (removed, pending) = stripe.clean(now, max_work=100)
+        self.assertEqual(len(removed), 6)
+        self.assertFalse(pending)
+        self.assertEqual(stripe.n_elems, 0)
+
+    def test_rebuild_drops_stale_entries(self):
+        stripe = CacheStripe()
+        now = time.time()
+        stripe.insert("1", new_elem(now + 60))
+        for i in range(2000):
+            stripe.reset("1", now + 60 + i)
+        # Rebuilt when most of the entries were stale
+        self.assertLess(len(stripe.expiry_heap), 1100)
+        stripe.reset("1", now - 1)
+        (removed, pending) = stripe.clean(now)
+        self.assertEqual([key for (user_id, key, elem) in removed], ["1"])
+
+    def test_lookup_removes_expired(self):
+        stripe = CacheStripe()
+        now = time.time()
+        stripe.insert("1", new_elem(now - 1))
+        self.assertIsNone(stripe.lookup("1", now=now))
+        self.assertEqual(stripe.n_elems, 0)
+        self.assertEqual(stripe.expirations, 1)
+        self.assertEqual(stripe.clean(now), ([], False))
+
+
+class CleanCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        logger = logging.getLogger("test_expiry")
+        logger.setLevel(logging.WARNING)
+        self.cache = PySiCa(logger=logger, max_elems=0, clean_interval=3600, metrics=False)
+
+    def test_clean_cache(self):
+        for i in range(100):
+            self.cache.add(str(i), i, "number", timeout=-1 if i % 2 else 10, compress=False)
+        self.cache.add("u", "value", "string", timeout=-1, user_id="user")
+        self.cache.clean_cache()
+        self.assertEqual(self.cache.count_elems(), 50)
+        self.assertEqual(self.cache.get_elem("0"), [0])
+        self.assertEqual(self.cache.get_elem("1"), [])
+        self.assertEqual(self.cache.get_elem("u", user_id="user"), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,238 @@
+"""
+PySiCa, a simple Python Cache system
+
+Tests for the framing of the socket protocol (pysica_framing.py): FrameReader and
+SendBuffer with sockets that only read or write a few bytes per call, and the blocking
+helpers used by the client and the blocking engine.
+
+Usage: python -m pytest test/core
+"""
+
+import os
+import random
+import socket
+import sys
+import unittest
+import zlib
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, ROOT)
+
+import pysica_framing
+from pysica_framing import FrameReader, SendBuffer, FrameTooLargeError, ConnectionClosedError, pack_header, recv_header, recv_exactly, recv_decompress, send_buffers, FLAG_CLOSE, PROTOCOL_VERSION
+
+
+class PartialConnection(object):
+    """
+    Socket reading and writing at most the given number of bytes per call (cycling
+    through the sizes), to check partial reads and writes.
+    """
+
+    def __init__(self, data=b'', sizes=(1,)):
+        self.data = bytes(data)
+        self.offset = 0
+        self.sizes = list(sizes)
+        self.calls = 0
+        self.sent = bytearray()
+
+    def next_size(self):
+        size = self.sizes[self.calls % len(self.sizes)]
+        self.calls += 1
+        return size
+
+    def recv_into(self, buffer, nbytes=0):
+        n = min(len(buffer), nbytes or len(buffer), self.next_size(), len(self.data) - self.offset)
+        buffer[:n] = self.data[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+    def recv(self, nbytes):
+        buffer = bytearray(nbytes)
+        return bytes(buffer[:self.recv_into(buffer)])
+
+    def sendmsg(self, buffers):
+        data = b''.join(bytes(data) for data in buffers)[:self.next_size()]
+        self.sent.extend(data)
+        return len(data)
+
+    def send(self, data):
+        return self.sendmsg([data])
+
+    def sendall(self, data):
+        self.sent.extend(data)
+
+
+def frames(payloads, version=2):
+    data = b''
+    for (i, payload) in enumerate(payloads):
+        data += pack_header(len(payload), i + 1 if version == 2 else None, FLAG_CLOSE if i == len(payloads) - 1 else 0) + payload
+    return data
+
+
+def read_frames(reader, connection):
+    result = []
+    while True:
+        frame = reader.next_frame()
+        if frame is not None:
+            result.append(frame)
+            continue
+        if reader.read(connection) == 0:
+            return result
+
+
+class FrameReaderTest(unittest.TestCase):
+
+    payloads = [b'', b'a', b'x' * 100, os.urandom(5000), b'y' * 70000, b'z' * 10]
+
+    def test_partial_reads(self):
+        expected = [(PROTOCOL_VERSION, i + 1, FLAG_CLOSE if i == len(self.payloads) - 1 else 0, payload) for (i, payload) in enumerate(self.payloads)]
+        for sizes in [(1,), (3, 7), (17,), (4096,), (1000000,)]:
+            connection = PartialConnection(frames(self.payloads), sizes)
+            self.assertEqual(read_frames(FrameReader(buffer_size=1024), connection), expected, sizes)
+
+    def test_random_reads(self):
+        rand = random.Random(0)
+        payloads = [os.urandom(rand.randrange(3000)) for i in range(200)]
+        connection = PartialConnection(frames(payloads), [rand.randrange(1, 2000) for i in range(100)])
+        result = read_frames(FrameReader(buffer_size=512), connection)
+        self.assertEqual([frame[3] for frame in result], payloads)
+        self.assertEqual([frame[1] for frame in result], list(range(1, 201)))
+
+    def test_version_1(self):
+        connection = PartialConnection(frames([b'first', b'second'], version=1), (5,))
+        self.assertEqual(read_frames(FrameReader(buffer_size=64), connection), [(1, None, 0, b'first'), (1, None, 0, b'second')])
+
+    def test_header_split_at_buffer_end(self):
+        # The buffer is filled with a frame and part of the next header
+        reader = FrameReader(buffer_size=32)
+        payload = b'p' * (32 - len(pack_header(0, 1)) - 4)
+        connection = PartialConnection(frames([payload, b'next']), (1000,))
+        self.assertEqual([frame[3] for frame in read_frames(reader, connection)], [payload, b'next'])
+
+    def test_max_size(self):
+        connection = PartialConnection(frames([b'x' * 100]), (1000,))
+        reader = FrameReader(max_size=50)
+        reader.read(connection)
+        with self.assertRaises(FrameTooLargeError) as context:
+            reader.next_frame()
+        self.assertEqual(context.exception.request_id, 1)
+
+    def test_unsupported_version(self):
+        reader = FrameReader()
+        reader.read(PartialConnection(b'PS\x07' + b'\x00' * 20, (1000,)))
+        with self.assertRaises(Exception):
+            reader.next_frame()
+
+
+class SendBufferTest(unittest.TestCase):
+
+    def test_partial_writes(self):
+        buffers = [pack_header(5000, 1), os.urandom(5000), pack_header(3, 2), b'abc', b'', bytearray(b'x' * 70000)]
+        for sizes in [(1,), (7, 13), (4096,), (1000000,)]:
+            send_buffer = SendBuffer()
+            send_buffer.extend(buffers)
+            self.assertEqual(len(send_buffer), sum(len(data) for data in buffers))
+            connection = PartialConnection(sizes=sizes)
+            while len(send_buffer) > 0:
+                send_buffer.send(connection)
+            self.assertEqual(bytes(connection.sent), b''.join(bytes(data) for data in buffers), sizes)
+            self.assertEqual(send_buffer.buffers, [])
+            self.assertEqual(send_buffer.send(connection), 0)
+
+    def test_append_while_sending(self):
+        send_buffer = SendBuffer()
+        connection = PartialConnection(sizes=(3,))
+        expected = b''
+        for i in range(50):
+            data = str(i).encode("utf-8") * 5
+            send_buffer.append(data)
+            expected += data
+            send_buffer.send(connection)
+        while len(send_buffer) > 0:
+            send_buffer.send(connection)
+        self.assertEqual(bytes(connection.sent), expected)
+
+    def test_many_buffers(self):
+        # More buffers than a sendmsg call takes
+        buffers = [str(i).encode("utf-8") for i in range(pysica_framing.MAX_BUFFERS * 3)]
+        send_buffer = SendBuffer()
+        send_buffer.extend(buffers)
+        connection = PartialConnection(sizes=(1000000,))
+        while len(send_buffer) > 0:
+            send_buffer.send(connection)
+        self.assertEqual(bytes(connection.sent), b''.join(buffers))
+
+    def test_without_sendmsg(self):
+        has_sendmsg = pysica_framing.HAS_SENDMSG
+        pysica_framing.HAS_SENDMSG = False
+        try:
+            send_buffer = SendBuffer()
+            send_buffer.extend([b'header', b'x' * 1000, b'tail'])
+            connection = PartialConnection(sizes=(100,))
+            while len(send_buffer) > 0:
+                send_buffer.send(connection)
+            self.assertEqual(bytes(connection.sent), b'header' + b'x' * 1000 + b'tail')
+        finally:
+            pysica_framing.HAS_SENDMSG = has_sendmsg
+
+
+class BlockingTest(unittest.TestCase):
+
+    def test_send_buffers_partial(self):
+        buffers = [pack_header(100000, 1), os.urandom(100000), b'tail']
+        connection = PartialConnection(sizes=(4093, 1))
+        send_buffers(connection, buffers)
+        self.assertEqual(bytes(connection.sent), b''.join(buffers))
+
+    def test_recv_partial(self):
+        payload = os.urandom(200000)
+        connection = PartialConnection(frames([payload]), (1, 3, 4096))
+        (version, request_id, flags, data_length, header_size) = recv_header(connection)
+        self.assertEqual((version, request_id, data_length), (PROTOCOL_VERSION, 1, len(payload)))
+        self.assertEqual(bytes(recv_exactly(connection, data_length)), payload)
+
+    def test_recv_decompress_partial(self):
+        payload = os.urandom(1000) * 200
+        data = zlib.compress(payload)
+        self.assertEqual(recv_decompress(PartialConnection(data, (999,)), len(data), chunk_size=4096), payload)
+
+    def test_connection_closed(self):
+        connection = PartialConnection(frames([b'x' * 100])[:-10], (7,))
+        recv_header(connection)
+        with self.assertRaises(ConnectionClosedError):
+            recv_exactly(connection, 100)
+        with self.assertRaises(ConnectionClosedError):
+            recv_header(PartialConnection(b'PS\x02', (1,)))
+
+    def test_socketpair(self):
+        (left, right) = socket.socketpair()
+        try:
+            left.setblocking(False)
+            right.setblocking(False)
+            payloads = [os.urandom(300000), b'small']
+            send_buffer = SendBuffer()
+            send_buffer.extend([pack_header(len(payloads[0]), 1), payloads[0], pack_header(len(payloads[1]), 2), payloads[1]])
+            reader = FrameReader(buffer_size=4096)
+            result = []
+            while len(result) < 2:
+                if len(send_buffer) > 0:
+                    try:
+                        send_buffer.send(left)
+                    except BlockingIOError:
+                        pass
+                try:
+                    reader.read(right)
+                except BlockingIOError:
+                    pass
+                frame = reader.next_frame()
+                while frame is not None:
+                    result.append(frame[3])
+                    frame = reader.next_frame()
+            self.assertEqual(result, payloads)
+        finally:
+            left.close()
+            right.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""
+PySiCa, a simple Python Cache system
+
+Tests for the sampling of the operations logged at INFO (pysica_logging.py): one of every
+1/log_sample_rate operations is logged, with the evictions it caused.
+
+Usage: python -m pytest test/core
+"""
+
+import logging
+import os
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, ROOT)
+
+from pysica import PySiCa
+from pysica_logging import OperationSampler
+
+
+class RecordsHandler(logging.Handler):
+
+    def __init__(self):
+        super(RecordsHandler, self).__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class OperationSamplerTest(unittest.TestCase):
+
+    def test_sample_rate(self):
+        for (sample_rate, logged) in [(1.0, 100), (0.25, 25), (0, 0)]:
+            sampler = OperationSampler(sample_rate)
+            self.assertEqual(sum(sampler.sample() for i in range(100)), logged)
+
+    def test_max_per_second(self):
+        sampler = OperationSampler(1.0, max_per_second=10)
+        self.assertLessEqual(sum(sampler.sample() for i in range(100)), 20)
+
+
+class SampledOperationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger("test_logging")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.handler = RecordsHandler()
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def count(self, prefix):
+        return len([message for message in self.handler.messages if message.startswith(prefix)])
+
+    def test_evictions_logged_with_their_operation(self):
+        cache = PySiCa(logger=self.logger, clean_interval=3600, metrics=False, max_elems=1, stripes=1, log_sample_rate=0.5)
+        for i in range(10):
+            cache.add(str(i), i, "number")
+        # Adds 0, 2, 4, 6 and 8 are sampled, all but the first one evicted an element
+        self.assertEqual(self.count("Storing new element"), 5)
+        self.assertEqual(self.count("Evicting item"), 4)
+        self.assertEqual(cache.count_elems(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
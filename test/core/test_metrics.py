@@ -0,0 +1,77 @@
+"""
+PySiCa, a simple Python Cache system
+
+Tests for the metrics of the operations (pysica_metrics.py): counters added up from the
+tables of the threads, tables of finished threads and the limit of data_types.
+
+Usage: python -m pytest test/core
+"""
+
+import os
+import sys
+import threading
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, ROOT)
+
+from pysica_metrics import Metrics, OTHER_DATA_TYPE, format_prometheus
+
+
+def record_in_thread(metrics, *args):
+    thread = threading.Thread(target=metrics.record, args=args)
+    thread.start()
+    thread.join()
+
+
+class MetricsTest(unittest.TestCase):
+
+    def get_entry(self, metrics, operation, cache, data_type):
+        for entry in metrics.get_metrics():
+            if (entry.get("operation"), entry.get("cache"), entry.get("data_type")) == (operation, cache, data_type):
+                return entry
+        return None
+
+    def test_record(self):
+        metrics = Metrics()
+        metrics.record("get", "general", "text", 1, 0, 10, 0.000003)
+        metrics.record("get", "general", "text", 0, 1, 0, 0.5)
+        metrics.record("add", "user", None, 0, 0, 5, expirations=2)
+        entry = self.get_entry(metrics, "get", "general", "text")
+        self.assertEqual((entry.get("hits"), entry.get("misses"), entry.get("bytes"), entry.get("count")), (1, 1, 10, 2))
+        # 3us goes to the bucket of 4us
+        self.assertEqual(entry.get("buckets")[2], 1)
+        self.assertEqual(self.get_entry(metrics, "add", "user", None).get("expirations"), 2)
+        self.assertIn('pysica_hits_total{operation="get",cache="general",data_type="text"} 1', format_prometheus({"operations": metrics.get_metrics()}))
+
+    def test_tables_of_finished_threads(self):
+        metrics = Metrics()
+        for i in range(50):
+            record_in_thread(metrics, "get", "general", "text", 1, 0, 1)
+        # Each new thread folds the tables of the finished ones
+        self.assertLessEqual(len(metrics.tables), 1)
+        metrics.record("get", "general", "text", 1, 0, 1)
+        self.assertEqual(len(metrics.tables), 1)
+        self.assertEqual(self.get_entry(metrics, "get", "general", "text").get("hits"), 51)
+        self.assertEqual(len(metrics.tables), 1)
+
+    def test_max_data_types(self):
+        metrics = Metrics(max_data_types=2)
+        for i in range(5):
+            metrics.record("add", "general", "type" + str(i), 0, 0, 10)
+            record_in_thread(metrics, "add", "general", "type" + str(i), 0, 0, 1)
+        metrics.record("add", "general", None, 0, 0, 1)
+        data_types = sorted(str(entry.get("data_type")) for entry in metrics.get_metrics())
+        self.assertEqual(data_types, sorted(["None", "type0", "type1", OTHER_DATA_TYPE]))
+        self.assertEqual(self.get_entry(metrics, "add", "general", "type0").get("bytes"), 11)
+        self.assertEqual(self.get_entry(metrics, "add", "general", OTHER_DATA_TYPE).get("bytes"), 33)
+
+    def test_no_data_type_limit(self):
+        metrics = Metrics(max_data_types=0)
+        for i in range(200):
+            metrics.record("get", "general", "type" + str(i), 1, 0, 0)
+        self.assertEqual(len(metrics.get_metrics()), 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+"""
+PySiCa, a simple Python Cache system
+
+Tests for the operation log (pysica_oplog.py): records replayed on startup, torn and
+corrupted records at the end of the log, invalid logs and compaction.
+
+Usage: python -m pytest test/core
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, ROOT)
+
+from pysica import PySiCa
+from pysica_oplog import OperationLog, pack_record, read_log, OP_ADD, OP_REMOVE, OP_RESET, HEADER_SIZE
+
+
+def new_elem(data, timeout=60):
+    return {"timeout": time.time() + timeout, "compressed": False, "data_type": "object", "data": data}
+
+
+class OperationLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="pysica-test-oplog-")
+        self.path = os.path.join(self.directory, "pysica.oplog")
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.oplog.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def new_cache(self, **options):
+        logger = logging.getLogger("test_oplog")
+        logger.setLevel(logging.CRITICAL)
+        cache = PySiCa(logger=logger, clean_interval=3600, metrics=False, oplog_file=self.path, oplog_fsync="always", **options)
+        self.caches.append(cache)
+        return cache
+
+    def restart(self, cache, **options):
+        cache.oplog.close()
+        return self.new_cache(**options)
+
+    def write_log(self, records):
+        oplog = OperationLog(self.path, fsync="always")
+        oplog.open()
+        for record in records:
+            oplog.sync(oplog.append(record))
+        oplog.close()
+        return os.path.getsize(self.path)
+
+    def test_read_log(self):
+        size = self.write_log([pack_record(OP_ADD, "1", None, new_elem(1)), pack_record(OP_ADD, "2", "user", new_elem(2)), pack_record(OP_REMOVE, "1")])
+        operations = list(read_log(self.path))
+        self.assertEqual([(operation, user_id, element_id) for (operation, user_id, element_id, elem) in operations[:-1]], [(OP_ADD, None, "1"), (OP_ADD, "user", "2"), (OP_REMOVE, None, "1")])
+        self.assertEqual(operations[1][3].get("data"), 2)
+        self.assertEqual(operations[-1], (None, None, None, size))
+
+    def test_torn_record(self):
+        size = self.write_log([pack_record(OP_ADD, "1", None, new_elem(1))])
+        # The process died while writing the second record
+        with open(self.path, "ab") as output:
+            output.write(pack_record(OP_ADD, "2", None, new_elem(2))[:-3])
+        operations = list(read_log(self.path))
+        self.assertEqual([element_id for (operation, user_id, element_id, elem) in operations[:-1]], ["1"])
+        self.assertEqual(operations[-1][3], size)
+        # Opening the log drops the torn record, new records follow the valid ones
+        oplog = OperationLog(self.path, fsync="always")
+        oplog.open()
+        self.assertEqual(os.path.getsize(self.path), size)
+        oplog.sync(oplog.append(pack_record(OP_ADD, "3", None, new_elem(3))))
+        oplog.close()
+        self.assertEqual([element_id for (operation, user_id, element_id, elem) in read_log(self.path)][:-1], ["1", "3"])
+
+    def test_corrupted_record(self):
+        size = self.write_log([pack_record(OP_ADD, "1", None, new_elem(1))])
+        self.write_log([pack_record(OP_ADD, "2", None, new_elem(2)), pack_record(OP_ADD, "3", None, new_elem(3))])
+        with open(self.path, "r+b") as output:
+            # Flip a byte in the entry of the second record, its crc does not match
+            output.seek(size + 20)
+            byte = output.read(1)
+            output.seek(size + 20)
+            output.write(bytes([byte[0] ^ 0xFF]))
+        operations = list(read_log(self.path))
+        self.assertEqual([element_id for (operation, user_id, element_id, elem) in operations[:-1]], ["1"])
+        self.assertEqual(operations[-1][3], size)
+
+    def test_empty_log(self):
+        open(self.path, "wb").close()
+        self.assertEqual(list(read_log(self.path)), [(None, None, None, 0)])
+        oplog = OperationLog(self.path)
+        oplog.open()
+        oplog.close()
+        self.assertTrue(oplog.created)
+        self.assertEqual(os.path.getsize(self.path), HEADER_SIZE)
+
+    def test_replay(self):
+        cache = self.new_cache()
+        cache.add("1", {"a": 1}, "object")
+        cache.add("2", "x" * 4096, "text", compress="zlib")
+        cache.add("3", '{"b": 2}', "object", raw=True)
+        cache.add("4", [1, 2], "list", user_id="user")
+        cache.add("5", 5, "number", timeout=1)
+        cache.add("6", 6, "number")
+        cache.remove("1")
+        cache.reset_timeout("5", timeout=60)
+        cache.add("6", 7, "number")
+        other = self.restart(cache)
+        self.assertEqual(other.count_elems(), 5)
+        self.assertEqual(other.get_elem("1"), [])
+        self.assertEqual(other.get_elem("2"), ["x" * 4096])
+        self.assertEqual(other.get_elem("3"), ['{"b": 2}'])
+        self.assertEqual(other.get_elem("4", user_id="user"), [[1, 2]])
+        self.assertEqual(other.get_elem("6"), [7])
+        # The new timeout was replayed
+        self.assertGreater(other.get_stripe("5").general_cache.get("5").get("timeout"), time.time() + 59 * 60)
+        self.assertEqual(other.count_bytes(), cache.count_bytes())
+
+    def test_replay_drops_expired(self):
+        cache = self.new_cache()
+        cache.add("1", 1, "number", timeout=-1)
+        cache.add("2", 2, "number")
+        other = self.restart(cache)
+        self.assertEqual(other.count_elems(), 1)
+        self.assertEqual(other.get_elem("2"), [2])
+
+    def test_replay_reset_after_deadline(self):
+        # The deadline of the add is over when the log is replayed, the reset extended it
+        cache = self.new_cache()
+        cache.add("1", 1, "number", timeout=0.01)
+        cache.add("2", 2, "number", timeout=0.01)
+        cache.reset_timeout("1", timeout=10)
+        time.sleep(0.8)
+        other = self.restart(cache)
+        self.assertEqual(other.get_elem("1"), [1])
+        self.assertEqual(other.get_elem("2"), [])
+        self.assertEqual(other.count_elems(), 1)
+        self.assertEqual(other.count_bytes(), other.get_stripe("1").general_cache.get("1").get("size"))
+
+    def test_replay_evictions(self):
+        cache = self.new_cache(max_elems=2, stripes=1)
+        for i in range(5):
+            cache.add(str(i), i, "number")
+        other = self.restart(cache, max_elems=2, stripes=1)
+        self.assertEqual(other.count_elems(), 2)
+        self.assertEqual(other.get_elem("4"), [4])
+
+    def test_replay_torn_log(self):
+        cache = self.new_cache()
+        cache.add("1", 1, "number")
+        cache.oplog.close()
+        with open(self.path, "ab") as output:
+            output.write(pack_record(OP_ADD, "2", None, new_elem(2))[:10])
+        other = self.new_cache()
+        self.assertEqual(other.get_elem("1"), [1])
+        self.assertEqual(other.get_elem("2"), [])
+        other.add("3", 3, "number")
+        self.assertEqual(self.restart(other).count_elems(), 2)
+
+    def test_invalid_log(self):
+        with open(self.path, "wb") as output:
+            output.write(b"not an operation log")
+        cache = self.new_cache()
+        # The log is kept aside and a new one is started
+        self.assertTrue(os.path.exists(self.path + ".bad"))
+        self.assertEqual(cache.count_elems(), 0)
+        cache.add("1", 1, "number")
+        self.assertEqual(self.restart(cache).get_elem("1"), [1])
+
+    def test_compact(self):
+        cache = self.new_cache()
+        for i in range(100):
+            cache.add(str(i % 10), "x" * 100, "text", compress=False)
+        cache.reset_timeout("1", timeout=60)
+        cache.remove("9")
+        size = os.path.getsize(self.path)
+        cache.oplog.compact()
+        self.assertLess(os.path.getsize(self.path), size / 5)
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+        # New records are appended to the compacted log
+        cache.add("10", "y", "text")
+        operations = list(read_log(self.path))
+        self.assertEqual(len(operations) - 1, 10)
+        self.assertEqual(operations[-1][3], os.path.getsize(self.path))
+        other = self.restart(cache)
+        self.assertEqual(sorted(key for (user_id, key, elem) in other.iter_elements()), sorted([str(i) for i in range(9)] + ["10"]))
+        self.assertGreater(other.get_stripe("1").general_cache.get("1").get("timeout"), time.time() + 59 * 60)
+
+    def test_compact_in_background(self):
+        oplog = OperationLog(self.path, fsync="none", interval=0.01, compact_size=1024)
+        elements = [(None, str(i), new_elem(i)) for i in range(5)]
+        oplog.open(elements=lambda: iter(elements))
+        for i in range(100):
+            oplog.append(pack_record(OP_ADD, str(i % 5), None, new_elem(i % 5)))
+        deadline = time.time() + 5
+        while oplog.base_size == HEADER_SIZE and time.time() < deadline:
+            time.sleep(0.01)
+        oplog.close()
+        self.assertGreater(oplog.base_size, HEADER_SIZE)
+        self.assertLess(os.path.getsize(self.path), 1024)
+        self.assertEqual(sorted(set(element_id for (operation, user_id, element_id, elem) in list(read_log(self.path))[:-1])), [str(i) for i in range(5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+"""
+PySiCa, a simple Python Cache system
+
+Tests for the elements stored in raw mode (pysica.py): payloads checked when they are
+stored, returned as RawValue and spliced unchanged in the responds.
+
+Usage: python -m pytest test/core
+"""
+
+import json
+import logging
+import os
+import sys
+import unittest
+
+import ujson
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, ROOT)
+
+from pysica import PySiCa, RawValue, check_raw_value, dumps_respond, loads_raw_values, dumps_item, run_batch
+
+
+def new_cache(**options):
+    logger = logging.getLogger("test_raw")
+    logger.setLevel(logging.CRITICAL)
+    return PySiCa(logger=logger, clean_interval=3600, metrics=False, **options)
+
+
+class CheckRawValueTest(unittest.TestCase):
+
+    def test_valid_payloads(self):
+        for data in ['{"a": [1, 2]}', b'{"a": 1}', '"text"', '1', 'null', u'{"ñ": 1}'.encode("utf-8")]:
+            value = check_raw_value(data)
+            self.assertIsInstance(value, RawValue)
+            self.assertEqual(value, data.decode("utf-8") if isinstance(data, bytes) else data)
+
+    def test_invalid_payloads(self):
+        for data in ['{"y": 1', '{"a": 1} x', '', b'\xff\xfe', "{'a': 1}"]:
+            with self.assertRaises(Exception):
+                check_raw_value(data)
+
+    def test_not_encoded(self):
+        # Values that are not encoded are rejected instead of storing their repr
+        for data in [{"a": 1}, [1, 2], 1, None]:
+            with self.assertRaises(Exception) as context:
+                check_raw_value(data)
+            self.assertIn("str or bytes", str(context.exception))
+
+
+class RawElementsTest(unittest.TestCase):
+
+    def test_add_rejects_invalid_payloads(self):
+        cache = new_cache()
+        self.assertFalse(cache.add("1", '{"y": 1', "object", raw=True))
+        self.assertFalse(cache.add("2", {"y": 1}, "object", raw=True))
+        self.assertTrue(cache.add("3", b'{"y": 1}', "object", raw=True))
+        self.assertEqual(cache.count_elems(), 1)
+        # Only valid payloads are spliced in the results of the queries by type
+        self.assertEqual(cache.get_elem(data_type="object"), [{"id": "3", "data": '{"y": 1}'}])
+        self.assertIsInstance(cache.get_elem("3")[0], RawValue)
+
+
+class DumpsRespondTest(unittest.TestCase):
+
+    def test_without_raw_values(self):
+        for respond in [{"success": True, "result": [{"y": 1}, 2]}, {"success": False}, {"success": True, "result": {"y": 1}}]:
+            self.assertEqual(dumps_respond(respond, ujson.dumps), ujson.dumps(respond))
+
+    def test_raw_values(self):
+        respond = {"success": True, "result": [RawValue('{"y":  [1, 2]}'), {"y": 3}]}
+        data = dumps_respond(respond, ujson.dumps)
+        # The payload is written as it was stored (spacing included)
+        self.assertIn('{"y":  [1, 2]}', data)
+        self.assertEqual(json.loads(data), {"success": True, "result": [{"y": [1, 2]}, {"y": 3}]})
+        # A respond without other fields
+        self.assertEqual(dumps_respond({"result": [RawValue('1')]}, ujson.dumps), '{"result":[1]}')
+
+    def test_query_by_type(self):
+        respond = {"success": True, "result": [{"id": "1", "data": RawValue('{"y": 1}')}, {"id": "2", "data": {"y": 2}}]}
+        data = dumps_respond(respond, ujson.dumps)
+        self.assertIn('{"id":"1","data":{"y": 1}}', data)
+        self.assertEqual(json.loads(data), {"success": True, "result": [{"id": "1", "data": {"y": 1}}, {"id": "2", "data": {"y": 2}}]})
+        self.assertEqual(dumps_item({"id": "1", "data": RawValue('[1,  2]')}, ujson.dumps), '{"id":"1","data":[1,  2]}')
+        self.assertEqual(json.loads(dumps_item({"id": "2", "data": [1, 2]}, ujson.dumps)), {"id": "2", "data": [1, 2]})
+
+    def test_batch(self):
+        cache = new_cache()
+        cache.add("raw", '{"y":  1}', "object", raw=True)
+        cache.add("encoded", {"y": 2}, "object")
+        respond = {"success": True, "result": run_batch(cache, {"operation": "get", "items": ["raw", "encoded", "missing"]})}
+        data = dumps_respond(respond, ujson.dumps)
+        # Raw values in the results of each item are spliced too
+        self.assertIn('[{"y":  1}]', data)
+        expected = {"success": True, "result": [{"success": True, "result": [{"y": 1}]}, {"success": True, "result": [{"y": 2}]}, {"success": False}]}
+        self.assertEqual(json.loads(data), expected)
+        self.assertEqual(loads_raw_values(respond, ujson.loads), expected)
+
+    def test_loads_raw_values(self):
+        respond = {"success": True, "result": [RawValue('[1, 2]'), {"id": "1", "data": RawValue('"text"')}, 3]}
+        result = loads_raw_values(respond, ujson.loads)
+        self.assertEqual(result, {"success": True, "result": [[1, 2], {"id": "1", "data": "text"}, 3]})
+        self.assertFalse(any(isinstance(item, RawValue) for item in result.get("result")))
+        # The respond itself is not modified
+        self.assertIsInstance(respond.get("result")[0], RawValue)
+        plain = {"success": True, "result": [1]}
+        self.assertIs(loads_raw_values(plain, ujson.loads), plain)
+
+
+if __name__ == '__main__':
+    unittest.main()
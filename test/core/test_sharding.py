@@ -0,0 +1,103 @@
+"""
+PySiCa, a simple Python Cache system
+
+Tests for the client-side sharding (api/pysica_sharding.py): routing of the keys with
+the consistent hashing ring, endpoints and responds gathered from all the shards.
+
+Usage: python -m pytest test/core
+"""
+
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, os.path.join(ROOT, "api"))
+
+from pysica_sharding import HashRing, hash_key, parse_endpoint, gather_responses
+
+KEYS = [str(i) for i in range(10000)]
+
+
+def new_ring(names, virtual_nodes=160, weights=None):
+    weights = weights or {}
+    return HashRing([(name, name, weights.get(name, 1)) for name in names], virtual_nodes=virtual_nodes)
+
+
+class Response(object):
+    def __init__(self, result=None, message=None):
+        if result is not None:
+            self.result = result
+        if message is not None:
+            self.message = message
+
+
+class HashRingTest(unittest.TestCase):
+
+    def test_hash_key_is_stable_across_processes(self):
+        # hash() is randomized per process, the clients of different processes must agree
+        code = "import sys; sys.path.insert(0, sys.argv[1]); from pysica_sharding import hash_key; print(hash_key('element-1'))"
+        output = subprocess.check_output([sys.executable, "-c", code, os.path.join(ROOT, "api")])
+        self.assertEqual(int(output), hash_key("element-1"))
+
+    def test_routing_does_not_depend_on_the_order_of_the_servers(self):
+        ring = new_ring(["a:4444", "b:4444", "c:4444"])
+        other = new_ring(["c:4444", "a:4444", "b:4444"])
+        self.assertEqual([ring.get_node(key) for key in KEYS], [other.get_node(key) for key in KEYS])
+
+    def test_keys_are_balanced(self):
+        ring = new_ring(["a:4444", "b:4444", "c:4444", "d:4444"])
+        counts = {}
+        for key in KEYS:
+            node = ring.get_node(key)
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEqual(len(counts), 4)
+        for count in counts.values():
+            self.assertGreater(count, len(KEYS) / 4 * 0.7)
+            self.assertLess(count, len(KEYS) / 4 * 1.3)
+
+    def test_adding_a_server_only_moves_keys_to_it(self):
+        ring = new_ring(["a:4444", "b:4444", "c:4444"])
+        bigger = new_ring(["a:4444", "b:4444", "c:4444", "d:4444"])
+        moved = [key for key in KEYS if ring.get_node(key) != bigger.get_node(key)]
+        self.assertTrue(all(bigger.get_node(key) == "d:4444" for key in moved))
+        # About a quarter of the keys move to the new server
+        self.assertGreater(len(moved), len(KEYS) * 0.15)
+        self.assertLess(len(moved), len(KEYS) * 0.35)
+
+    def test_removing_a_server_only_moves_its_keys(self):
+        ring = new_ring(["a:4444", "b:4444", "c:4444"])
+        smaller = new_ring(["a:4444", "c:4444"])
+        for key in KEYS:
+            if ring.get_node(key) != "b:4444":
+                self.assertEqual(smaller.get_node(key), ring.get_node(key))
+
+    def test_weights(self):
+        ring = new_ring(["a:4444", "b:4444"], weights={"a:4444": 3})
+        count = len([key for key in KEYS if ring.get_node(key) == "a:4444"])
+        self.assertGreater(count, len(KEYS) * 0.65)
+        self.assertLess(count, len(KEYS) * 0.85)
+
+    def test_single_server(self):
+        ring = new_ring(["a:4444"], virtual_nodes=1)
+        self.assertEqual(set(ring.get_node(key) for key in KEYS[:100]), {"a:4444"})
+
+
+class EndpointTest(unittest.TestCase):
+
+    def test_parse_endpoint(self):
+        self.assertEqual(parse_endpoint("cache1:4445"), {"server": "cache1", "port": 4445, "socket_file": None, "weight": 1, "name": "cache1:4445"})
+        self.assertEqual(parse_endpoint("cache1", port=4446).get("port"), 4446)
+        self.assertEqual(parse_endpoint(("cache1", 4445, 2)).get("weight"), 2)
+        self.assertEqual(parse_endpoint({"server": "cache1", "weight": 0.5}), {"server": "cache1", "port": 4444, "socket_file": None, "weight": 0.5, "name": "cache1:4444"})
+        self.assertEqual(parse_endpoint("/tmp/pysica.sock"), {"server": None, "port": None, "socket_file": "/tmp/pysica.sock", "weight": 1, "name": "/tmp/pysica.sock"})
+
+    def test_gather_responses(self):
+        respond = gather_responses([Response(result=[1, 2]), Response(message="Not found."), Response(result=[3])])
+        self.assertEqual(respond, {"success": True, "result": [1, 2, 3], "message": "Not found."})
+        self.assertEqual(gather_responses([Response(message="a"), Response(message="b")]), {"success": False, "message": "a b"})
+
+
+if __name__ == '__main__':
+    unittest.main()
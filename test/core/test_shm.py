@@ -0,0 +1,219 @@
+"""
+PySiCa, a simple Python Cache system
+
+Tests for the shared memory storage (pysica_shm.py): puts, gets and evictions in the
+SharedStore, its index by data_type, processes attaching to the same file and files
+replaced when their geometry does not match.
+
+Usage: python -m pytest test/core
+"""
+
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, ROOT)
+
+from pysica_shm import SharedStore, SharedPySiCa, FLAG_RAW, TYPE_SLOTS
+
+SIZE = 4 * 1024 * 1024
+PAGE_SIZE = 64 * 1024
+
+
+class SharedStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="pysica-test-shm-")
+        self.path = os.path.join(self.directory, "pysica.cache")
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def new_store(self, **options):
+        geometry = dict(size=SIZE, page_size=PAGE_SIZE, stripes=4, capacity=1024)
+        geometry.update(options)
+        store = SharedStore(self.path, **geometry)
+        self.stores.append(store)
+        return store
+
+    def test_put_get(self):
+        store = self.new_store()
+        deadline = time.time() + 60
+        self.assertEqual(store.put("1", None, "text", b"value", 1, 0, deadline), [])
+        self.assertEqual(store.put("1", "user", "text", b"user value", 0, FLAG_RAW, deadline), [])
+        self.assertEqual(store.get("1"), (1, 0, b"value"))
+        self.assertEqual(store.get("1", "user"), (0, FLAG_RAW, b"user value"))
+        self.assertIsNone(store.get("2"))
+        self.assertEqual(store.count_elems(), 2)
+        self.assertEqual(store.count_bytes(), len(b"value") + len(b"user value"))
+        self.assertEqual(store.get_user_bytes("user"), len(b"user value"))
+
+    def test_put_replaces(self):
+        store = self.new_store()
+        deadline = time.time() + 60
+        store.put("1", None, "text", b"first", 0, 0, deadline)
+        store.put("1", None, "text", b"second value", 0, 0, deadline)
+        self.assertEqual(store.get("1"), (0, 0, b"second value"))
+        self.assertEqual(store.count_elems(), 1)
+        self.assertEqual(store.count_bytes(), len(b"second value"))
+
+    def test_remove_and_expiry(self):
+        store = self.new_store()
+        store.put("1", None, "text", b"value", 0, 0, time.time() + 60)
+        store.put("2", None, "text", b"expired", 0, 0, time.time() - 1)
+        self.assertIsNone(store.get("2"))
+        self.assertEqual(store.get("1", remove=True), (0, 0, b"value"))
+        self.assertIsNone(store.get("1"))
+        store.put("3", None, "text", b"expired", 0, 0, time.time() - 1)
+        self.assertEqual(store.clean(time.time()), [(None, "3")])
+        self.assertEqual(store.count_elems(), 0)
+        self.assertEqual(store.count_bytes(), 0)
+
+    def test_get_type(self):
+        store = self.new_store()
+        deadline = time.time() + 60
+        for i in range(10):
+            store.put(str(i), None, "even" if i % 2 == 0 else "odd", str(i).encode("utf-8"), 0, 0, deadline)
+        values = sorted(item[-1] for item in store.get_type("even"))
+        self.assertEqual(values, [b"0", b"2", b"4", b"6", b"8"])
+        self.assertEqual(store.count_by_type(), {"even": 5, "odd": 5})
+
+    def test_type_index(self):
+        store = self.new_store(max_elems=200)
+        deadline = time.time() + 60
+        rand = random.Random(1)
+        for i in range(2000):
+            (element_id, user_id, data_type) = (str(rand.randrange(300)), rand.choice([None, None, "a", "b"]), "type" + str(rand.randrange(20)))
+            operation = rand.random()
+            if operation < 0.6:
+                store.put(element_id, user_id, data_type, element_id.encode("utf-8"), 0, rand.choice([0, FLAG_RAW]), deadline if rand.random() < 0.9 else time.time() - 1)
+            elif operation < 0.8:
+                store.get(element_id, user_id, remove=True)
+            elif operation < 0.9:
+                store.get_type(data_type, user_id)
+            else:
+                store.clean(time.time())
+        # Queries by type find the same elements as a scan of all of them
+        for user_id in [None, "a", "b"]:
+            elements = [item for item in store.items() if item[0] == user_id]
+            expected = {}
+            for (item_user_id, element_id, item_deadline, data_type, codec, flags, value) in elements:
+                expected[data_type] = expected.get(data_type, 0) + 1
+            self.assertEqual(store.count_by_type(user_id), expected)
+            for data_type in ["type" + str(i) for i in range(20)]:
+                found = sorted((element_id, flags, value) for (element_id, codec, flags, value) in store.get_type(data_type, user_id))
+                live = sorted((item[1], item[5], item[6]) for item in elements if item[3] == data_type and item[2] >= time.time())
+                self.assertEqual(found, live)
+
+    def test_type_index_expired(self):
+        store = self.new_store()
+        store.put("1", None, "text", b"value", 0, 0, time.time() + 60)
+        store.put("2", None, "text", b"expired", 0, 0, time.time() - 1)
+        store.put("3", "user", "text", b"user value", 0, 0, time.time() + 60)
+        self.assertEqual(store.count_by_type(), {"text": 2})
+        self.assertEqual(store.get_type("text"), [("1", 0, 0, b"value")])
+        # Expired elements found by a query are removed
+        self.assertEqual(store.count_elems(), 2)
+        self.assertEqual(store.count_by_type(), {"text": 1})
+        self.assertEqual(store.get_type("text", "user"), [("3", 0, 0, b"user value")])
+        self.assertEqual(store.get_type("other"), [])
+
+    def test_type_index_full(self):
+        # Data types that do not fit in the index of the stripe are still found
+        store = self.new_store(stripes=1, capacity=4096)
+        deadline = time.time() + 60
+        n_types = TYPE_SLOTS + 50
+        for i in range(n_types):
+            store.put(str(i), None, "type" + str(i), b"value", 0, FLAG_RAW, deadline)
+            store.put(str(i), "user", "type" + str(i), b"user value", 0, 0, deadline)
+        self.assertEqual(store.count_by_type(), dict(("type" + str(i), 1) for i in range(n_types)))
+        self.assertEqual(store.count_by_type("user"), dict(("type" + str(i), 1) for i in range(n_types)))
+        for i in range(0, n_types, 7):
+            self.assertEqual(store.get_type("type" + str(i)), [(str(i), 0, FLAG_RAW, b"value")])
+            self.assertEqual(store.get_type("type" + str(i), "user"), [(str(i), 0, 0, b"user value")])
+        for i in range(0, n_types, 2):
+            store.get(str(i), remove=True)
+        self.assertEqual(store.count_by_type(), dict(("type" + str(i), 1) for i in range(1, n_types, 2)))
+        self.assertEqual([len(store.get_type("type" + str(i))) for i in range(n_types)], [i % 2 for i in range(n_types)])
+        self.assertEqual(len(store.count_by_type("user")), n_types)
+
+    def test_evict_max_elems(self):
+        store = self.new_store(max_elems=10)
+        deadline = time.time() + 60
+        evicted = []
+        for i in range(30):
+            evicted.extend(store.put(str(i), None, "text", b"value", 0, 0, deadline))
+        self.assertEqual(store.count_elems(), 10)
+        self.assertEqual(len(evicted), 20)
+        self.assertEqual(store.get_stats().get("evictions_general"), 20)
+        # The element just written is never the victim
+        self.assertEqual(store.get("29"), (0, 0, b"value"))
+        for (user_id, element_id) in evicted:
+            self.assertIsNone(store.get(element_id))
+
+    def test_evict_when_full(self):
+        # Values larger than the free space evict elements of their slab class
+        store = self.new_store(size=1024 * 1024, page_size=PAGE_SIZE)
+        value = b"x" * 30000
+        for i in range(100):
+            store.put(str(i), None, "text", value, 0, 0, time.time() + 60)
+        self.assertEqual(store.get("99"), (0, 0, value))
+        self.assertLess(store.count_elems(), 100)
+        self.assertLessEqual(store.get_stats().get("pages"), store.get_stats().get("max_pages"))
+
+    def test_attach_existing_file(self):
+        store = self.new_store()
+        store.put("1", None, "text", b"value", 0, 0, time.time() + 60)
+        other = self.new_store()
+        self.assertTrue(store.created)
+        self.assertFalse(other.created)
+        self.assertEqual(os.fstat(other.fd).st_ino, os.fstat(store.fd).st_ino)
+        self.assertEqual(other.get("1"), (0, 0, b"value"))
+        other.put("2", None, "text", b"other", 0, 0, time.time() + 60)
+        self.assertEqual(store.get("2"), (0, 0, b"other"))
+
+    def test_replace_file_with_other_geometry(self):
+        store = self.new_store()
+        store.put("1", None, "text", b"value", 0, 0, time.time() + 60)
+        other = self.new_store(stripes=8)
+        self.assertTrue(other.created)
+        self.assertNotEqual(os.fstat(other.fd).st_ino, os.fstat(store.fd).st_ino)
+        self.assertIsNone(other.get("1"))
+        # The old file is not truncated under the processes still using it
+        self.assertEqual(store.get("1"), (0, 0, b"value"))
+        self.assertEqual(os.listdir(self.directory), ["pysica.cache"])
+
+    def test_replace_invalid_file(self):
+        with open(self.path, "wb") as output:
+            output.write(b"\xff" * SIZE)
+        store = self.new_store()
+        self.assertTrue(store.created)
+        store.put("1", None, "text", b"value", 0, 0, time.time() + 60)
+        self.assertEqual(store.get("1"), (0, 0, b"value"))
+
+
+class SharedPySiCaTest(unittest.TestCase):
+
+    def test_oplog_not_available(self):
+        directory = tempfile.mkdtemp(prefix="pysica-test-shm-")
+        try:
+            logger = logging.getLogger("test_shm")
+            logger.setLevel(logging.WARNING)
+            with self.assertRaises(Exception):
+                SharedPySiCa(path=os.path.join(directory, "pysica.cache"), size=SIZE, page_size=PAGE_SIZE, logger=logger, clean_interval=3600, oplog_file=os.path.join(directory, "pysica.oplog"))
+            self.assertFalse(os.path.exists(os.path.join(directory, "pysica.oplog")))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+"""
+PySiCa, a simple Python Cache system
+
+Tests for the snapshots of the cache (pysica_snapshot.py): entries of each kind of value,
+expired elements and snapshots saved and loaded by PySiCa.
+
+Usage: python -m pytest test/core
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, ROOT)
+
+from pysica import PySiCa
+from pysica_snapshot import pack_entry, unpack_entry, write_snapshot, read_snapshot
+
+
+def new_cache(**options):
+    logger = logging.getLogger("test_snapshot")
+    logger.setLevel(logging.WARNING)
+    return PySiCa(logger=logger, clean_interval=3600, metrics=False, **options)
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="pysica-test-snapshot-")
+        self.path = os.path.join(self.directory, "pysica.snapshot")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_entries(self):
+        deadline = time.time() + 60
+        elems = [
+            (None, "plain", {"timeout": deadline, "compressed": False, "data_type": "object", "data": {"a": [1, 2]}}),
+            ("user", "compressed", {"timeout": deadline, "compressed": True, "data_type": "text", "codec": "zlib", "data": b"\x78\x9c\x03\x00\x00\x00\x00\x01"}),
+            (None, "raw", {"timeout": deadline, "compressed": False, "data_type": None, "raw": True, "data": '{"a": 1}'})
+        ]
+        for (user_id, element_id, elem) in elems:
+            self.assertEqual(unpack_entry(pack_entry(user_id, element_id, elem), 0), (user_id, element_id, elem))
+
+    def test_write_read(self):
+        now = time.time()
+        elements = [(None, str(i), {"timeout": now + 60 if i % 2 else now - 1, "compressed": False, "data_type": "number", "data": i}) for i in range(10)]
+        self.assertEqual(write_snapshot(iter(elements), self.path), 10)
+        loaded = list(read_snapshot(self.path, now=now))
+        # Expired elements are skipped
+        self.assertEqual(loaded, [element for element in elements if element[2].get("timeout") > now])
+        self.assertEqual(os.listdir(self.directory), ["pysica.snapshot"])
+
+    def test_invalid_file(self):
+        with open(self.path, "wb") as output:
+            output.write(b"not a snapshot, just some bytes")
+        with self.assertRaises(Exception):
+            list(read_snapshot(self.path))
+        with open(self.path, "wb") as output:
+            output.write(b"PSSN")
+        with self.assertRaises(Exception):
+            list(read_snapshot(self.path))
+
+    def test_failed_write_keeps_previous(self):
+        write_snapshot(iter([(None, "1", {"timeout": time.time() + 60, "compressed": False, "data_type": "number", "data": 1})]), self.path)
+
+        def elements():
+            yield (None, "2", {"timeout": time.time() + 60, "compressed": False, "data_type": "number", "data": 2})
+            raise Exception("failed while iterating")
+
+        with self.assertRaises(Exception):
+            write_snapshot(elements(), self.path)
+        self.assertEqual([element_id for (user_id, element_id, elem) in read_snapshot(self.path)], ["1"])
+        self.assertEqual(os.listdir(self.directory), ["pysica.snapshot"])
+
+    def fill_cache(self, cache):
+        cache.add("plain", {"a": 1}, "object", compress=False)
+        cache.add("compressed", "x" * 4096, "text", compress="zlib")
+        cache.add("raw", '{"b": 2}', "object", raw=True)
+        cache.add("user", [1, 2, 3], "list", user_id="user")
+        cache.add("expired", 1, "object", timeout=-1)
+
+    def assertLoaded(self, cache):
+        self.assertEqual(cache.count_elems(), 4)
+        self.assertEqual(cache.get_elem("plain"), [{"a": 1}])
+        self.assertEqual(cache.get_elem("compressed"), ["x" * 4096])
+        self.assertEqual(cache.get_elem("raw"), ['{"b": 2}'])
+        self.assertEqual(cache.get_elem("user", user_id="user"), [[1, 2, 3]])
+        self.assertEqual(cache.get_elem("expired"), [])
+        self.assertEqual(len(cache.get_elem(data_type="object")), 2)
+
+    def test_save_load(self):
+        cache = new_cache()
+        self.fill_cache(cache)
+        self.assertEqual(cache.save_snapshot(self.path, fork=False), 0)
+        other = new_cache()
+        self.assertEqual(other.load_snapshot(self.path), 4)
+        self.assertLoaded(other)
+        self.assertEqual(other.count_bytes(), cache.count_bytes() - cache.get_stripe("expired").general_cache.get("expired").get("size"))
+
+    def test_save_forked(self):
+        if not hasattr(os, "fork"):
+            self.skipTest("fork is not available")
+        cache = new_cache()
+        self.fill_cache(cache)
+        pid = cache.save_snapshot(self.path)
+        self.assertGreater(pid, 0)
+        deadline = time.time() + 10
+        while cache.snapshot_pid is not None and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIsNone(cache.snapshot_pid)
+        other = new_cache()
+        other.load_snapshot(self.path)
+        self.assertLoaded(other)
+
+    def test_save_unchanged(self):
+        cache = new_cache()
+        cache.add("1", 1, "number")
+        self.assertEqual(cache.save_snapshot(self.path, fork=False, force=False), 0)
+        # Nothing changed since the last snapshot
+        self.assertIsNone(cache.save_snapshot(self.path, fork=False, force=False))
+
+    def test_warm_restart(self):
+        cache = new_cache(snapshot_file=self.path)
+        self.fill_cache(cache)
+        cache.save_snapshot(fork=False)
+        other = new_cache(snapshot_file=self.path)
+        self.assertLoaded(other)
+
+
+if __name__ == '__main__':
+    unittest.main()
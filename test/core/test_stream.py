@@ -0,0 +1,151 @@
+"""
+PySiCa, a simple Python Cache system
+
+Tests for the streamed queries by data_type: PySiCa.iter_type, the NDJSON chunks written
+by iter_ndjson (pysica.py), their frames (stream_frames in pysica_framing.py) and the
+client reading them as they arrive (SocketHandler.send_stream).
+
+Usage: python -m pytest test/core
+"""
+
+import json
+import logging
+import os
+import sys
+import unittest
+import zlib
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "api"))
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+import ujson
+from pysica import PySiCa, RawValue, iter_ndjson
+from pysica_framing import FrameReader, stream_frames, FLAG_CLOSE, FLAG_MORE
+from pysica_api_sockets import SocketHandler
+from test_framing import PartialConnection, read_frames
+
+
+def new_cache(**options):
+    logger = logging.getLogger("test_stream")
+    logger.setLevel(logging.CRITICAL)
+    return PySiCa(logger=logger, clean_interval=3600, metrics=False, **options)
+
+
+def parse_chunks(chunks):
+    lines = b''.join(chunks).decode("utf-8").split("\n")
+    # The last line ends with a line break too
+    assert lines.pop() == ""
+    return [json.loads(line) for line in lines]
+
+
+class ClosingConnection(PartialConnection):
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def stream_client(chunks, sizes=(1000000,), request_id=1):
+    """
+    Returns a SocketHandler reading the frames of the given chunks from a connection that
+    receives at most the given number of bytes per call.
+    """
+    data = b''.join(b''.join(bytes(buffer) for buffer in frame) for frame in stream_frames(chunks, request_id, flags=FLAG_CLOSE))
+    handler = SocketHandler(protocol_version=2)
+    handler.request_ids = iter([request_id])
+    handler.socket = ClosingConnection(data, sizes)
+    return handler
+
+
+class IterTypeTest(unittest.TestCase):
+
+    def test_elements(self):
+        cache = new_cache(stripes=4)
+        for i in range(20):
+            cache.add(str(i), {"value": i}, "even" if i % 2 == 0 else "odd")
+        cache.add("expired", 1, "even", timeout=-1)
+        cache.add("user", 1, "even", user_id="user")
+        items = list(cache.iter_type("even"))
+        self.assertEqual(sorted(item.get("id") for item in items), sorted(str(i) for i in range(0, 20, 2)))
+        self.assertTrue(all(item.get("data") == {"value": int(item.get("id"))} for item in items))
+        self.assertEqual(list(cache.iter_type("even", user_id="user")), [{"id": "user", "data": 1}])
+        self.assertEqual(list(cache.iter_type("missing")), [])
+
+    def test_raw_and_encoded(self):
+        cache = new_cache()
+        cache.add("raw", '{"y":  [1, 2]}', "object", raw=True)
+        cache.add("encoded", {"y": [1, 2]}, "object", compress="zlib")
+        items = dict((item.get("id"), item.get("data")) for item in cache.iter_type("object"))
+        self.assertIsInstance(items.get("raw"), RawValue)
+        self.assertEqual(items.get("raw"), '{"y":  [1, 2]}')
+        self.assertEqual(items.get("encoded"), {"y": [1, 2]})
+
+
+class IterNDJSONTest(unittest.TestCase):
+
+    def test_chunks(self):
+        items = [{"id": str(i), "data": "x" * (i * 7)} for i in range(100)]
+        for chunk_size in [1, 50, 1000, 65536]:
+            chunks = list(iter_ndjson(iter(items), ujson.dumps, chunk_size=chunk_size))
+            # Chunks only end at the end of a line, an element is never split
+            self.assertTrue(all(chunk.endswith(b"\n") for chunk in chunks))
+            self.assertEqual(parse_chunks(chunks), items + [{"success": True, "count": 100}], chunk_size)
+        self.assertEqual(len(list(iter_ndjson(iter(items), ujson.dumps, chunk_size=1))), 101)
+
+    def test_empty_result(self):
+        self.assertEqual(list(iter_ndjson(iter([]), ujson.dumps)), [b'{"success":false,"count":0}\n'])
+
+    def test_raw_values(self):
+        items = [{"id": "raw", "data": RawValue('{"y":  [1, 2]}')}, {"id": "encoded", "data": {"y": [1, 2]}}]
+        chunks = list(iter_ndjson(iter(items), ujson.dumps))
+        # Raw values are spliced as they are, the others are serialized
+        self.assertEqual(chunks[0].split(b"\n")[:2], [b'{"id":"raw","data":{"y":  [1, 2]}}', b'{"id":"encoded","data":{"y":[1,2]}}'])
+        self.assertEqual(parse_chunks(chunks)[:2], [{"id": "raw", "data": {"y": [1, 2]}}, {"id": "encoded", "data": {"y": [1, 2]}}])
+
+    def test_error_while_iterating(self):
+        def items():
+            yield {"id": "1", "data": 1}
+            raise Exception("stripe failed")
+        result = parse_chunks(iter_ndjson(items(), ujson.dumps))
+        self.assertEqual(result[0], {"id": "1", "data": 1})
+        self.assertEqual(result[1].get("success"), False)
+        self.assertEqual(result[1].get("count"), 1)
+        self.assertIn("stripe failed", result[1].get("message"))
+
+
+class StreamFramesTest(unittest.TestCase):
+
+    def test_frames(self):
+        chunks = [b'first\n', b'second\n', b'summary\n']
+        connection = PartialConnection(b''.join(b''.join(frame) for frame in stream_frames(chunks, 7, flags=FLAG_CLOSE)), (3,))
+        frames = read_frames(FrameReader(buffer_size=64), connection)
+        self.assertEqual([(request_id, flags) for (version, request_id, flags, payload) in frames], [(7, FLAG_MORE), (7, FLAG_MORE), (7, FLAG_CLOSE)])
+        # A single zlib stream, each frame can be decompressed as it arrives
+        decompressor = zlib.decompressobj()
+        self.assertEqual([decompressor.decompress(payload) for (version, request_id, flags, payload) in frames], chunks)
+
+    def test_records_split_across_frames(self):
+        items = [{"id": str(i), "data": "y" * i} for i in range(50)]
+        data = b''.join(iter_ndjson(iter(items), ujson.dumps))
+        # Frames cut at any byte, records span several frames
+        for size in [1, 5, 64, len(data)]:
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+            for sizes in [(1,), (7, 4096)]:
+                self.assertEqual(list(stream_client(chunks, sizes).send_stream({"target": "get"})), items, (size, sizes))
+
+    def test_empty_stream(self):
+        self.assertEqual(list(stream_client(iter_ndjson(iter([]), ujson.dumps)).send_stream({"target": "get"})), [])
+
+    def test_failed_stream(self):
+        chunks = [b'{"id":"1","data":1}\n{"success":false,"count":1,"message":"Failed while getting elements."}\n']
+        with self.assertRaises(Exception) as context:
+            list(stream_client(chunks).send_stream({"target": "get"}))
+        self.assertIn("Failed while getting elements.", str(context.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
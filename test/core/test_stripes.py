@@ -0,0 +1,121 @@
+"""
+PySiCa, a simple Python Cache system
+
+Tests for the lock stripes of the cache: concurrent adds, gets and removes from several
+threads must keep the counters of elements and bytes of each stripe consistent.
+
+Usage: python -m pytest test/core
+"""
+
+import logging
+import os
+import sys
+import threading
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, ROOT)
+
+from pysica import PySiCa
+
+THREADS = 8
+KEYS = 200
+
+
+def new_cache(**options):
+    logger = logging.getLogger("test_stripes")
+    logger.setLevel(logging.WARNING)
+    return PySiCa(logger=logger, clean_interval=3600, metrics=False, **options)
+
+
+def run_threads(target, n_threads=THREADS):
+    errors = []
+
+    def run(n):
+        try:
+            target(n)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+class StripesTest(unittest.TestCase):
+
+    def assertCountersConsistent(self, cache):
+        # The counters of each stripe match the elements it actually stores
+        for stripe in cache.stripes:
+            caches = [(None, stripe.general_cache)] + list(stripe.user_cache.items())
+            n_elems = sum(len(elements) for (user_id, elements) in caches)
+            self.assertEqual(stripe.n_elems, n_elems)
+            self.assertEqual(stripe.n_bytes, sum(elem.get("size") for (user_id, elements) in caches for elem in elements.values()))
+            for (user_id, elements) in caches:
+                self.assertEqual(stripe.cache_bytes.get(user_id, 0), sum(elem.get("size") for elem in elements.values()))
+
+    def test_keys_spread_over_stripes(self):
+        cache = new_cache(stripes=4)
+        for i in range(KEYS):
+            cache.add(str(i), i, "number", compress=False)
+        self.assertEqual(len(cache.stripes), 4)
+        self.assertTrue(all(stripe.n_elems > 0 for stripe in cache.stripes))
+        self.assertEqual(cache.count_elems(), KEYS)
+
+    def test_user_elements_in_one_stripe(self):
+        cache = new_cache(stripes=4)
+        for i in range(50):
+            cache.add(str(i), i, "number", user_id="user", compress=False)
+        stripe = cache.get_stripe(user_id="user")
+        self.assertEqual(stripe.n_elems, 50)
+        self.assertEqual(len(stripe.user_cache.get("user")), 50)
+        self.assertEqual(cache.get_cache_bytes(user_id="user"), stripe.cache_bytes.get("user"))
+
+    def test_concurrent_add_get_remove(self):
+        cache = new_cache(stripes=4)
+
+        def work(n):
+            user_id = "user-" + str(n) if n % 2 else None
+            for i in range(KEYS):
+                element_id = str(n) + "-" + str(i)
+                self.assertTrue(cache.add(element_id, {"n": n, "i": i}, "type-" + str(i % 3), user_id=user_id, compress=i % 2 == 0))
+                self.assertEqual(cache.get_elem(element_id, user_id=user_id), [{"n": n, "i": i}])
+                if i % 4 == 0:
+                    self.assertEqual(cache.remove(element_id, user_id=user_id), [{"n": n, "i": i}])
+
+        self.assertEqual(run_threads(work), [])
+        self.assertEqual(cache.count_elems(), THREADS * KEYS * 3 // 4)
+        self.assertCountersConsistent(cache)
+        self.assertEqual(len(cache.get_elem(data_type="type-1")), (THREADS // 2) * len([i for i in range(KEYS) if i % 3 == 1 and i % 4]))
+
+    def test_concurrent_overwrites(self):
+        # All the threads write the same keys, each one is stored once
+        cache = new_cache(stripes=4)
+
+        def work(n):
+            for i in range(KEYS):
+                cache.add(str(i), "x" * (n + 1), "text", compress=False)
+
+        self.assertEqual(run_threads(work), [])
+        self.assertEqual(cache.count_elems(), KEYS)
+        self.assertCountersConsistent(cache)
+
+    def test_concurrent_max_elems(self):
+        cache = new_cache(stripes=4, max_elems=100)
+
+        def work(n):
+            for i in range(KEYS):
+                cache.add(str(n) + "-" + str(i), i, "number", compress=False)
+
+        self.assertEqual(run_threads(work), [])
+        # Stripes evict on their own lock, concurrent adds may leave a few extra elements
+        self.assertLessEqual(cache.count_elems(), 100 + THREADS)
+        self.assertGreater(cache.get_stats().get("evictions"), 0)
+        self.assertCountersConsistent(cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
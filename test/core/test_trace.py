@@ -0,0 +1,155 @@
+"""
+PySiCa, a simple Python Cache system
+
+Tests for the tracing of the requests and the sampling profiler (pysica_trace.py):
+phases of a trace, slow requests logged with their breakdown, tracing switched at runtime
+and the collapsed stacks written by the profiler.
+
+Usage: python -m pytest test/core
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, ROOT)
+
+from pysica_trace import Tracer, SamplingProfiler, RequestTrace, NO_TRACE
+
+
+class RecordsHandler(logging.Handler):
+
+    def __init__(self):
+        super(RecordsHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+
+def new_logger(name):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = RecordsHandler()
+    logger.handlers = [handler]
+    return logger, handler
+
+
+class RequestTraceTest(unittest.TestCase):
+
+    def test_phases(self):
+        trace = RequestTrace(1, request_id=7, start=time.perf_counter())
+        for phase in ["recv", "cache", "send", "send"]:
+            time.sleep(0.002)
+            trace.mark(phase)
+        phases = trace.get_phases()
+        self.assertEqual(sorted(phases.keys()), ["cache", "recv", "send"])
+        # Repeated phases are added up
+        self.assertGreaterEqual(phases.get("send"), 0.004)
+        self.assertAlmostEqual(sum(phases.values()), trace.get_duration())
+        trace.target = "get"
+        self.assertTrue(str(trace).startswith("Request 1 (client id 7) get: "))
+
+
+class TracerTest(unittest.TestCase):
+
+    def setUp(self):
+        (self.logger, self.handler) = new_logger("test_trace")
+
+    def test_disabled(self):
+        tracer = Tracer(self.logger, slow_threshold=0)
+        trace = tracer.start()
+        self.assertIs(trace, NO_TRACE)
+        trace.mark("recv")
+        tracer.finish(trace, "get")
+        self.assertEqual(self.handler.records, [])
+
+    def test_configure(self):
+        tracer = Tracer(self.logger)
+        self.assertEqual(tracer.configure(enabled=True, slow_threshold="0.5"), {"enabled": True, "slow_threshold": 0.5})
+        self.assertIsInstance(tracer.start(request_id=3), RequestTrace)
+        # Options not given are kept
+        self.assertEqual(tracer.configure(enabled=False), {"enabled": False, "slow_threshold": 0.5})
+        self.assertIs(tracer.start(), NO_TRACE)
+
+    def test_slow_requests(self):
+        tracer = Tracer(self.logger, enabled=True, slow_threshold=0.01)
+        fast = tracer.start()
+        fast.mark("cache")
+        tracer.finish(fast, "get")
+        self.assertEqual(self.handler.records, [])
+        slow = tracer.start(request_id=5)
+        time.sleep(0.02)
+        slow.mark("cache")
+        tracer.finish(slow, "add")
+        self.assertEqual(len(self.handler.records), 1)
+        (level, message) = self.handler.records[0]
+        self.assertEqual(level, logging.WARNING)
+        self.assertTrue(message.startswith("Slow request. Request " + str(slow.trace_id) + " (client id 5) add: "))
+        self.assertIn("cache=", message)
+        self.assertIn("other=", message)
+        # Each trace has its own id
+        self.assertNotEqual(fast.trace_id, slow.trace_id)
+
+    def test_all_requests(self):
+        # With a threshold of 0, every request is logged at INFO
+        tracer = Tracer(self.logger, enabled=True, slow_threshold=0)
+        for i in range(3):
+            tracer.finish(tracer.start(), "stats")
+        self.assertEqual([level for (level, message) in self.handler.records], [logging.INFO] * 3)
+
+
+class SamplingProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        (self.logger, self.handler) = new_logger("test_profiler")
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_profile(self):
+        profiler = SamplingProfiler(self.logger, directory=self.directory, interval=0.005, max_time=5)
+        stop = threading.Event()
+        worker = threading.Thread(target=stop.wait, name="test-worker")
+        worker.start()
+        try:
+            path = profiler.start(0.2)
+            self.assertEqual(os.path.dirname(path), self.directory)
+            self.assertEqual(profiler.get_status(), {"running": True, "file": path})
+            with self.assertRaises(Exception):
+                profiler.start(0.2)
+            profiler.thread.join(5)
+        finally:
+            stop.set()
+            worker.join()
+        self.assertEqual(profiler.get_status(), {"running": False, "file": path})
+        with open(path) as profile:
+            lines = profile.read().splitlines()
+        # Collapsed stacks: frames separated by ";" from the thread name, then the samples
+        self.assertTrue(all(int(line.rsplit(" ", 1)[1]) > 0 for line in lines))
+        stacks = [line.rsplit(" ", 1)[0] for line in lines]
+        self.assertTrue(any(stack.startswith("test-worker;") and "wait (threading.py:" in stack for stack in stacks))
+        self.assertFalse(any(stack.startswith("pysica-profiler;") for stack in stacks))
+        self.assertFalse(os.path.exists(path + ".tmp"))
+
+    def test_limits(self):
+        profiler = SamplingProfiler(self.logger, directory=self.directory, max_time=1)
+        for seconds in [0, -1, 2]:
+            with self.assertRaises(Exception):
+                profiler.start(seconds)
+        with self.assertRaises(Exception) as context:
+            SamplingProfiler(self.logger, directory=self.directory, max_time=0).start(1)
+        self.assertIn("disabled", str(context.exception))
+        self.assertEqual(profiler.get_status(), {"running": False, "file": None})
+
+
+if __name__ == '__main__':
+    unittest.main()
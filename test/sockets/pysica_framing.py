@@ -0,0 +1 @@
+../../api/pysica_framing.py
\ No newline at end of file
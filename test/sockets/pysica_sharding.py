@@ -0,0 +1 @@
+../../api/pysica_sharding.py
\ No newline at end of file